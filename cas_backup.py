@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Incremental backups of ceph configs and monitor stores. Files are split
+# into fixed size chunks named by their SHA-256, the controller keeps the
+# chunks in a content addressed store, so only the chunks which the store
+# does not have yet get compressed and copied over.
+#
+# On the node (the manifest of the previous backup tells which chunks
+# the store already has, files with the same size and mtime as recorded
+# in it are not even read):
+#
+#   cas_backup.py backup -p prev.manifest -m host.manifest -o host.pack \
+#       /var/lib/ceph /etc/ceph
+#
+# On the controller (verifies the chunks and checks that the store has
+# everything the manifest refers to):
+#
+#   cas_backup.py ingest -s store -m host.manifest host.pack
+#
+# Restoring:
+#
+#   cas_backup.py export -s store -m host.manifest -o host.pack  # controller
+#   cas_backup.py restore -m host.manifest host.pack             # node
+#
+# Chunks are compressed (and hashed) by a pool of processes. The store is
+# never pruned.
+
+import errno
+import hashlib
+import json
+import multiprocessing
+import os
+import stat
+import struct
+import sys
+import zlib
+
+from optparse import OptionParser
+
+CHUNK_SIZE = 4 * 1024 * 1024
+COMPRESS_LEVEL = 3
+# restoring the mtime might lose the sub-microsecond part
+MTIME_TOLERANCE = 1e-5
+MANIFEST_VERSION = 1
+PACK_MAGIC = b'CASPACK1'
+_RECORD = struct.Struct('!32sI')
+
+FILE = 'f'
+DIR = 'd'
+SYMLINK = 'l'
+
+
+class BackupError(Exception):
+    pass
+
+
+def _atomic_open(path):
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    return tmp_path, open(tmp_path, 'wb')
+
+
+def _commit(f, tmp_path, path):
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(tmp_path, path)
+
+
+def load_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise BackupError('%s: unsupported manifest version %s' % (
+            path, manifest.get('version')))
+    return manifest
+
+
+def save_manifest(manifest, path):
+    tmp_path, f = _atomic_open(path)
+    f.write(json.dumps(manifest, sort_keys=True).encode('utf-8'))
+    _commit(f, tmp_path, path)
+
+
+def manifest_chunks(manifest):
+    return set(digest for entry in manifest['files']
+               for digest in entry.get('chunks', ()))
+
+
+def walk(roots):
+    """Yield (path, lstat) of the roots and their contents, not crossing
+    the file systems boundaries (like tar --one-file-system)"""
+    for root in roots:
+        root = os.path.abspath(root)
+        try:
+            root_st = os.lstat(root)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        yield root, root_st
+        if not stat.S_ISDIR(root_st.st_mode):
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in sorted(dirnames):
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                yield path, st
+                if st.st_dev != root_st.st_dev:
+                    # a mount point, record it but don't descend
+                    dirnames.remove(name)
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                yield path, os.lstat(path)
+            dirnames.sort()
+
+
+# Pool workers. The digests of the chunks which the store has are passed
+# to every worker once, on start
+
+_have = frozenset()
+
+
+def _init_worker(have):
+    global _have
+    _have = have
+
+
+def _read_chunk(path, offset, size):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(size)
+    if len(data) != size:
+        raise BackupError('%s: changed while being backed up' % path)
+    return data
+
+
+def _hash_chunk(args):
+    """(raw digest, compressed data or None if the store has the chunk)"""
+    path, offset, size, level = args
+    data = _read_chunk(path, offset, size)
+    digest = hashlib.sha256(data).digest()
+    if digest in _have:
+        return digest, None
+    return digest, zlib.compress(data, level)
+
+
+def _verify_chunk(args):
+    digest, compressed = args
+    data = zlib.decompress(compressed)
+    if hashlib.sha256(data).digest() != digest:
+        raise BackupError('chunk %s is corrupted' % _hex(digest))
+    return len(data)
+
+
+def _hex(digest):
+    return digest.encode('hex') if str is bytes else digest.hex()
+
+
+def _unhex(digest):
+    return digest.decode('hex') if str is bytes else bytes.fromhex(digest)
+
+
+def _entry(path, st):
+    entry = {
+        'path': path,
+        'mode': stat.S_IMODE(st.st_mode),
+        'uid': st.st_uid,
+        'gid': st.st_gid,
+        'mtime': st.st_mtime,
+    }
+    if stat.S_ISDIR(st.st_mode):
+        entry['type'] = DIR
+    elif stat.S_ISLNK(st.st_mode):
+        entry['type'] = SYMLINK
+        entry['target'] = os.readlink(path)
+    elif stat.S_ISREG(st.st_mode):
+        entry['type'] = FILE
+        entry['size'] = st.st_size
+    else:
+        # sockets, fifos, devices
+        return None
+    return entry
+
+
+def write_pack_header(f):
+    f.write(PACK_MAGIC)
+
+
+def write_pack_record(f, digest, compressed):
+    f.write(_RECORD.pack(digest, len(compressed)))
+    f.write(compressed)
+
+
+def read_pack(f, skip=False):
+    """Yield (raw digest, compressed chunk) of the pack, or (raw digest,
+    (offset, size)) of the chunk if skip is True"""
+    if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+        raise BackupError('not a pack file')
+    while True:
+        header = f.read(_RECORD.size)
+        if not header:
+            return
+        if len(header) != _RECORD.size:
+            raise BackupError('truncated pack file')
+        digest, size = _RECORD.unpack(header)
+        if skip:
+            offset = f.tell()
+            f.seek(size, os.SEEK_CUR)
+            if f.tell() > os.fstat(f.fileno()).st_size:
+                raise BackupError('truncated pack file')
+            yield digest, (offset, size)
+            continue
+        data = f.read(size)
+        if len(data) != size:
+            raise BackupError('truncated pack file')
+        yield digest, data
+
+
+def backup(roots, manifest_path, pack_path, prev_manifest_path=None,
+           chunk_size=CHUNK_SIZE, level=COMPRESS_LEVEL, processes=None):
+    """Write the manifest of the files under roots, and the pack of
+    the chunks missing in the previous backup. Returns (files, chunks
+    read, chunks packed)"""
+    prev = {}
+    have = set()
+    if prev_manifest_path and os.path.exists(prev_manifest_path):
+        prev_manifest = load_manifest(prev_manifest_path)
+        if prev_manifest['chunk_size'] == chunk_size:
+            prev = dict((e['path'], e) for e in prev_manifest['files']
+                        if e['type'] == FILE)
+            have = set(_unhex(d) for d in manifest_chunks(prev_manifest))
+
+    entries = []
+    jobs = []  # (entry, chunk index, path, offset, size)
+    for path, st in walk(roots):
+        entry = _entry(path, st)
+        if entry is None:
+            continue
+        entries.append(entry)
+        if entry['type'] != FILE:
+            continue
+        old = prev.get(path)
+        if old is not None and old['size'] == entry['size'] and \
+                abs(old['mtime'] - entry['mtime']) < MTIME_TOLERANCE:
+            entry['chunks'] = old['chunks']
+            continue
+        count = (entry['size'] + chunk_size - 1) // chunk_size
+        entry['chunks'] = [None] * count
+        for idx in range(count):
+            offset = idx * chunk_size
+            jobs.append((entry, idx, path, offset,
+                         min(chunk_size, entry['size'] - offset)))
+
+    packed = set()
+    pool = multiprocessing.Pool(processes, _init_worker, (frozenset(have),))
+    tmp_path, pack = _atomic_open(pack_path)
+    try:
+        write_pack_header(pack)
+        results = pool.imap(_hash_chunk, [(path, offset, size, level) for
+                                          entry, idx, path, offset, size
+                                          in jobs])
+        for job, (digest, compressed) in enumerate(results):
+            entry, idx = jobs[job][:2]
+            entry['chunks'][idx] = _hex(digest)
+            if compressed is not None and digest not in packed:
+                write_pack_record(pack, digest, compressed)
+                packed.add(digest)
+        pool.close()
+        _commit(pack, tmp_path, pack_path)
+    except:
+        pool.terminate()
+        pack.close()
+        os.unlink(tmp_path)
+        raise
+    finally:
+        pool.join()
+
+    save_manifest({
+        'version': MANIFEST_VERSION,
+        'chunk_size': chunk_size,
+        'files': entries,
+    }, manifest_path)
+    return len(entries), len(jobs), len(packed)
+
+
+class Store(object):
+    """Compressed chunks as objects/<2 hex digits>/<the rest>"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _object_path(self, hex_digest):
+        return os.path.join(self.path, 'objects', hex_digest[:2],
+                            hex_digest[2:])
+
+    def __contains__(self, hex_digest):
+        return os.path.exists(self._object_path(hex_digest))
+
+    def get(self, hex_digest):
+        try:
+            with open(self._object_path(hex_digest), 'rb') as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise BackupError('chunk %s is missing in the store' %
+                                  hex_digest)
+            raise
+
+    def put(self, hex_digest, compressed):
+        path = self._object_path(hex_digest)
+        if os.path.exists(path):
+            return False
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_path, f = _atomic_open(path)
+        f.write(compressed)
+        _commit(f, tmp_path, path)
+        return True
+
+    def missing(self, manifest):
+        return sorted(d for d in manifest_chunks(manifest) if d not in self)
+
+
+def _pack_batches(records, batch):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= batch:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def ingest(store, manifest_path, pack_path, processes=None):
+    """Verify the chunks of the pack and add them to the store. Fails
+    if the store still lacks some chunks of the manifest. Returns
+    the number of the new chunks"""
+    manifest = load_manifest(manifest_path)
+    added = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        with open(pack_path, 'rb') as f:
+            # bounded batches, the pack might be large
+            for records in _pack_batches(read_pack(f), 64):
+                pool.map(_verify_chunk, records)
+                for digest, compressed in records:
+                    added += store.put(_hex(digest), compressed)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    missing = store.missing(manifest)
+    if missing:
+        raise BackupError('%d chunks of %s are missing in the store (was '
+                          'the previous backup lost?), remove the manifest '
+                          'to make a full backup' % (len(missing),
+                                                     manifest_path))
+    return added
+
+
+def export(store, manifest_path, pack_path):
+    """Pack all chunks of the manifest. Returns the number of chunks"""
+    manifest = load_manifest(manifest_path)
+    digests = sorted(manifest_chunks(manifest))
+    tmp_path, pack = _atomic_open(pack_path)
+    try:
+        write_pack_header(pack)
+        for hex_digest in digests:
+            write_pack_record(pack, _unhex(hex_digest), store.get(hex_digest))
+        _commit(pack, tmp_path, pack_path)
+    except:
+        pack.close()
+        os.unlink(tmp_path)
+        raise
+    return len(digests)
+
+
+def _remove(path):
+    try:
+        st = os.lstat(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISDIR(st.st_mode):
+        os.unlink(path)
+
+
+def restore(manifest_path, pack_path, prefix='/'):
+    """Recreate the files of the manifest (under prefix) from the pack,
+    verifying every chunk and the size of every file. Returns the number
+    of files"""
+    manifest = load_manifest(manifest_path)
+    pack = open(pack_path, 'rb')
+    chunks = dict((_hex(digest), location) for digest, location in
+                  read_pack(pack, skip=True))
+    missing = manifest_chunks(manifest).difference(chunks)
+    if missing:
+        raise BackupError('%d chunks are missing in %s' % (len(missing),
+                                                           pack_path))
+
+    def chunk(hex_digest):
+        offset, size = chunks[hex_digest]
+        pack.seek(offset)
+        data = zlib.decompress(pack.read(size))
+        if hashlib.sha256(data).hexdigest() != hex_digest:
+            raise BackupError('chunk %s is corrupted' % hex_digest)
+        return data
+
+    def target(entry):
+        return os.path.join(prefix, entry['path'].lstrip('/'))
+
+    for entry in manifest['files']:
+        path = target(entry)
+        if entry['type'] == DIR:
+            if not os.path.isdir(path):
+                _remove(path)
+                os.makedirs(path)
+        elif entry['type'] == SYMLINK:
+            _remove(path)
+            os.symlink(entry['target'], path)
+        else:
+            _remove(path)
+            size = 0
+            with open(path, 'wb') as f:
+                for hex_digest in entry['chunks']:
+                    data = chunk(hex_digest)
+                    f.write(data)
+                    size += len(data)
+            if size != entry['size']:
+                raise BackupError('%s: restored %d bytes instead of %d' % (
+                    path, size, entry['size']))
+        os.lchown(path, entry['uid'], entry['gid'])
+        if entry['type'] != SYMLINK:
+            os.chmod(path, entry['mode'])
+            os.utime(path, (entry['mtime'], entry['mtime']))
+    pack.close()
+    # creating the files has changed the directories' mtime
+    for entry in reversed(manifest['files']):
+        if entry['type'] == DIR:
+            os.utime(target(entry), (entry['mtime'], entry['mtime']))
+    return len(manifest['files'])
+
+
+def main():
+    parser = OptionParser(usage='%prog backup|ingest|export|restore '
+                          '[options] [args]')
+    parser.add_option('-m', '--manifest', dest='manifest',
+                      help='manifest of the backup')
+    parser.add_option('-p', '--prev-manifest', dest='prev_manifest',
+                      help='manifest of the previous backup (backup)')
+    parser.add_option('-o', '--output', dest='output',
+                      help='pack to write (backup, export)')
+    parser.add_option('-s', '--store', dest='store',
+                      help='chunk store directory (ingest, export)')
+    parser.add_option('-P', '--processes', dest='processes', type=int,
+                      help='number of compressing processes [CPU count]')
+    parser.add_option('-l', '--level', dest='level', type=int,
+                      default=COMPRESS_LEVEL,
+                      help='compression level [%default]')
+    parser.add_option('-C', '--prefix', dest='prefix', default='/',
+                      help='restore the files under this directory '
+                      '[%default]')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('no mode given')
+    mode, args = args[0], args[1:]
+    if not options.manifest:
+        parser.error('no manifest given')
+    try:
+        if mode == 'backup':
+            if not args or not options.output:
+                parser.error('backup needs the pack and the paths')
+            files, read, packed = backup(
+                args, options.manifest, options.output,
+                prev_manifest_path=options.prev_manifest,
+                level=options.level, processes=options.processes)
+            print('%d files, %d chunks read, %d chunks packed' % (
+                files, read, packed))
+        elif mode == 'ingest':
+            if len(args) != 1 or not options.store:
+                parser.error('ingest needs the store and the pack')
+            added = ingest(Store(options.store), options.manifest, args[0],
+                           processes=options.processes)
+            print('%d new chunks' % added)
+        elif mode == 'export':
+            if not options.store or not options.output:
+                parser.error('export needs the store and the pack')
+            count = export(Store(options.store), options.manifest,
+                           options.output)
+            print('%d chunks exported' % count)
+        elif mode == 'restore':
+            if len(args) != 1:
+                parser.error('restore needs the pack')
+            count = restore(options.manifest, args[0], prefix=options.prefix)
+            print('%d files restored' % count)
+        else:
+            parser.error('unknown mode: %s' % mode)
+    except BackupError as e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# cloud-init phone home server. A single long-lived server receives the
+# phone_home posts of all VMs being provisioned (rather than a listener
+# per VM, which can't share the address with the others), writes the
+# posted host keys to ~/.ssh/known_hosts in batches, and lets clients
+# wait until the given VMs have reported. The VMs' user-data should have
+#
+#   phone_home:
+#     url: http://10.253.0.1:8080/$INSTANCE_ID/
+#     post: [pub_key_rsa, pub_key_ecdsa, pub_key_ed25519, hostname, fqdn]
+#
+# and the VMs are provisioned like this:
+#
+#   cloudinit_callback.py start -l 10.253.0.1:8080 vm1 vm2
+#   (reprovision vm1 and vm2)
+#   cloudinit_callback.py wait -l 10.253.0.1:8080 -t 600 vm1 vm2
+#
+# `start` runs the server in background unless it's already running and
+# forgets the previous reports of the given VMs; `wait` returns once the
+# VMs have reported and their keys are in known_hosts. The server exits
+# after being idle for --idle-timeout seconds.
+
+import asyncio
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from optparse import OptionParser
+from urllib.parse import (
+    parse_qs,
+    urlencode,
+    urlsplit,
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'maas_tools'))
+
+from cacheutils import cache_dir
+from known_hosts import (
+    KNOWN_HOSTS_FILE,
+    KnownHosts,
+)
+
+ADDR = '10.253.0.1:8080'
+WAIT_TIMEOUT = 600
+IDLE_TIMEOUT = 3600
+# collect the reports arriving within that interval into one known_hosts
+# update, seconds
+FLUSH_DELAY = 0.5
+# a single wait request lasts at most that long, the client re-polls
+POLL_INTERVAL = 30
+START_TIMEOUT = 10
+REQUEST_TIMEOUT = 10
+MAX_BODY_SIZE = 64 * 1024
+KEY_FIELDS = ('pub_key_rsa', 'pub_key_ecdsa', 'pub_key_ed25519',
+              'pub_key_dsa')
+REPORTS_PATH = '/reports'
+LOG_FILE = 'cloudinit_callback.log'
+
+
+class CallbackError(Exception):
+    pass
+
+
+def parse_addr(addr):
+    host, _, port = addr.rpartition(':')
+    if not host or not port.isdigit():
+        raise CallbackError('invalid address %s, expected HOST:PORT' % addr)
+    return host, int(port)
+
+
+def short_name(name):
+    return name.split('.')[0].lower()
+
+
+def host_keys(form):
+    """'type base64' host keys from the phone_home post, comments (which
+    are the VM's own idea of its name) are dropped"""
+    keys = []
+    for field in KEY_FIELDS:
+        for value in form.get(field, ()):
+            parts = value.split()
+            if len(parts) >= 2:
+                keys.append(' '.join(parts[:2]))
+    return keys
+
+
+class Report(object):
+    def __init__(self, hostname, fqdn, addr, keys):
+        self.hostname = hostname
+        self.fqdn = fqdn
+        self.addr = addr
+        self.keys = keys
+        self.time = time.time()
+
+    @property
+    def names(self):
+        """Names the host is known as, without duplicates"""
+        names = []
+        for name in (self.hostname, self.fqdn, self.addr):
+            if name and name not in names:
+                names.append(name)
+        return names
+
+    def to_json(self):
+        return {'hostname': self.hostname, 'fqdn': self.fqdn,
+                'addr': self.addr, 'keys': len(self.keys),
+                'time': self.time}
+
+
+def update_known_hosts(reports, path=KNOWN_HOSTS_FILE):
+    """Replace the keys of all the reported hosts with one write"""
+    known_hosts = KnownHosts(path)
+    for report in reports:
+        for name in report.names:
+            known_hosts.remove(name)
+        for key in report.keys:
+            known_hosts.add(report.names, key)
+    known_hosts.commit()
+
+
+class CallbackServer(object):
+    """Reports are kept by the short host name. A host counts as
+    reported only after its keys have been written to known_hosts"""
+
+    def __init__(self, known_hosts_file=KNOWN_HOSTS_FILE,
+                 flush_delay=FLUSH_DELAY, idle_timeout=IDLE_TIMEOUT):
+        self.known_hosts_file = known_hosts_file
+        self.flush_delay = flush_delay
+        self.idle_timeout = idle_timeout
+        self.reported = {}
+        self._pending = {}
+        self._has_pending = asyncio.Event()
+        self._changed = asyncio.Condition()
+        self._waiters = 0
+        self._last_active = time.time()
+
+    def log(self, msg):
+        sys.stderr.write('%s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                                      msg))
+        sys.stderr.flush()
+
+    async def flusher(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self._has_pending.wait()
+            await asyncio.sleep(self.flush_delay)
+            pending, self._pending = self._pending, {}
+            self._has_pending.clear()
+            try:
+                await loop.run_in_executor(None, update_known_hosts,
+                                           list(pending.values()),
+                                           self.known_hosts_file)
+            except EnvironmentError as e:
+                self.log('failed to update %s: %s' % (self.known_hosts_file,
+                                                      e))
+                continue
+            self.log('known_hosts updated: %s' % ' '.join(sorted(pending)))
+            async with self._changed:
+                self.reported.update(pending)
+                self._changed.notify_all()
+
+    async def run(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        self.log('listening on %s:%d' % (host, port))
+        flusher = asyncio.ensure_future(self.flusher())
+        try:
+            while self._pending or self._waiters or \
+                    time.time() - self._last_active < self.idle_timeout:
+                await asyncio.sleep(1)
+            self.log('idle for %ds, exiting' % self.idle_timeout)
+        finally:
+            flusher.cancel()
+            server.close()
+            await server.wait_closed()
+
+    def phone_home(self, form, addr):
+        fqdn = form.get('fqdn', [''])[0]
+        hostname = form.get('hostname', [''])[0] or fqdn
+        keys = host_keys(form)
+        if not hostname:
+            return 400, {'error': 'no hostname'}
+        if not keys:
+            return 400, {'error': 'no host keys'}
+        name = short_name(hostname)
+        self._pending[name] = Report(hostname, fqdn, addr, keys)
+        self._has_pending.set()
+        self.log('%s: phoned home from %s, %d keys' % (name, addr,
+                                                       len(keys)))
+        return 200, {'host': name}
+
+    def forget(self, hosts):
+        for host in hosts:
+            self.reported.pop(host, None)
+            self._pending.pop(host, None)
+        return 200, {'forgotten': sorted(hosts)}
+
+    async def wait(self, hosts, timeout):
+        self._waiters += 1
+        try:
+            deadline = time.time() + timeout
+            async with self._changed:
+                while True:
+                    missing = [h for h in hosts if h not in self.reported]
+                    remaining = deadline - time.time()
+                    if not missing or remaining <= 0:
+                        break
+                    try:
+                        await asyncio.wait_for(self._changed.wait(),
+                                               remaining)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self._waiters -= 1
+        return 200, {
+            'reported': dict((h, self.reported[h].to_json())
+                             for h in hosts if h in self.reported),
+            'missing': missing,
+        }
+
+    async def dispatch(self, method, url, body, addr):
+        url = urlsplit(url)
+        query = parse_qs(url.query)
+        if url.path == REPORTS_PATH:
+            hosts = [short_name(h) for value in query.get('hosts', ())
+                     for h in value.split(',') if h]
+            if method == 'GET':
+                timeout = float(query.get('wait', ['0'])[0])
+                return await self.wait(hosts, min(timeout, POLL_INTERVAL))
+            if method == 'DELETE':
+                return self.forget(hosts)
+            return 405, {'error': 'method not allowed'}
+        if method == 'POST':
+            return self.phone_home(parse_qs(body.decode('utf-8', 'replace')),
+                                   addr)
+        return 404, {'error': 'not found'}
+
+    async def read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise ValueError('bad request line')
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY_SIZE:
+            raise ValueError('request too big')
+        body = await reader.readexactly(length) if length else b''
+        return request_line[0], request_line[1], body
+
+    async def handle(self, reader, writer):
+        self._last_active = time.time()
+        addr = writer.get_extra_info('peername')[0]
+        try:
+            try:
+                method, url, body = await asyncio.wait_for(
+                    self.read_request(reader), REQUEST_TIMEOUT)
+            except (ValueError, asyncio.IncompleteReadError,
+                    asyncio.TimeoutError) as e:
+                status, result = 400, {'error': str(e) or 'bad request'}
+            else:
+                try:
+                    status, result = await self.dispatch(method, url, body,
+                                                         addr)
+                except ValueError as e:
+                    status, result = 400, {'error': str(e)}
+            data = json.dumps(result).encode('utf-8')
+            writer.write(('HTTP/1.0 %d %s\r\n'
+                          'Content-Type: application/json\r\n'
+                          'Content-Length: %d\r\n'
+                          'Connection: close\r\n\r\n' % (
+                              status, http.client.responses.get(status, ''),
+                              len(data))).encode('latin-1') + data)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self._last_active = time.time()
+
+
+def request(addr, method, hosts, timeout=REQUEST_TIMEOUT, **params):
+    host, port = parse_addr(addr)
+    query = urlencode(dict(params, hosts=','.join(hosts)))
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request(method, '%s?%s' % (REPORTS_PATH, query))
+        resp = conn.getresponse()
+        result = json.loads(resp.read().decode('utf-8'))
+    finally:
+        conn.close()
+    if resp.status != 200:
+        raise CallbackError('%s: %s' % (addr, result.get('error',
+                                                         resp.reason)))
+    return result
+
+
+def is_running(addr):
+    try:
+        request(addr, 'GET', [])
+    except (socket.error, http.client.HTTPException, ValueError):
+        return False
+    return True
+
+
+def start(addr, hosts, known_hosts_file=KNOWN_HOSTS_FILE,
+          idle_timeout=IDLE_TIMEOUT):
+    """Run the server in background unless it's running already, forget
+    the previous reports of the hosts"""
+    if not is_running(addr):
+        log_path = os.path.join(cache_dir(), LOG_FILE)
+        with open(log_path, 'a') as log, open(os.devnull) as devnull:
+            subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              'serve', '-l', addr, '-k', known_hosts_file,
+                              '-i', str(idle_timeout)],
+                             stdin=devnull, stdout=log, stderr=log,
+                             start_new_session=True)
+        deadline = time.time() + START_TIMEOUT
+        while not is_running(addr):
+            if time.time() > deadline:
+                raise CallbackError('server has not started on %s, see %s' % (
+                    addr, log_path))
+            time.sleep(0.2)
+    request(addr, 'DELETE', hosts)
+
+
+def wait(addr, hosts, timeout=WAIT_TIMEOUT):
+    """{host: report} of the hosts which have reported within timeout,
+    and the list of missing ones. Connection errors are retried until
+    the timeout expires, so the server can be restarted meanwhile"""
+    deadline = time.time() + timeout
+    result = {'reported': {}, 'missing': hosts}
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            result = request(addr, 'GET', hosts,
+                             timeout=POLL_INTERVAL + REQUEST_TIMEOUT,
+                             wait=int(min(remaining, POLL_INTERVAL)))
+        except (socket.error, http.client.HTTPException):
+            time.sleep(min(1, max(remaining, 0)))
+            continue
+        if not result['missing']:
+            break
+    return result['reported'], result['missing']
+
+
+def serve(addr, known_hosts_file=KNOWN_HOSTS_FILE,
+          idle_timeout=IDLE_TIMEOUT):
+    host, port = parse_addr(addr)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def main():
+        server = CallbackServer(known_hosts_file=known_hosts_file,
+                                idle_timeout=idle_timeout)
+        await server.run(host, port)
+
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+def main():
+    parser = OptionParser(usage='%prog serve [options]\n'
+                          '       %prog start [options] HOST...\n'
+                          '       %prog wait [options] HOST...')
+    parser.add_option('-l', '--listen', dest='addr', default=ADDR,
+                      help='address of the server, HOST:PORT [%default]')
+    parser.add_option('-t', '--timeout', dest='timeout', type=int,
+                      default=WAIT_TIMEOUT,
+                      help='wait that long for the hosts to report, '
+                      'seconds (wait) [%default]')
+    parser.add_option('-k', '--known-hosts', dest='known_hosts',
+                      default=KNOWN_HOSTS_FILE,
+                      help='known_hosts file to update (serve, start) '
+                      '[%default]')
+    parser.add_option('-i', '--idle-timeout', dest='idle_timeout', type=int,
+                      default=IDLE_TIMEOUT,
+                      help='exit after being idle for that long, seconds '
+                      '(serve, start) [%default]')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('no mode given')
+    mode, hosts = args[0], [short_name(h) for h in args[1:]]
+    try:
+        if mode == 'serve':
+            if hosts:
+                parser.error('serve takes no hosts')
+            serve(options.addr, options.known_hosts, options.idle_timeout)
+        elif mode == 'start':
+            start(options.addr, hosts, options.known_hosts,
+                  options.idle_timeout)
+        elif mode == 'wait':
+            if not hosts:
+                parser.error('no hosts given')
+            reported, missing = wait(options.addr, hosts, options.timeout)
+            for host in hosts:
+                if host in reported:
+                    print('%s: reported from %s' % (host,
+                                                    reported[host]['addr']))
+            if missing:
+                sys.stderr.write('no report in %ds from: %s\n' % (
+                    options.timeout, ' '.join(missing)))
+                sys.exit(1)
+        else:
+            parser.error('unknown mode: %s' % mode)
+    except CallbackError as e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
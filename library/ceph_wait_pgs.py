@@ -0,0 +1,288 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+DOCUMENTATION = '''
+---
+module: ceph_wait_pgs
+short_description: Wait until all placement groups are active+clean
+description:
+  - Polls the PG state counts from the pgmap summary of C(ceph status),
+    which is small no matter how many PGs the cluster has. The full
+    C(ceph pg dump) is used only if the summary has no per state counts,
+    and it's parsed as it's being read instead of loading it as a whole.
+  - The polling interval grows while the recovery makes no progress
+    and shrinks back once it does.
+  - Scrubbing PGs are considered clean.
+options:
+  cluster:
+    description: name of the cluster
+    default: ceph
+  timeout:
+    description: give up after that many seconds
+    default: 300
+  min_delay:
+    description: initial (and minimal) interval between polls, seconds
+    default: 2
+  max_delay:
+    description: maximal interval between polls, seconds
+    default: 30
+  state:
+    description: the state all PGs should reach
+    default: active+clean
+'''
+
+EXAMPLES = '''
+- name: wait for PGs to become active+clean
+  ceph_wait_pgs: timeout=125
+  delegate_to: "{{ groups.mons[0] }}"
+'''
+
+import json
+import subprocess
+import time
+
+# PG state flags which don't matter for the data safety
+IGNORED_STATE_FLAGS = ('scrubbing', 'deep', 'scrubq')
+# progress samples to return
+MAX_SAMPLES = 50
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+
+
+def normalize_state(state):
+    return '+'.join(flag for flag in state.split('+')
+                    if flag not in IGNORED_STATE_FLAGS)
+
+
+def iter_json_array(chunks, buf=''):
+    """Yield the elements of a JSON array given as an iterable of text
+    chunks (buf being the data read so far), without holding the whole
+    document. Modules are self-contained, so this duplicates
+    maas_tools/node_records.py"""
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    pos = 0
+    started = False
+    exhausted = False
+
+    while True:
+        while pos < len(buf) and buf[pos] in _WHITESPACE:
+            pos += 1
+        item = end = None
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('expected a JSON array')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            if buf[pos] == ',':
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if exhausted:
+                    raise
+            if end is not None and (end < len(buf) or exhausted):
+                pos = end
+                yield item
+                continue
+        if exhausted:
+            raise ValueError('truncated JSON array')
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+        else:
+            buf = buf[pos:] + chunk
+            pos = 0
+
+
+def iter_pg_stats(chunks, key='"pg_stats"'):
+    """Elements of the (first) pg_stats array of `pg dump` output"""
+    chunks = iter(chunks)
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        idx = buf.find(key)
+        if idx < 0:
+            # the key might be split between the chunks
+            buf = buf[-len(key):]
+            continue
+        buf = buf[idx + len(key):].lstrip(_WHITESPACE)
+        while not buf:
+            buf = next(chunks, '').lstrip(_WHITESPACE)
+            if not buf:
+                raise ValueError('truncated pg dump')
+        if buf[0] != ':':
+            continue
+        return iter_json_array(chunks, buf[1:])
+    raise ValueError('no pg_stats in pg dump')
+
+
+class PgState(object):
+    def __init__(self, counts, degraded=0, misplaced=0, unfound=0,
+                 source='status'):
+        self.counts = counts  # state => number of PGs
+        self.degraded = degraded
+        self.misplaced = misplaced
+        self.unfound = unfound
+        self.source = source
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def count(self, state):
+        return self.counts.get(state, 0)
+
+    def sample(self, elapsed, wanted):
+        return {
+            'elapsed': round(elapsed, 1),
+            wanted: self.count(wanted),
+            'pgs': self.total,
+            'degraded_objects': self.degraded,
+            'misplaced_objects': self.misplaced,
+        }
+
+
+class CephPgs(object):
+    def __init__(self, module, cluster):
+        self.module = module
+        self.cmd = ['ceph', '--cluster', cluster]
+
+    def summary(self):
+        """PgState from the pgmap of `ceph status`, None if it lacks
+        the state counts"""
+        rc, out, err = self.module.run_command(
+            self.cmd + ['status', '--format=json'], check_rc=True)
+        pgmap = json.loads(out).get('pgmap', {})
+        if 'pgs_by_state' not in pgmap:
+            return None
+        counts = {}
+        for item in pgmap['pgs_by_state']:
+            state = normalize_state(item['state_name'])
+            counts[state] = counts.get(state, 0) + item['count']
+        return PgState(counts,
+                       degraded=pgmap.get('degraded_objects', 0),
+                       misplaced=pgmap.get('misplaced_objects', 0),
+                       unfound=pgmap.get('unfound_objects', 0))
+
+    def dump(self):
+        """PgState counted over the streamed `ceph pg dump`"""
+        # text mode, so that the chunks are str with python 3 too
+        proc = subprocess.Popen(self.cmd + ['pg', 'dump', '--format=json'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        chunks = iter(lambda: proc.stdout.read(CHUNK_SIZE), '')
+        counts = {}
+        degraded = misplaced = unfound = 0
+        error = None
+        try:
+            for pg in iter_pg_stats(chunks):
+                state = normalize_state(pg['state'])
+                counts[state] = counts.get(state, 0) + 1
+                stat_sum = pg.get('stat_sum', {})
+                degraded += stat_sum.get('num_objects_degraded', 0)
+                misplaced += stat_sum.get('num_objects_misplaced', 0)
+                unfound += stat_sum.get('num_objects_unfound', 0)
+        except (ValueError, KeyError) as e:
+            error = e
+        finally:
+            # read (and drop) the rest of the dump, otherwise ceph
+            # fails with EPIPE
+            for chunk in chunks:
+                pass
+            err = proc.stderr.read()
+            rc = proc.wait()
+        # a failed ceph leaves no (or partial) output, report its stderr
+        # rather than the parse error
+        if rc != 0:
+            self.module.fail_json(msg='ceph pg dump failed: %s' % err,
+                                  rc=rc, stderr=err)
+        if error is not None:
+            self.module.fail_json(msg='failed to parse ceph pg dump: %s' %
+                                  error)
+        return PgState(counts, degraded=degraded, misplaced=misplaced,
+                       unfound=unfound, source='pg dump')
+
+    def state(self):
+        return self.summary() or self.dump()
+
+
+def wait_pgs(pgs, wanted, timeout, min_delay, max_delay):
+    """Poll until all PGs are in the wanted state. The delay doubles
+    (up to max_delay) while nothing changes and is reset to min_delay
+    once more PGs get to the wanted state or less objects are degraded
+    or misplaced. Returns (success, last PgState, polls, samples)"""
+    started = time.time()
+    delay = min_delay
+    samples = []
+    polls = 0
+    prev = None
+    while True:
+        state = pgs.state()
+        polls += 1
+        elapsed = time.time() - started
+        if prev is None or (state.count(wanted), state.degraded,
+                            state.misplaced) != (prev.count(wanted),
+                                                 prev.degraded,
+                                                 prev.misplaced):
+            samples.append(state.sample(elapsed, wanted))
+            del samples[:-MAX_SAMPLES]
+        if state.total > 0 and state.count(wanted) == state.total:
+            return True, state, polls, samples
+        if elapsed + delay > timeout:
+            return False, state, polls, samples
+        if prev is not None:
+            progress = (state.count(wanted) > prev.count(wanted) or
+                        state.degraded + state.misplaced <
+                        prev.degraded + prev.misplaced)
+            delay = min_delay if progress else min(delay * 2, max_delay)
+        prev = state
+        time.sleep(delay)
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            cluster=dict(default='ceph'),
+            timeout=dict(default=300, type='int'),
+            min_delay=dict(default=2, type='int'),
+            max_delay=dict(default=30, type='int'),
+            state=dict(default='active+clean'),
+        ),
+        supports_check_mode=True,
+    )
+    params = module.params
+    started = time.time()
+    ok, state, polls, samples = wait_pgs(
+        CephPgs(module, params['cluster']), params['state'],
+        params['timeout'], params['min_delay'], params['max_delay'])
+    result = dict(
+        changed=False,
+        pgs=state.total,
+        states=state.counts,
+        degraded_objects=state.degraded,
+        misplaced_objects=state.misplaced,
+        unfound_objects=state.unfound,
+        source=state.source,
+        polls=polls,
+        progress=samples,
+        elapsed=round(time.time() - started, 1),
+    )
+    if not ok:
+        module.fail_json(msg='%d of %d PGs are %s after %ds' % (
+            state.count(params['state']), state.total, params['state'],
+            params['timeout']), **result)
+    module.exit_json(**result)
+
+
+# import module snippets
+from ansible.module_utils.basic import *
+
+main()
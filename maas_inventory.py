@@ -1,20 +1,44 @@
 #!/usr/bin/env python
 
 import argparse
+import hashlib
 import json
 import os
 import re
 import subprocess
 import sys
-import uuid
+import time
 
-from math import ceil
-
-import oauth.oauth as oauth
-import requests
+from urlparse import urlparse
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+from maas_tools.cacheutils import (
+    atomic_write,
+    cache_dir,
+    file_lock,
+)
+from maas_tools.credentials import (
+    API_URL_ENV,
+    api_key_refresher,
+    get_api_key,
+)
+from maas_tools.maas_api import (
+    MaasApi,
+    normalize_node,
+)
+from maas_tools.journal_placement import (
+    JournalPolicy,
+    place_journals,
+)
+from maas_tools.maas_transport import get_transport
+from maas_tools.node_records import fetch_node_records
+from maas_tools import tracing
+from maas_tools.workers import (
+    parallel_call,
+    parallel_map,
+)
+
 MAAS_HOST = '10.40.0.2'
 MAAS_USER = 'root'
 MAAS_TOKEN = None
@@ -23,120 +47,175 @@ OSD_DATA_TAG = 'ansible_osd_data'
 OSD_JOURNAL_TAG = 'ansible_osd_journal'
 CLIENT_NET = 'client_net'
 CLUSTER_NET = 'cluster_net'
+# nodes tagged with ansible_foo are put into the `foo' group
+ROLE_TAG_RE = re.compile(r'ansible_')
+# If nodes of a group have different network layouts (fabrics, subnets,
+# interface names), the nodes having the same layout are put into a child
+# group `foo_layout_<hash>' with the network variables of that layout.
+# Layouts shared by fewer nodes are passed as host variables instead.
+LAYOUT_GROUP_MIN_HOSTS = 2
 
 # must match ceph-ansible variables
 OSD_DATA_DEVICES_KEY = 'devices'
 OSD_JOURNAL_DEVICES_KEY = 'raw_journal_devices'
+# expected write load of the journal drives, for reference
+OSD_JOURNAL_LOAD_KEY = 'osd_journal_load'
+
+# Serve the cached inventory for INVENTORY_CACHE_TTL seconds. A stale one
+# (but younger than INVENTORY_CACHE_MAX_STALE) is still served, however
+# a background refresh is started. Can be overriden via the environment
+# (ansible does not pass any options to the inventory scripts)
+INVENTORY_CACHE_TTL = 300
+INVENTORY_CACHE_MAX_STALE = 3600
+INVENTORY_CACHE_TTL_ENV = 'MAAS_INVENTORY_CACHE_TTL'
+INVENTORY_CACHE_MAX_STALE_ENV = 'MAAS_INVENTORY_CACHE_MAX_STALE'
+
+# Max number of concurrent MAAS requests
+INVENTORY_CONCURRENCY = 8
+INVENTORY_CONCURRENCY_ENV = 'MAAS_INVENTORY_CONCURRENCY'
+# Find out the members of the ansible_* tags by querying every tag
+# (instead of using the tag_names of the nodes)
+INVENTORY_PER_TAG_ENV = 'MAAS_INVENTORY_PER_TAG'
 
 
 class Inventory(object):
-    def __init__(self, maas_api_url, maas_token):
+    def __init__(self, maas_api_url, maas_token,
+                 concurrency=INVENTORY_CONCURRENCY,
+                 per_tag=False,
+                 refresh_token=None,
+                 journal_policy=None):
         self.maas_api = maas_api_url
+        self._api = MaasApi(maas_api_url)
         self.token = maas_token
+        self.refresh_token = refresh_token
         self.public_net = CLIENT_NET
         self.cluster_net = CLUSTER_NET
+        self.concurrency = concurrency
+        self.per_tag = per_tag
+        self.journal_policy = journal_policy or JournalPolicy()
 
-    def _auth(self):
-        consumer_key, key, secret = self.token.split(':')
-        resource_token = oauth.OAuthToken(key, secret)
-        consumer_token = oauth.OAuthConsumer(consumer_key, '')
-        oauth_request = oauth.OAuthRequest.from_consumer_and_token(
-            consumer_token,
-            token=resource_token,
-            http_url=self.maas_api,
-            parameters={
-                'auth_nonce': uuid.uuid4().get_hex(),
-            },
-        )
-        oauth_request.sign_request(oauth.OAuthSignatureMethod_PLAINTEXT(),
-                                   consumer_token,
-                                   resource_token)
-        headers = oauth_request.to_header()
-        return headers
+    @property
+    def _transport(self):
+        return get_transport(self.token, refresh_token=self.refresh_token)
 
     def _node_data(self, node):
         data = {
-            'mac_address': node['macaddress_set'][0]['mac_address'],
-            'system_id': node['system_id'],
-            'power_type': node['power_type'],
-            'os': node['osystem'],
-            'os_release': node['distro_series'],
+            'mac_address': node.macs[0],
+            'system_id': node.system_id,
+            'power_type': node.power_type,
+            'os': node.osystem,
+            'os_release': node.distro_series,
         }
         data.update(self._node_drives_by_tag(node))
-        return {node['hostname']: data}
+        return {node.hostname: data}
 
     def _node_drives_by_tag(self, node,
                             osd_tag=OSD_DATA_TAG,
                             journal_tag=OSD_JOURNAL_TAG):
-        all_drives = node['physicalblockdevice_set']
-        devices = [blk['id_path'] for blk in all_drives
-                   if osd_tag in blk['tags']]
-        journal_devices = [blk['id_path'] for blk in all_drives
-                           if journal_tag in blk['tags']]
-        osds_count = len(devices)
-        journals_count = len(journal_devices)
-        if (journals_count > 0) and (journals_count < osds_count):
-            osds_per_journal = int(ceil(float(osds_count) / journals_count))
-            # list each journal device N times so ceph-ansible will partition
-            # each journal drive for N OSDs
-            journal_devices *= osds_per_journal
-            # truncate the journals list so there's exactly 1 entry per an OSD
-            journal_devices = journal_devices[:osds_count]
-        elif (journals_count > 0) and (journals_count > osds_count):
-            # got more journals than OSDs? That's strange, but anyway:
-            # truncate the journals list so there's exactly 1 entry per an OSD
-            journal_devices = journal_devices[:osds_count]
-
-        if (osds_count == 0) and (journals_count == 0):
+        osds = [blk for blk in node.drives if osd_tag in blk.tags]
+        journals = [blk for blk in node.drives if journal_tag in blk.tags]
+        if not osds and not journals:
             return {}
-        else:
-            return {
-                OSD_DATA_DEVICES_KEY: devices,
-                OSD_JOURNAL_DEVICES_KEY: journal_devices,
-            }
+        # exactly 1 entry per an OSD: a journal device listed N times
+        # makes ceph-ansible partition the journal drive for N OSDs
+        journal_devices, load = place_journals(osds, journals,
+                                               self.journal_policy)
+        ret = {
+            OSD_DATA_DEVICES_KEY: [blk.id_path for blk in osds],
+            OSD_JOURNAL_DEVICES_KEY: journal_devices,
+        }
+        if load:
+            ret[OSD_JOURNAL_LOAD_KEY] = load
+        return ret
 
     def host(self):
         return {}
 
     def tags(self):
-        url = '%s/tags/?op=list' % self.maas_api.rstrip()
-        rq = requests.get(url, headers=self._auth())
+        url = self._api.tags_url()
+        rq = self._transport.get(url)
         rq.raise_for_status()
-        ret = json.loads(rq.text)
-        matcher = re.compile(r'ansible_')
+        ret = tracing.loads(rq.text, 'tags')
         return [tag['name'] for tag in
-                filter(lambda t: re.match(matcher, t['name']), ret)]
+                filter(lambda t: re.match(ROLE_TAG_RE, t['name']), ret)]
+
+    def tag_members(self, tag):
+        url = self._api.tag_url(tag, 'nodes')
+        rq = self._transport.get(url)
+        rq.raise_for_status()
+        return [node['hostname'] for node in
+                tracing.loads(rq.text, 'tag_nodes')]
+
+    def _index(self):
+        if not self.per_tag:
+            # A single nodes listing is enough: nodes carry their tags
+            # (tag_names), so there's no need to query every tag separately.
+            # The tags are still listed (concurrently) so that the roles
+            # without nodes get (empty) groups
+            tags, nodes = parallel_call(self.tags, self.node_records,
+                                        concurrency=self.concurrency)
+            return NodeIndex(nodes, tags=tags)
+        # The tags and the nodes listings are independent, and so are
+        # the queries of the individual tags
+        tags, nodes = parallel_call(self.tags, self.node_records,
+                                    concurrency=self.concurrency)
+        members = parallel_map(self.tag_members, tags,
+                               concurrency=self.concurrency)
+        return NodeIndex(nodes, tag_members=dict(zip(tags, members)))
 
-    def _nodes_by_role(self):
+    def _nodes_by_role(self, index):
+        """Returns the groups, and the host variables of the nodes having
+        an uncommon network layout"""
         ret = {}
-        for tag in self.tags():
-            url = '%s/tags/%s/?op=nodes' % (self.maas_api, tag)
+        host_vars = {}
+        layouts = {}
+
+        def layout(hostname):
+            if hostname not in layouts:
+                layouts[hostname] = self._layout(
+                    index.nodes_by_hostname[hostname])
+            return layouts[hostname]
+
+        for tag, hostnames in index.hosts_by_tag.items():
             # ansible_foo => foo
             group_name = tag.partition('_')[2]
-            rq = requests.get(url, headers=self._auth())
-            rq.raise_for_status()
-            nodes = json.loads(rq.text)
             group_vars = {
                 'ansible_user': 'ubuntu',
             }
-            group_vars.update(self._nodes_ifaces_by_role(nodes, group_name))
+            layout_vars, children, layout_host_vars = self._group_by_layout(
+                group_name, [(name, layout(name)) for name in hostnames])
+            group_vars.update(layout_vars)
             ret[group_name] = {
-                'hosts': [node['hostname'] for node in nodes],
+                'hosts': hostnames,
                 'vars': group_vars,
             }
-        return ret
+            if children:
+                ret[group_name]['children'] = sorted(children)
+                ret.update(children)
+            for hostname, hvars in layout_host_vars.items():
+                host_vars.setdefault(hostname, {}).update(hvars)
+        return ret, host_vars
 
     def inventory(self):
-        ansible = self._nodes_by_role()
+        with tracing.phase('fetch'):
+            index = self._index()
+        with tracing.phase('build'):
+            return self._inventory(index)
+
+    def _inventory(self, index):
+        ansible, layout_host_vars = self._nodes_by_role(index)
         hostvars = {
             '_meta': {
                 'hostvars': {}
             }
         }
-        for node in self.nodes():
-            if not node['tag_names']:
+        for node in index.nodes_by_hostname.values():
+            if not node.tag_names:
                 continue
             hostvars['_meta']['hostvars'].update(self._node_data(node))
+        for hostname, hvars in layout_host_vars.items():
+            hostvars['_meta']['hostvars'].setdefault(hostname, {}).update(
+                hvars)
 
         result = ansible.copy()
         result.update(hostvars)
@@ -144,55 +223,188 @@ class Inventory(object):
 
     def _get_interfaces_by_fabric(self, node):
         ret = {}
-        for iface in node['interface_set']:
-            for link in iface['links']:
-                fabric = link['subnet']['vlan']['fabric']
-                ret[fabric] = {
-                    'cidr': link['subnet']['cidr'],
-                    'name': iface['name'],
-                }
+        for iface, link in node.links:
+            ret[link.fabric] = {
+                'cidr': link.cidr,
+                'name': iface.name,
+            }
         return ret
 
-    def _nodes_ifaces_by_role(self, nodes, nodes_role):
-        if len(nodes) == 0:
-            return {}
-        ifaces_by_role = self._get_interfaces_by_fabric(nodes[0])
+    def _layout(self, node):
+        """Hashable fingerprint of the node's network layout"""
+        return tuple(sorted((fabric, iface['cidr'], iface['name']) for
+                            fabric, iface in
+                            self._get_interfaces_by_fabric(node).items()))
+
+    def _layout_vars(self, layout, nodes_role):
+        ifaces_by_role = dict((fabric, {'cidr': cidr, 'name': name})
+                              for fabric, cidr, name in layout)
         if not self.public_net in ifaces_by_role:
             return {}
-        if any(self._get_interfaces_by_fabric(node) != ifaces_by_role
-               for node in nodes):
-            return {}
         ret = {
             'public_network': ifaces_by_role[self.public_net]['cidr'],
         }
         if nodes_role == 'mons':
             ret['monitor_interface'] = ifaces_by_role[self.public_net]['name']
-        if nodes_role == 'osds':
+        if nodes_role == 'osds' and self.cluster_net in ifaces_by_role:
             ret['cluster_network'] = ifaces_by_role[self.cluster_net]['cidr']
         return ret
 
+    def _group_by_layout(self, nodes_role, host_layouts):
+        """Group the hosts ([(hostname, layout)]) by the network layout.
+        Returns the network variables of the group (if all hosts share
+        the layout), the child groups (by name), and the host variables
+        of the hosts with a rare layout"""
+        hosts_by_layout = {}
+        for hostname, layout in host_layouts:
+            hosts_by_layout.setdefault(layout, []).append(hostname)
+        if len(hosts_by_layout) <= 1:
+            return self._layout_vars(layout, nodes_role) if host_layouts \
+                else {}, {}, {}
+        children = {}
+        host_vars = {}
+        for layout, hostnames in hosts_by_layout.items():
+            layout_vars = self._layout_vars(layout, nodes_role)
+            if not layout_vars:
+                continue
+            if len(hostnames) >= LAYOUT_GROUP_MIN_HOSTS:
+                # repr() differs between python versions (u'' prefixes)
+                blob = json.dumps(layout, sort_keys=True).encode('utf-8')
+                digest = hashlib.sha1(blob).hexdigest()[:8]
+                children['%s_layout_%s' % (nodes_role, digest)] = {
+                    'hosts': hostnames,
+                    'vars': layout_vars,
+                }
+            else:
+                for hostname in hostnames:
+                    host_vars[hostname] = dict(layout_vars)
+        return {}, children, host_vars
+
     def nodes(self):
-        url = '%s/nodes/?op=list' % self.maas_api
-        rq = requests.get(url, headers=self._auth())
+        rq = self._transport.get(self._api.nodes_url())
         rq.raise_for_status()
-        _nodes = json.loads(rq.text)
-        return _nodes
+        _nodes = tracing.loads(rq.text, 'nodes')
+        return [normalize_node(node) for node in _nodes]
+
+    def node_records(self):
+        """The nodes as (compact) NodeRecords"""
+        return fetch_node_records(self._transport, self._api.nodes_url())
+
+
+class NodeIndex(object):
+    """Nodes indexed by hostname, and hostnames indexed by ansible_* tags
+
+    Tag members are taken from the nodes' tag_names unless tag_members
+    (tag => hostnames) are given. Either way hosts are listed in the order
+    of nodes, so the result does not depend on how the tags were queried.
+    Every one of `tags` (and of tag_members) is indexed, even if no node
+    has it.
+    """
+
+    def __init__(self, nodes, tag_members=None, tags=()):
+        self.nodes_by_hostname = {}
+        self.hosts_by_tag = dict((tag, []) for tag in tags
+                                 if re.match(ROLE_TAG_RE, tag))
+        if tag_members is not None:
+            for tag in tag_members:
+                if re.match(ROLE_TAG_RE, tag):
+                    self.hosts_by_tag.setdefault(tag, [])
+        if tag_members is not None:
+            tags_by_host = {}
+            for tag, hostnames in tag_members.items():
+                for hostname in hostnames:
+                    tags_by_host.setdefault(hostname, []).append(tag)
+        for node in nodes:
+            hostname = node.hostname
+            self.nodes_by_hostname[hostname] = node
+            if tag_members is None:
+                tags = node.tag_names
+            else:
+                tags = tags_by_host.get(hostname, [])
+            for tag in tags:
+                if re.match(ROLE_TAG_RE, tag):
+                    self.hosts_by_tag.setdefault(tag, []).append(hostname)
+
+
+class InventoryCache(object):
+    """The assembled inventory (groups and _meta.hostvars) stored on disk"""
+
+    def __init__(self, path, ttl=INVENTORY_CACHE_TTL,
+                 max_stale=INVENTORY_CACHE_MAX_STALE,
+                 refresh_args=()):
+        self.path = path
+        self.ttl = ttl
+        self.max_stale = max(max_stale, ttl)
+        # passed to the background refresh process
+        self.refresh_args = list(refresh_args)
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def load(self):
+        """Returns the cached inventory and its age in seconds"""
+        if not self.enabled:
+            return None, None
+        try:
+            with open(self.path, 'r') as f:
+                age = time.time() - os.fstat(f.fileno()).st_mtime
+                return json.load(f), age
+        except (IOError, OSError, ValueError):
+            return None, None
+
+    def store(self, data):
+        if self.enabled:
+            atomic_write(self.path, json.dumps(data))
+
+    def refresh_lock(self, blocking=True):
+        return file_lock(self.path + '.lock', blocking=blocking)
+
+    def get(self, build, refresh=False):
+        if not refresh:
+            data, age = self.load()
+            if data is not None and age < self.ttl:
+                return data
+            if data is not None and age < self.max_stale:
+                spawn_background_refresh(self.refresh_args)
+                return data
+        with self.refresh_lock():
+            if not refresh:
+                # somebody else might have refreshed the cache while
+                # we were waiting for the lock
+                data, age = self.load()
+                if data is not None and age < self.ttl:
+                    return data
+            data = build()
+            self.store(data)
+        return data
+
+    def background_refresh(self, build):
+        with self.refresh_lock(blocking=False) as locked:
+            if not locked:
+                # another refresh is already in progress
+                return
+            self.store(build())
+
+
+def spawn_background_refresh(args=()):
+    cmd = [sys.executable, os.path.abspath(__file__), '--background-refresh']
+    cmd.extend(args)
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
 
 
 def get_maas_token(maas_host=MAAS_HOST, maas_user=MAAS_USER):
-    cmd = [
-        'ssh', 'ubuntu@%s' % maas_host,
-        'sudo', 'maas-region-admin', 'apikey',
-        '--username=%s' % maas_user,
-    ]
-    token = subprocess.check_output(cmd).strip()
-    return token
+    return get_api_key(maas_host, user=maas_user)
 
 
 def main(maas_host=MAAS_HOST, maas_token=None):
-    maas_api_url = 'http://%s:5240/MAAS/api/1.0' % maas_host
-    if maas_token is None:
-        maas_token = get_maas_token(maas_host=maas_host)
+    maas_api_url = os.environ.get(API_URL_ENV)
+    if maas_api_url:
+        maas_host = urlparse(maas_api_url).hostname
+    else:
+        maas_api_url = 'http://%s:5240/MAAS/api/1.0' % maas_host
 
     parser = argparse.ArgumentParser(
         description='Produce an ansible inventory from MAAS')
@@ -204,18 +416,74 @@ def main(maas_host=MAAS_HOST, maas_token=None):
                         help='list all nodes known to MAAS')
     parser.add_argument('--ssh-keys', action='store_true',
                         help="update ~/.ssh/known_hosts with nodes' host keys")
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help='query MAAS even if the cached inventory is fresh')
+    parser.add_argument('--cache-ttl', type=int,
+                        default=int(os.environ.get(INVENTORY_CACHE_TTL_ENV,
+                                                   INVENTORY_CACHE_TTL)),
+                        help='use the cached inventory for that many seconds '
+                        '(0 disables caching)')
+    parser.add_argument('--cache-max-stale', type=int,
+                        default=int(os.environ.get(
+                            INVENTORY_CACHE_MAX_STALE_ENV,
+                            INVENTORY_CACHE_MAX_STALE)),
+                        help='serve a stale inventory (and refresh it in '
+                        'background) unless it is older than that, seconds')
+    parser.add_argument('--concurrency', type=int,
+                        default=int(os.environ.get(INVENTORY_CONCURRENCY_ENV,
+                                                   INVENTORY_CONCURRENCY)),
+                        help='max number of concurrent MAAS requests')
+    parser.add_argument('--per-tag', action='store_true',
+                        default=bool(os.environ.get(INVENTORY_PER_TAG_ENV)),
+                        help='query the members of every ansible_* tag '
+                        'instead of relying on the tags of nodes')
+    parser.add_argument('--background-refresh', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write timings of MAAS requests etc to the file '
+                        '(also ${0})'.format(tracing.TRACE_ENV))
     args = parser.parse_args()
+    tracing.enable(args.trace)
+
+    def make_inventory():
+        token, refresh_token = maas_token, None
+        if token is None:
+            with tracing.phase('token'):
+                token = get_maas_token(maas_host=maas_host)
+            refresh_token = api_key_refresher(maas_host, MAAS_USER)
+        return Inventory(maas_api_url, token,
+                         concurrency=args.concurrency,
+                         per_tag=args.per_tag,
+                         refresh_token=refresh_token,
+                         journal_policy=JournalPolicy.load())
+
+    def build_inventory():
+        return make_inventory().inventory()
+
+    cache = InventoryCache(
+        os.path.join(cache_dir(), 'maas_inventory-%s.json' % maas_host),
+        ttl=args.cache_ttl,
+        max_stale=args.cache_max_stale,
+        refresh_args=['--concurrency', str(args.concurrency)] +
+        (['--per-tag'] if args.per_tag else []))
 
-    inventory = Inventory(maas_api_url, maas_token)
+    if args.background_refresh:
+        cache.background_refresh(build_inventory)
+        return
     if args.list:
-        data = inventory.inventory()
+        data = cache.get(build_inventory, refresh=args.refresh_cache)
+    elif args.refresh_cache:
+        cache.get(build_inventory, refresh=True)
+        return
     elif args.nodes:
-        data = inventory.nodes()
+        data = make_inventory().nodes()
     elif args.host:
-        data = inventory.host()
+        # no need to ask MAAS for a token, _meta has all host variables
+        data = Inventory(maas_api_url, maas_token).host()
     elif args.ssh_keys:
         from maas_tools.fetch_ssh_keys import update_ssh_keys
-        data = update_ssh_keys(maas_host=maas_host, maas_user=MAAS_USER)
+        data = update_ssh_keys(None, maas_host=maas_host, maas_user=MAAS_USER,
+                               concurrency=args.concurrency)
     else:
         sys.exit(1)
     print(json.dumps(data, sort_keys=True, indent=2))
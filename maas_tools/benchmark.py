@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Measure how the inventory script and maas_tools scale with the fleet size.
+# Every scenario runs the tool (as a separate process) against a fresh
+# fake_maas server and records the wall time, peak RSS of the tool, and
+# the requests/traffic seen by the server. Results can be saved as
+# a baseline and compared with it later:
+#
+#   python maas_tools/benchmark.py -s 10,100,1000 --save baseline.json
+#   python maas_tools/benchmark.py -s 10,100,1000 --compare baseline.json
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from credentials import API_KEY_ENV, API_URL_ENV
+from cacheutils import CACHE_DIR_ENV
+from fake_maas import (
+    API_VERSIONS,
+    DRIVES,
+    FABRICS,
+    INTERFACES,
+    FakeMaasServer,
+    Fleet,
+    FleetSpec,
+)
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+
+SIZES = (10, 100, 1000)
+# a metric regresses if it exceeds the baseline by more than that fraction
+TOLERANCE = 0.2
+METRICS = ('wall_time', 'max_rss_kb', 'requests', 'bytes_sent',
+           'bytes_received')
+FAKE_API_KEY = 'bench:bench:bench'
+
+
+class Scenario(object):
+    def __init__(self, name, argv, state='Ready', tagged=True,
+                 transition_time=0):
+        self.name = name
+        self.argv = argv
+        self.state = state
+        self.tagged = tagged
+        self.transition_time = transition_time
+
+
+SCENARIOS = [
+    Scenario('inventory', [os.path.join(REPO_DIR, 'maas_inventory.py'),
+                           '--list', '--refresh-cache']),
+    Scenario('inventory-per-tag',
+             [os.path.join(REPO_DIR, 'maas_inventory.py'),
+              '--list', '--refresh-cache', '--per-tag']),
+    Scenario('classify-dry-run',
+             [os.path.join(TOOLS_DIR, 'classify_nodes.py'), '-n'],
+             tagged=False),
+    Scenario('classify', [os.path.join(TOOLS_DIR, 'classify_nodes.py')],
+             tagged=False),
+    Scenario('ifaces-mode', [os.path.join(TOOLS_DIR, 'ifaces_mode.py')]),
+    Scenario('commission',
+             [os.path.join(TOOLS_DIR, 'serial_deploy.py'), '-C', '-p', '64'],
+             state='New', transition_time=1),
+]
+
+
+def run_scenario(scenario, size, python=sys.executable, drives=DRIVES,
+                 interfaces=INTERFACES, fabrics=FABRICS, latency=0,
+                 error_rate=0, api_version=API_VERSIONS[0]):
+    spec = FleetSpec(nodes=size, drives=drives, interfaces=interfaces,
+                     fabrics=fabrics, state=scenario.state,
+                     tagged=scenario.tagged, api_version=api_version)
+    fleet = Fleet(spec, transition_time=scenario.transition_time)
+    server = FakeMaasServer(('127.0.0.1', 0), fleet, latency=latency,
+                            error_rate=error_rate)
+    server.start()
+    workdir = tempfile.mkdtemp(prefix='maas-bench-')
+    env = dict(os.environ)
+    env.update({
+        API_URL_ENV: server.api_url,
+        API_KEY_ENV: FAKE_API_KEY,
+        CACHE_DIR_ENV: workdir,
+        'HOME': workdir,
+    })
+    try:
+        with open(os.path.join(workdir, 'output'), 'w') as out:
+            started = time.time()
+            proc = subprocess.Popen([python] + scenario.argv, env=env,
+                                    stdout=out, stderr=subprocess.STDOUT,
+                                    cwd=workdir)
+            _, status, rusage = os.wait4(proc.pid, 0)
+            proc.returncode = status
+            wall_time = time.time() - started
+        stats = server.stats.to_dict()
+        result = {
+            'wall_time': round(wall_time, 3),
+            'max_rss_kb': rusage.ru_maxrss,
+            'exit_status': os.WEXITSTATUS(status) if os.WIFEXITED(status)
+            else -os.WTERMSIG(status),
+            'requests': stats['requests'],
+            'errors': stats['errors'],
+            'connections': stats['connections'],
+            'bytes_sent': stats['bytes_sent'],
+            'bytes_received': stats['bytes_received'],
+        }
+        if result['exit_status'] != 0:
+            with open(os.path.join(workdir, 'output')) as out:
+                result['output_tail'] = out.read()[-2000:]
+        return result
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run(scenarios, sizes, repeat=1, **kwargs):
+    """Returns {scenario: {size: result}}, wall time and RSS being
+    the median of `repeat` runs"""
+    results = {}
+    for scenario in scenarios:
+        for size in sizes:
+            runs = [run_scenario(scenario, size, **kwargs)
+                    for _ in range(repeat)]
+            result = dict(runs[-1])
+            result['wall_time'] = _median(r['wall_time'] for r in runs)
+            result['max_rss_kb'] = _median(r['max_rss_kb'] for r in runs)
+            results.setdefault(scenario.name, {})[str(size)] = result
+            print_result(scenario.name, size, result)
+    return results
+
+
+def print_result(name, size, result):
+    print('{name:<18} {size:>6} nodes: {wall_time:8.2f}s '
+          '{max_rss_kb:>8}KB RSS {requests:>6} requests '
+          '{bytes_sent:>11} bytes out {bytes_received:>9} bytes in'
+          '{failed}'.format(name=name, size=size,
+                            failed=' FAILED (%d)' % result['exit_status']
+                            if result['exit_status'] else '',
+                            **result))
+    sys.stdout.flush()
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Returns the list of regressions as (scenario, size, metric,
+    baseline value, value)"""
+    regressions = []
+    for name, by_size in sorted(results.items()):
+        for size, result in sorted(by_size.items()):
+            base = baseline.get(name, {}).get(size)
+            if base is None:
+                continue
+            for metric in METRICS:
+                if base.get(metric) is None:
+                    continue
+                if result[metric] > base[metric] * (1 + tolerance):
+                    regressions.append((name, size, metric, base[metric],
+                                        result[metric]))
+    return regressions
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-s', '--sizes', dest='sizes',
+                      default=','.join(str(s) for s in SIZES),
+                      help='comma separated fleet sizes [%default]')
+    parser.add_option('-S', '--scenarios', dest='scenarios',
+                      default=','.join(s.name for s in SCENARIOS),
+                      help='comma separated scenarios [%default]')
+    parser.add_option('-r', '--repeat', dest='repeat', type=int, default=1)
+    parser.add_option('-d', '--drives', dest='drives', type=int,
+                      default=DRIVES)
+    parser.add_option('-i', '--interfaces', dest='interfaces', type=int,
+                      default=INTERFACES)
+    parser.add_option('-f', '--fabrics', dest='fabrics', type=int,
+                      default=FABRICS)
+    parser.add_option('-l', '--latency', dest='latency', type=float,
+                      default=0, help='mean MAAS response latency, seconds')
+    parser.add_option('-e', '--error-rate', dest='error_rate', type=float,
+                      default=0, help='fraction of requests failing with 503')
+    parser.add_option('-a', '--api-version', dest='api_version',
+                      choices=API_VERSIONS, default=API_VERSIONS[0],
+                      help='MAAS API version to serve [%default]')
+    parser.add_option('--python', dest='python', default=sys.executable,
+                      help='interpreter to run the tools with [%default]')
+    parser.add_option('--save', dest='save',
+                      help='save the results (as a baseline) to the file')
+    parser.add_option('--compare', dest='compare',
+                      help='compare the results with the baseline')
+    parser.add_option('-t', '--tolerance', dest='tolerance', type=float,
+                      default=TOLERANCE,
+                      help='allowed regression, fraction [%default]')
+    options, args = parser.parse_args()
+    by_name = dict((s.name, s) for s in SCENARIOS)
+    unknown = [n for n in options.scenarios.split(',') if n not in by_name]
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(unknown))
+    results = run([by_name[n] for n in options.scenarios.split(',')],
+                  [int(s) for s in options.sizes.split(',')],
+                  repeat=options.repeat, python=options.python,
+                  drives=options.drives, interfaces=options.interfaces,
+                  fabrics=options.fabrics, latency=options.latency,
+                  error_rate=options.error_rate,
+                  api_version=options.api_version)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, sort_keys=True, indent=2)
+    failed = any(r['exit_status'] for by_size in results.values()
+                 for r in by_size.values())
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, tolerance=options.tolerance)
+        for name, size, metric, base, value in regressions:
+            print('REGRESSION %s (%s nodes): %s %s -> %s' % (
+                name, size, metric, base, value))
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
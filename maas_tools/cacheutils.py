@@ -0,0 +1,88 @@
+
+# encoding: utf-8
+# Helpers for the on-disk caches kept by the inventory script and maas_tools
+
+import errno
+import fcntl
+import os
+import tempfile
+
+from contextlib import contextmanager
+
+CACHE_DIR_ENV = 'MAAS_TOOLS_CACHE_DIR'
+CACHE_SUBDIR = 'demo-ceph-ansible'
+
+
+def cache_dir(create=True):
+    """Directory holding the caches, ~/.cache/demo-ceph-ansible by default"""
+    path = os.environ.get(CACHE_DIR_ENV)
+    if not path:
+        xdg_cache = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.expanduser('~/.cache')
+        path = os.path.join(xdg_cache, CACHE_SUBDIR)
+    if create:
+        try:
+            os.makedirs(path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return path
+
+
+def atomic_write(path, data, mode=0o600):
+    """Replace the file with the given data so readers never see a partial
+    file: write a temporary file in the same directory and rename it"""
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname,
+                                    prefix='.%s.' % os.path.basename(path))
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """Hold an exclusive flock on path (created if necessary, and removed
+    once the lock is released, so no lock files are left behind).
+    Yields False instead of waiting if blocking is False and the lock
+    is taken by somebody else"""
+    flags = fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, flags)
+        except IOError as e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        # the previous holder might have removed the file while we were
+        # waiting, the lock is only valid if it's still there
+        try:
+            st, locked = os.stat(path), os.fstat(fd)
+            if (st.st_dev, st.st_ino) == (locked.st_dev, locked.st_ino):
+                break
+        except OSError:
+            pass
+        os.close(fd)
+    try:
+        yield True
+    finally:
+        # removed while still locked, closing the file releases the lock
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        os.close(fd)
@@ -1,11 +1,31 @@
 #!/usr/bin/env python
 # encoding: utf-8
-# tag nodes having >= 1 unused drive(s) as OSD
-# tag unused drives bigger than a given size as OSD data
-# tag unused drives less then a given size as OSD journal
+# tag nodes having >= 1 unused data drive(s) as OSD
+# tag unused drives according to their media (as recorded by MAAS):
+#  - NVMe and SSD drives as OSD journal (as OSD data on all-flash nodes,
+#    i.e. the nodes having NVMe and SSD drives only)
+#  - rotating drives bigger than a given size as OSD data
+#  - drives of unknown media bigger than a given size as OSD data,
+#    smaller ones as OSD journal
+# The policy can be adjusted in the [classify] section of the config file
+# (MAAS_INVENTORY_CONFIG or --policy):
+#
+#   [classify]
+#   journal_media = nvme, ssd
+#   data_media = rotary
+#   # minimal size of OSD data drive, GB
+#   min_data_size = 500
+#   # models (as reported by MAAS) to use as journal/data regardless
+#   # of the media
+#   journal_models = INTEL SSDSC2BP240G4
+#   data_models =
+#
+# Nodes which don't have enough journal drives for the fan-out set by
+# max_osds_per_journal in the [journals] section (6 unless set, 0 turns
+# the check off) are reported.
+# Only the missing (or wrong) tags are changed, see --dry-run
 
 import os
-import requests
 import sys
 
 from collections import defaultdict
@@ -13,21 +33,128 @@ from optparse import OptionParser
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+from journal_placement import (
+    JOURNALS_SECTION,
+    NVME,
+    ROTARY,
+    SSD,
+    JournalPolicy,
+    drive_media,
+    read_config,
+)
 from maas_base_client import MaasBaseClient
+import tracing
+from workers import (
+    CONCURRENCY,
+    parallel_map,
+)
 
 CLIENT_TAG = 'ansible_clients'
 OSD_TAG = 'ansible_osds'
 OSD_DATA_TAG = 'ansible_osd_data'
 OSD_JOURNAL_TAG = 'ansible_osd_journal'
 
+CLASSIFY_SECTION = 'classify'
+FLASH_MEDIA = (NVME, SSD)
+# journal fan-out to check the nodes against, 0 means don't check
+MAX_OSDS_PER_JOURNAL = 6
+# drive classes
+DATA = 'data'
+JOURNAL = 'journal'
+UNUSED = 'unused'
+
+
+def _split(value):
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+class ClassifyPolicy(object):
+    def __init__(self, journal_media=(NVME, SSD), data_media=(ROTARY,),
+                 min_data_size=0, journal_models=(), data_models=(),
+                 max_osds_per_journal=MAX_OSDS_PER_JOURNAL):
+        self.journal_media = journal_media
+        self.data_media = data_media
+        self.min_data_size = min_data_size  # GB
+        self.journal_models = journal_models
+        self.data_models = data_models
+        self.max_osds_per_journal = max_osds_per_journal
+
+    @classmethod
+    def load(cls, path=None, **kwargs):
+        """Read the policy from the file (MAAS_INVENTORY_CONFIG if path
+        is not given), kwargs are the defaults"""
+        config = read_config(path)
+        if config is None:
+            return cls(**kwargs)
+        if config.has_option(JOURNALS_SECTION, 'max_osds_per_journal'):
+            kwargs['max_osds_per_journal'] = \
+                JournalPolicy.load(path).max_osds_per_journal
+        if config.has_section(CLASSIFY_SECTION):
+            for name, value in config.items(CLASSIFY_SECTION):
+                if name == 'min_data_size':
+                    kwargs[name] = int(value)
+                elif name in ('journal_media', 'data_media',
+                              'journal_models', 'data_models'):
+                    kwargs[name] = _split(value)
+                else:
+                    raise ValueError('%s: unknown option %s in [%s]' % (
+                        path, name, CLASSIFY_SECTION))
+        return cls(**kwargs)
+
+    def drive_class(self, drive):
+        model = drive.get('model')
+        if model in self.journal_models:
+            return JOURNAL
+        if model in self.data_models:
+            return DATA
+        big_enough = drive['size'] >= self.min_data_size * 1024 ** 3
+        media = drive_media(drive.get('name'), drive.get('id_path'),
+                            drive.get('tags', ()), default=None)
+        if media is None:
+            return DATA if big_enough else JOURNAL
+        if media in self.journal_media:
+            return JOURNAL
+        if media in self.data_media and big_enough:
+            return DATA
+        return UNUSED
+
+    def classify(self, drives):
+        """[(drive, class, media)] of the node's drives"""
+        classes = [(drive, self.drive_class(drive),
+                    drive_media(drive.get('name'), drive.get('id_path'),
+                                drive.get('tags', ()), default='?'))
+                   for drive in drives]
+        if classes and all(media in FLASH_MEDIA
+                           for drive, cls, media in classes):
+            # all-flash node, journals are collocated with the data
+            classes = [(drive, DATA if cls == JOURNAL else cls, media)
+                       for drive, cls, media in classes]
+        return classes
+
+    def fanout_problem(self, classes):
+        """Why the node can't meet the journal fan-out, None if it can"""
+        if self.max_osds_per_journal <= 0:
+            return None
+        data = sum(1 for drive, cls, media in classes if cls == DATA)
+        journals = sum(1 for drive, cls, media in classes if cls == JOURNAL)
+        if journals == 0 and not any(cls == DATA and media == ROTARY
+                                     for drive, cls, media in classes):
+            # no data drives, or an all-flash node
+            return None
+        if data <= journals * self.max_osds_per_journal:
+            return None
+        return '%d data drives need %d journal drives (max %d OSDs per ' \
+            'journal), got %d' % (
+                data, -(-data // self.max_osds_per_journal),
+                self.max_osds_per_journal, journals)
+
 
 class MaasClient(MaasBaseClient):
 
     def tag_nodes(self, system_ids, tag, remove=False):
-        url = '%s/tags/%s/?op=update_nodes' % (self._api_url, tag)
+        url = self._api.tag_url(tag, 'update_nodes')
         op = 'remove' if remove else 'add'
-        rq = requests.post(url, data={op: system_ids},
-                           headers=self._auth())
+        rq = self._transport.post(url, data={op: system_ids})
         rq.raise_for_status()
 
     def tag_drive(self, drive_uri, tag, remove=False):
@@ -36,69 +163,256 @@ class MaasClient(MaasBaseClient):
             'tag': tag,
             'op': 'remove_tag' if remove else 'add_tag',
         }
-        rq = requests.get(drive_url, params=params, headers=self._auth())
+        rq = self._transport.request(self._api.drive_tag_method, drive_url,
+                                     params=params)
         try:
             rq.raise_for_status()
         except:
             print("failed to tag: %s" % drive_uri)
             raise
 
+    def plan_tags(self, nodes,
+                  osd_tag=OSD_TAG,
+                  client_tag=CLIENT_TAG,
+                  storage_tag=OSD_DATA_TAG,
+                  journal_tag=OSD_JOURNAL_TAG,
+                  policy=None,
+                  remove=False):
+        """Compare the desired tags of nodes and their unused drives with
+        the actual ones, return the changes to make (TagPlan)"""
+        plan = TagPlan()
+        policy = policy or ClassifyPolicy()
+        drive_tags = {DATA: storage_tag, JOURNAL: journal_tag, UNUSED: None}
+        for node in nodes:
+            drives = [blk for blk in node['physicalblockdevice_set']
+                      if blk['used_for'] == 'Unused']
+            classes = policy.classify(drives)
+            plan.report_node(node, classes, policy.fanout_problem(classes))
+            has_data = any(cls == DATA for drive, cls, media in classes)
+            node_tag = osd_tag if has_data else client_tag
+            plan.diff_node(node, node_tag, [osd_tag, client_tag],
+                           remove=remove)
+            for drive, cls, media in classes:
+                plan.diff_drive(node, drive, drive_tags[cls],
+                                [storage_tag, journal_tag], remove=remove)
+        return plan
+
+    def apply_tags(self, plan, concurrency=CONCURRENCY):
+        """Make the planned changes, returns the list of failed changes"""
+        def apply_changes(changes):
+            # MAAS updates the tags of a block device by read-modify-write,
+            # so the changes of a drive are made one after another, and the
+            # rest of them are skipped once one fails
+            for i, change in enumerate(changes):
+                try:
+                    if change.drive_uri is None:
+                        self.tag_nodes(change.targets, change.tag,
+                                       remove=change.remove)
+                    else:
+                        self.tag_drive(change.drive_uri, change.tag,
+                                       remove=change.remove)
+                except Exception as e:
+                    print("%s: %s" % (change, e))
+                    return changes[i:]
+            return []
+
+        failed = parallel_map(apply_changes, plan.change_groups(),
+                              concurrency=concurrency)
+        return [change for changes in failed for change in changes]
+
     def classify_nodes(self, nodes=None,
                        osd_tag=OSD_TAG,
                        client_tag=CLIENT_TAG,
                        storage_tag=OSD_DATA_TAG,
                        journal_tag=OSD_JOURNAL_TAG,
-                       data_size_threshold=0,
-                       remove=False):
-        if not nodes:
-            nodes = self.nodes()
-        nodes_to_tag = defaultdict(list)
-        drives_to_tag = defaultdict(list)
-        data_size_threshold = data_size_threshold * 1024 * 1024 * 1024
-        for node in nodes:
-            drives = filter(lambda blk: blk['used_for'] == 'Unused',
-                            node['physicalblockdevice_set'])
-            if len(drives) == 0:
-                nodes_to_tag[client_tag].append(node['system_id'])
-            else:
-                nodes_to_tag[osd_tag].append(node['system_id'])
-                drives_to_tag[storage_tag].extend(
-                    disk['resource_uri'] for disk in drives
-                    if disk['size'] >= data_size_threshold)
-                drives_to_tag[journal_tag].extend(
-                    disk['resource_uri'] for disk in drives
-                    if disk['size'] < data_size_threshold)
-        for tag, node_ids in dict(nodes_to_tag).iteritems():
-            self.tag_nodes(node_ids, tag, remove=remove)
-        for tag, drives in drives_to_tag.iteritems():
-            map(lambda drive_uri: self.tag_drive(drive_uri, tag, remove),
-                drives)
+                       policy=None,
+                       remove=False,
+                       dry_run=False,
+                       concurrency=CONCURRENCY,
+                       filters=None):
+        if nodes is None:
+            with tracing.phase('nodes'):
+                nodes = self.nodes(**(filters or {}))
+        with tracing.phase('plan'):
+            plan = self.plan_tags(nodes,
+                                  osd_tag=osd_tag,
+                                  client_tag=client_tag,
+                                  storage_tag=storage_tag,
+                                  journal_tag=journal_tag,
+                                  policy=policy,
+                                  remove=remove)
+        if not remove:
+            for line in plan.report():
+                print(line)
+        if dry_run:
+            for change in plan.changes():
+                print(change)
+        print(plan.summary())
+        if dry_run:
+            return []
+        with tracing.phase('apply'):
+            return self.apply_tags(plan, concurrency=concurrency)
+
+
+class TagChange(object):
+    def __init__(self, tag, remove, targets, drive_uri=None, label=None):
+        self.tag = tag
+        self.remove = remove
+        self.targets = targets  # system_ids of the nodes
+        self.drive_uri = drive_uri
+        self.label = label
+
+    def __str__(self):
+        what = self.label or ' '.join(self.targets)
+        return '%s: %s%s' % (what, '-' if self.remove else '+', self.tag)
+
+
+class TagPlan(object):
+    """Tags to add to (or remove from) nodes and drives. Tags of nodes are
+    changed in bulk (one request per a tag), drives one by one"""
+
+    def __init__(self):
+        self.node_changes = defaultdict(list)  # (tag, remove) => nodes
+        self.drive_changes = []
+        self.nodes_unchanged = 0
+        self.drives_unchanged = 0
+        self.node_reports = []  # (hostname, [(drive, class, media)], problem)
+
+    @staticmethod
+    def _diff(current, wanted, managed, remove):
+        """Returns [(tag, remove)] to get from the current tags to
+        the wanted one (or to clear all managed tags if remove is True)"""
+        current = set(current)
+        if remove:
+            return [(tag, True) for tag in managed if tag in current]
+        changes = [(tag, True) for tag in managed
+                   if tag != wanted and tag in current]
+        if wanted is not None and wanted not in current:
+            changes.append((wanted, False))
+        return changes
+
+    def diff_node(self, node, wanted, managed, remove=False):
+        changes = self._diff(node['tag_names'], wanted, managed, remove)
+        for tag_remove in changes:
+            self.node_changes[tag_remove].append(node)
+        if not changes:
+            self.nodes_unchanged += 1
+
+    def diff_drive(self, node, drive, wanted, managed, remove=False):
+        changes = self._diff(drive['tags'], wanted, managed, remove)
+        label = '%s:%s' % (node['hostname'], drive.get('id_path') or
+                           drive['name'])
+        for tag, remove_tag in changes:
+            self.drive_changes.append(TagChange(
+                tag, remove_tag, [node['system_id']],
+                drive_uri=drive['resource_uri'], label=label))
+        if not changes:
+            self.drives_unchanged += 1
+
+    def report_node(self, node, classes, problem=None):
+        self.node_reports.append((node['hostname'], classes, problem))
+
+    def report(self):
+        """Lines of the per-node classification report, the nodes which
+        can't meet the journal fan-out are listed at the end"""
+        lines = []
+        problems = []
+        for hostname, classes, problem in sorted(self.node_reports):
+            by_class = defaultdict(list)
+            for drive, cls, media in classes:
+                by_class[cls].append('%s(%s,%dG)' % (
+                    drive['name'], media, drive['size'] // 1024 ** 3))
+            lines.append('%s: %s' % (hostname, '; '.join(
+                '%s %s' % (cls, ' '.join(by_class[cls]))
+                for cls in (DATA, JOURNAL, UNUSED) if by_class[cls]) or
+                'no unused drives'))
+            if problem:
+                problems.append('WARNING: %s: %s' % (hostname, problem))
+        return lines + problems
+
+    def change_groups(self):
+        """Lists of changes which can be made concurrently with each other,
+        the changes of a list must be made in order: every node tag change
+        is a group of its own, the changes of a drive (removals first) make
+        a single group"""
+        groups = []
+        for (tag, remove), nodes in sorted(self.node_changes.items()):
+            nodes = sorted(nodes, key=lambda node: node['hostname'])
+            groups.append([TagChange(
+                tag, remove, [node['system_id'] for node in nodes],
+                label=' '.join(node['hostname'] for node in nodes))])
+        by_drive = {}
+        for change in sorted(self.drive_changes,
+                             key=lambda change: not change.remove):
+            if change.drive_uri not in by_drive:
+                by_drive[change.drive_uri] = []
+                groups.append(by_drive[change.drive_uri])
+            by_drive[change.drive_uri].append(change)
+        return groups
+
+    def changes(self):
+        return [change for changes in self.change_groups()
+                for change in changes]
+
+    def summary(self):
+        node_tags = sum(len(ids) for ids in self.node_changes.values())
+        return ('{0} node tag changes ({1} requests), {2} nodes unchanged; '
+                '{3} drive tag changes, {4} drives unchanged'.format(
+                    node_tags, len(self.node_changes), self.nodes_unchanged,
+                    len(self.drive_changes), self.drives_unchanged))
 
 
 def main():
     parser = OptionParser()
     parser.add_option('-m', '--maas-host', dest='maas_host')
     parser.add_option('-u', '--maas-user', dest='maas_user')
-    parser.add_option('-t', '--osd-tag', dest='osd_tag')
-    parser.add_option('-s', '--storage-tag', dest='storage_tag')
-    parser.add_option('-j', '--journal-tag', dest='journal_tag')
-    parser.add_option('-c', '--client-tag', dest='client_tag')
+    parser.add_option('-t', '--osd-tag', dest='osd_tag', default=OSD_TAG)
+    parser.add_option('-s', '--storage-tag', dest='storage_tag',
+                      default=OSD_DATA_TAG)
+    parser.add_option('-j', '--journal-tag', dest='journal_tag',
+                      default=OSD_JOURNAL_TAG)
+    parser.add_option('-c', '--client-tag', dest='client_tag',
+                      default=CLIENT_TAG)
     parser.add_option('-T', '--data-size-threshold',
                       help='minimal size of OSD data drive, GB',
-                      dest='data_size_threshold', type=int, default=0)
+                      dest='data_size_threshold', type=int, default=None)
+    parser.add_option('-p', '--policy', dest='policy',
+                      help='config file with the [classify] policy '
+                      '(default: $MAAS_INVENTORY_CONFIG)')
     parser.add_option('-U', '--untag', dest='clear_tags',
                       help="clear nodes' and drives' tags",
                       action='store_true', default=False)
+    parser.add_option('-n', '--dry-run', dest='dry_run',
+                      help='print the changes instead of making them',
+                      action='store_true', default=False)
+    parser.add_option('-P', '--concurrency', dest='concurrency', type=int,
+                      help='max number of concurrent MAAS requests',
+                      default=CONCURRENCY)
+    parser.add_option('-H', '--hostname', dest='hostnames', action='append',
+                      help='only this node, can be repeated')
+    parser.add_option('-z', '--zone', dest='zone',
+                      help='only the nodes in this zone')
+    parser.add_option('--trace', dest='trace',
+                      help='write timings of requests etc to the file')
     options, args = parser.parse_args()
+    tracing.enable(options.trace)
+    policy = ClassifyPolicy.load(options.policy)
+    if options.data_size_threshold is not None:
+        policy.min_data_size = options.data_size_threshold
     maas_client = MaasClient(host=options.maas_host, user=options.maas_user)
-    maas_client.classify_nodes(
+    failed = maas_client.classify_nodes(
         osd_tag=options.osd_tag,
         storage_tag=options.storage_tag,
         client_tag=options.client_tag,
         journal_tag=options.journal_tag,
-        data_size_threshold=options.data_size_threshold,
+        policy=policy,
+        filters={'hostname': options.hostnames, 'zone': options.zone},
         remove=options.clear_tags,
+        dry_run=options.dry_run,
+        concurrency=options.concurrency,
     )
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+
+# encoding: utf-8
+# Cache of MAAS API keys. Obtaining a key takes an ssh connection to
+# the MAAS server and running (slow to start) maas-region-admin, so keep
+# the keys in ~/.cache/demo-ceph-ansible/maas-credentials.json (mode 0600)
+
+import json
+import os
+
+import tracing
+
+from cacheutils import (
+    atomic_write,
+    cache_dir,
+    file_lock,
+)
+
+MAAS_USER = 'root'
+SHELL_USER = 'ubuntu'
+CREDENTIALS_FILE = 'maas-credentials.json'
+# use this API key instead of asking MAAS (and don't cache it)
+API_KEY_ENV = 'MAAS_API_KEY'
+# talk to this MAAS API endpoint instead of the default one
+API_URL_ENV = 'MAAS_API_URL'
+
+
+def fetch_api_key(host, user=MAAS_USER, shell_user=SHELL_USER):
+    cmd = [
+        'ssh', '%s@%s' % (shell_user, host),
+        'sudo', 'maas-region-admin', 'apikey',
+        '--username=%s' % user,
+    ]
+    return tracing.check_output(cmd).strip()
+
+
+class CredentialsCache(object):
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(cache_dir(), CREDENTIALS_FILE)
+        self.path = path
+
+    @staticmethod
+    def _key(host, user):
+        return '%s@%s' % (user, host)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, host, user):
+        return self._load().get(self._key(host, user))
+
+    def put(self, host, user, token):
+        data = self._load()
+        data[self._key(host, user)] = token
+        atomic_write(self.path, json.dumps(data, sort_keys=True, indent=2),
+                     mode=0o600)
+
+    def lock(self):
+        return file_lock(self.path + '.lock')
+
+
+def get_api_key(host, user=MAAS_USER, shell_user=SHELL_USER, refresh=False,
+                cache=None):
+    """Get the API key of the MAAS user, from the cache if possible.
+    refresh=True fetches the key from MAAS even if it's cached (use it
+    when MAAS rejects the cached key)"""
+    token = os.environ.get(API_KEY_ENV)
+    if token:
+        return token
+    if cache is None:
+        cache = CredentialsCache()
+    if not refresh:
+        token = cache.get(host, user)
+        if token:
+            return token
+    with cache.lock():
+        cached_token = cache.get(host, user)
+        if cached_token and not refresh:
+            # fetched by another process while we were waiting for the lock
+            return cached_token
+        token = fetch_api_key(host, user=user, shell_user=shell_user)
+        cache.put(host, user, token)
+    return token
+
+
+def api_key_refresher(host, user=MAAS_USER, shell_user=SHELL_USER):
+    """Callable to re-fetch the key on authentication failure (see
+    maas_transport.set_token_refresher), None if the key is given
+    explicitly"""
+    if os.environ.get(API_KEY_ENV):
+        return None
+    return lambda: get_api_key(host, user=user, shell_user=shell_user,
+                               refresh=True)
@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# A stand-in for the MAAS 1.0 API serving a synthetic fleet, to measure how
+# the inventory script and maas_tools scale without a region controller.
+# Implements just enough of the API used by this repo: node listing (with
+# id/mac_address filters), power parameters, tags, block device and
+# interface operations, and commission/acquire/start with the nodes moving
+# to the next state after --transition-time seconds.
+# Latency and errors (503) can be injected. GET /_stats returns the request
+# and traffic counters, POST /_stats resets them. Responses are gzipped if
+# the client asks so. With --api-version 2.0 the MAAS 2.0 flavour of the API
+# (machines/ endpoints and fields) is served instead.
+#
+# Point the tools at it with
+#   MAAS_API_URL=http://127.0.0.1:5240/MAAS/api/1.0 MAAS_API_KEY=a:b:c
+
+import BaseHTTPServer
+import SocketServer
+import json
+import zlib
+import random
+import re
+import threading
+import time
+
+from optparse import OptionParser
+from urlparse import parse_qs, urlparse
+
+API_PREFIX = '/MAAS/api/%s'
+API_VERSIONS = ('1.0', '2.0')
+PORT = 5240
+# don't bother compressing smaller responses
+GZIP_MIN_SIZE = 1024
+
+NODES = 100
+DRIVES = 4  # per node, the last one is a SSD
+INTERFACES = 3  # per node, the first one is the PXE interface
+FABRICS = 1  # PXE fabrics, nodes are spread evenly
+TRANSITION_TIME = 5  # seconds
+ROLE_TAGS = ('ansible_mons', 'ansible_osds', 'ansible_clients')
+MONS = 3
+CLIENTS_FRACTION = 0.1
+
+# non-PXE interfaces are connected to these fabrics (in this order)
+DATA_FABRICS = ('client_net', 'cluster_net')
+
+# state: (transient state, final state)
+ACTIONS = {
+    'commission': ('Commissioning', 'Ready'),
+    'start': ('Deploying', 'Deployed'),
+    'release': ('Releasing', 'Ready'),
+}
+ALLOCATED = 'Allocated'
+
+
+class FleetSpec(object):
+    def __init__(self, nodes=NODES, drives=DRIVES, interfaces=INTERFACES,
+                 fabrics=FABRICS, state='Ready', tagged=True, seed=0,
+                 api_version=API_VERSIONS[0]):
+        self.nodes = nodes
+        self.api_version = api_version
+        self.drives = max(drives, 1)
+        self.interfaces = max(interfaces, 1)
+        self.fabrics = max(fabrics, 1)
+        self.state = state
+        self.tagged = tagged
+        self.seed = seed
+
+
+def _mac(i, n):
+    return '52:54:%02x:%02x:%02x:%02x' % ((i >> 16) & 0xff, (i >> 8) & 0xff,
+                                          i & 0xff, n)
+
+
+def _fabric_name(n, pxe_fabric):
+    if n == 0:
+        return 'pxe_net' if pxe_fabric == 0 else 'pxe_net-%d' % pxe_fabric
+    if n - 1 < len(DATA_FABRICS):
+        return DATA_FABRICS[n - 1]
+    return 'fabric-%d' % n
+
+
+def make_node(i, spec, rnd):
+    system_id = 'node-%05d' % i
+    node_uri = '%s/nodes/%s/' % (API_PREFIX % spec.api_version, system_id)
+    pxe_fabric = i % spec.fabrics
+    ifaces = []
+    for n in range(spec.interfaces):
+        fabric = _fabric_name(n, pxe_fabric)
+        subnet_id = n if n else 100 + pxe_fabric
+        net = subnet_id % 250
+        ifaces.append({
+            'id': i * spec.interfaces + n,
+            'name': 'eth%d' % n,
+            'mac_address': _mac(i, n),
+            'resource_uri': '%sinterfaces/%d/' % (node_uri, n),
+            'links': [{
+                'id': i * spec.interfaces + n,
+                'mode': 'auto',
+                'ip_address': '10.%d.%d.%d' % (net, i // 250, i % 250 + 1),
+                'subnet': {
+                    'id': subnet_id,
+                    'cidr': '10.%d.0.0/16' % net,
+                    'vlan': {'fabric': fabric},
+                },
+            }],
+        })
+    drives = []
+    for d in range(spec.drives):
+        ssd = spec.drives > 1 and d == spec.drives - 1
+        drives.append({
+            'id': d,
+            'name': 'sd%s' % chr(ord('a') + d % 26),
+            'id_path': '/dev/disk/by-id/wwn-0x%012x%04x' % (i, d),
+            'model': 'SSD' if ssd else 'HDD',
+            'size': (200 if ssd else rnd.choice((2000, 4000))) * 10 ** 9,
+            'tags': ['ssd'] if ssd else ['rotary'],
+            'used_for': 'Unused',
+            'resource_uri': '%sblockdevices/%d/' % (node_uri, d),
+        })
+    tags = []
+    if spec.tagged:
+        if i < MONS:
+            tags.append('ansible_mons')
+        if rnd.random() < CLIENTS_FRACTION:
+            tags.append('ansible_clients')
+        else:
+            tags.append('ansible_osds')
+    return {
+        'system_id': system_id,
+        'hostname': 'node%05d.maas' % i,
+        'resource_uri': node_uri,
+        'tag_names': tags,
+        'power_type': '',
+        'osystem': 'ubuntu',
+        'distro_series': 'trusty',
+        'zone': {'name': 'default'},
+        'substatus_name': spec.state,
+        'status_name': spec.state,
+        'macaddress_set': [{'mac_address': iface['mac_address']}
+                           for iface in ifaces],
+        'pxe_mac': {'mac_address': ifaces[0]['mac_address']},
+        'interface_set': ifaces,
+        'physicalblockdevice_set': drives,
+    }
+
+
+class Fleet(object):
+    """Nodes, tags, and power parameters, guarded by a single lock"""
+
+    def __init__(self, spec, transition_time=TRANSITION_TIME):
+        rnd = random.Random(spec.seed)
+        self.lock = threading.Lock()
+        self.transition_time = transition_time
+        self.v2 = spec.api_version != API_VERSIONS[0]
+        self.nodes = [make_node(i, spec, rnd) for i in range(spec.nodes)]
+        self.by_id = dict((n['system_id'], n) for n in self.nodes)
+        self.tags = set(ROLE_TAGS)
+        for node in self.nodes:
+            self.tags.update(node['tag_names'])
+        self.power_params = dict((n['system_id'], {}) for n in self.nodes)
+        # system_id: (final state, when)
+        self._transitions = {}
+
+    def view(self, node):
+        """The node as seen via the API"""
+        if not self.v2:
+            return node
+        node = dict(node)
+        for key in ('substatus_name', 'macaddress_set', 'pxe_mac'):
+            del node[key]
+        node['boot_interface'] = node['interface_set'][0]
+        return node
+
+    def dumps(self, nodes):
+        return json.dumps([self.view(node) for node in nodes])
+
+    def _advance(self):
+        now = time.time()
+        for system_id, (state, when) in list(self._transitions.items()):
+            if when <= now:
+                node = self.by_id[system_id]
+                node['substatus_name'] = node['status_name'] = state
+                del self._transitions[system_id]
+
+    def list_nodes(self, ids=None, macs=None):
+        with self.lock:
+            self._advance()
+            nodes = self.nodes
+            if ids:
+                ids = set(ids)
+                nodes = [n for n in nodes if n['system_id'] in ids]
+            if macs:
+                macs = set(macs)
+                nodes = [n for n in nodes if any(
+                    m['mac_address'] in macs for m in n['macaddress_set'])]
+            return self.dumps(nodes)
+
+    def set_state(self, system_id, action):
+        transient, final = ACTIONS[action]
+        with self.lock:
+            node = self.by_id[system_id]
+            node['substatus_name'] = node['status_name'] = transient
+            self._transitions[system_id] = (final,
+                                            time.time() + self.transition_time)
+            return json.dumps(self.view(node))
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.connections = 0
+        self.by_endpoint = {}
+
+    def count(self, endpoint, sent, received, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.bytes_sent += sent
+            self.bytes_received += received
+            self.by_endpoint[endpoint] = self.by_endpoint.get(endpoint, 0) + 1
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'connections': self.connections,
+                'by_endpoint': dict(self.by_endpoint),
+            }
+
+
+class NotFound(Exception):
+    pass
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send the headers and the body at once
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.stats.lock:
+            self.server.stats.connections += 1
+
+    def _reply(self, code, body='', endpoint=None, received=0):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        gzipped = len(body) >= GZIP_MIN_SIZE and \
+            'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if endpoint is not None:
+            self.server.stats.count(endpoint, len(body), received,
+                                    error=code >= 500)
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        params.update(parse_qs(body))
+        received = len(self.path) + length
+
+        if url.path == '/_stats':
+            if method == 'POST':
+                self.server.stats.reset()
+            return self._reply(200, json.dumps(self.server.stats.to_dict()))
+
+        endpoint = '%s %s op=%s' % (
+            method, re.sub(r'/(node-\d+|\d+)/', '/*/',
+                           url.path[len(self.server.api_prefix):]),
+            params.get('op', [''])[0])
+        if self.server.latency:
+            time.sleep(random.uniform(0, 2 * self.server.latency))
+        if not self.headers.get('Authorization', '').startswith('OAuth '):
+            return self._reply(401, '"unauthorized"', endpoint, received)
+        if random.random() < self.server.error_rate:
+            return self._reply(503, '"try again"', endpoint, received)
+        try:
+            code, reply = self._dispatch(method, url.path, params)
+        except NotFound:
+            code, reply = 404, '"not found"'
+        self._reply(code, reply, endpoint, received)
+
+    def _dispatch(self, method, path, params):
+        fleet = self.server.fleet
+        prefix = self.server.api_prefix
+        if not path.startswith(prefix):
+            raise NotFound()
+        parts = [p for p in path[len(prefix):].split('/') if p]
+        op = params.get('op', [None])[0]
+        if fleet.v2:
+            # translate into MAAS 1.0 terms
+            if parts[:1] == ['machines']:
+                parts[0] = 'nodes'
+                if len(parts) == 1 and op is None and method == 'GET':
+                    op = 'list'
+            elif parts[:1] == ['nodes'] and len(parts) < 3:
+                raise NotFound()
+            op = {'allocate': 'acquire', 'deploy': 'start',
+                  'machines': 'nodes'}.get(op, op)
+            if op == 'acquire':
+                params['nodes'] = params.get('system_id', [])
+        if parts == ['nodes']:
+            if op == 'list':
+                return 200, fleet.list_nodes(ids=params.get('id'),
+                                             macs=params.get('mac_address'))
+            if op == 'power_parameters':
+                with fleet.lock:
+                    ids = params.get('id') or fleet.power_params.keys()
+                    return 200, json.dumps(dict(
+                        (i, fleet.power_params[i]) for i in ids
+                        if i in fleet.power_params))
+            if op == 'acquire' and method == 'POST':
+                with fleet.lock:
+                    allocated = []
+                    for system_id in params.get('nodes', []):
+                        node = fleet.by_id[system_id]
+                        if node['substatus_name'] == ALLOCATED:
+                            return 409, '"no matching node available"'
+                    for system_id in params.get('nodes', []):
+                        node = fleet.by_id[system_id]
+                        node['substatus_name'] = ALLOCATED
+                        node['status_name'] = ALLOCATED
+                        allocated.append(fleet.view(node))
+                    # MAAS replies with the allocated node
+                    return 200, json.dumps(allocated[0] if
+                                           len(allocated) == 1 else allocated)
+        elif parts[:1] == ['nodes'] and len(parts) >= 2:
+            if parts[1] not in fleet.by_id:
+                raise NotFound()
+            return self._node(method, parts[1], parts[2:], op, params)
+        elif parts == ['tags'] and op == 'list':
+            with fleet.lock:
+                return 200, json.dumps([{'name': t}
+                                        for t in sorted(fleet.tags)])
+        elif parts[:1] == ['tags'] and len(parts) == 2:
+            tag = parts[1]
+            if op == 'nodes':
+                with fleet.lock:
+                    return 200, fleet.dumps([n for n in fleet.nodes
+                                             if tag in n['tag_names']])
+            if op == 'update_nodes' and method == 'POST':
+                with fleet.lock:
+                    fleet.tags.add(tag)
+                    for system_id in params.get('add', []):
+                        tags = fleet.by_id[system_id]['tag_names']
+                        if tag not in tags:
+                            tags.append(tag)
+                    for system_id in params.get('remove', []):
+                        tags = fleet.by_id[system_id]['tag_names']
+                        if tag in tags:
+                            tags.remove(tag)
+                return 200, '{}'
+        raise NotFound()
+
+    def _node(self, method, system_id, parts, op, params):
+        fleet = self.server.fleet
+        node = fleet.by_id[system_id]
+        if not parts:
+            if op in ACTIONS and method == 'POST':
+                return 200, fleet.set_state(system_id, op)
+            if method == 'PUT':
+                with fleet.lock:
+                    pp = fleet.power_params[system_id]
+                    for key, value in params.items():
+                        if key.startswith('power_parameters_'):
+                            pp[key[len('power_parameters_'):]] = value[0]
+                        elif key in ('hostname', 'power_type'):
+                            node[key] = value[0]
+                    return 200, json.dumps(fleet.view(node))
+            with fleet.lock:
+                return 200, json.dumps(fleet.view(node))
+        if len(parts) != 2:
+            raise NotFound()
+        kind, item = parts[0], int(parts[1])
+        with fleet.lock:
+            if kind == 'blockdevices':
+                drives = [d for d in node['physicalblockdevice_set']
+                          if d['id'] == item]
+                if not drives:
+                    raise NotFound()
+                tag = params.get('tag', [None])[0]
+                if op == 'add_tag' and tag not in drives[0]['tags']:
+                    drives[0]['tags'].append(tag)
+                elif op == 'remove_tag' and tag in drives[0]['tags']:
+                    drives[0]['tags'].remove(tag)
+                return 200, json.dumps(drives[0])
+            if kind == 'interfaces':
+                ifaces = [i for i in node['interface_set']
+                          if i['resource_uri'].rstrip('/').endswith(
+                              '/%d' % item)]
+                if not ifaces:
+                    raise NotFound()
+                iface = ifaces[0]
+                if op == 'unlink_subnet':
+                    link_id = int(params['id'][0])
+                    iface['links'] = [l for l in iface['links']
+                                      if l['id'] != link_id]
+                elif op == 'link_subnet':
+                    subnet_id = int(params.get('subnet', ['0'])[0])
+                    iface['links'].append({
+                        'id': max([l['id'] for l in iface['links']] +
+                                  [0]) + 1,
+                        'mode': params.get('mode', ['auto'])[0].lower(),
+                        'subnet': {'id': subnet_id, 'cidr': '',
+                                   'vlan': {'fabric': ''}},
+                    })
+                return 200, json.dumps(iface)
+        raise NotFound()
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+
+class FakeMaasServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, fleet, latency=0, error_rate=0,
+                 verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.fleet = fleet
+        self.latency = latency
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.stats = Stats()
+        self.api_prefix = API_PREFIX % ('2.0' if fleet.v2 else '1.0')
+
+    @property
+    def api_url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d%s' % (host, port, self.api_prefix)
+
+    def start(self):
+        """Serve in a background (daemon) thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-b', '--bind', dest='bind', default='127.0.0.1')
+    parser.add_option('-p', '--port', dest='port', type=int, default=PORT)
+    parser.add_option('-n', '--nodes', dest='nodes', type=int, default=NODES)
+    parser.add_option('-d', '--drives', dest='drives', type=int,
+                      default=DRIVES, help='drives per node [%default]')
+    parser.add_option('-i', '--interfaces', dest='interfaces', type=int,
+                      default=INTERFACES,
+                      help='interfaces per node [%default]')
+    parser.add_option('-f', '--fabrics', dest='fabrics', type=int,
+                      default=FABRICS, help='PXE fabrics [%default]')
+    parser.add_option('-s', '--state', dest='state', default='Ready',
+                      help='initial state of nodes [%default]')
+    parser.add_option('-U', '--untagged', dest='tagged', default=True,
+                      action='store_false',
+                      help="don't assign role tags to nodes")
+    parser.add_option('-l', '--latency', dest='latency', type=float,
+                      default=0, help='mean response latency, seconds')
+    parser.add_option('-e', '--error-rate', dest='error_rate', type=float,
+                      default=0, help='fraction of requests failing with 503')
+    parser.add_option('-t', '--transition-time', dest='transition_time',
+                      type=float, default=TRANSITION_TIME,
+                      help='commissioning/deployment time, seconds')
+    parser.add_option('-a', '--api-version', dest='api_version',
+                      choices=API_VERSIONS, default=API_VERSIONS[0],
+                      help='MAAS API version to serve [%default]')
+    parser.add_option('--seed', dest='seed', type=int, default=0)
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
+                      default=False, help='log requests')
+    options, args = parser.parse_args()
+    spec = FleetSpec(nodes=options.nodes, drives=options.drives,
+                     interfaces=options.interfaces, fabrics=options.fabrics,
+                     state=options.state, tagged=options.tagged,
+                     seed=options.seed, api_version=options.api_version)
+    fleet = Fleet(spec, transition_time=options.transition_time)
+    server = FakeMaasServer((options.bind, options.port), fleet,
+                            latency=options.latency,
+                            error_rate=options.error_rate,
+                            verbose=options.verbose)
+    print("serving %d nodes at %s" % (len(fleet.nodes), server.api_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
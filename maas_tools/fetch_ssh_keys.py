@@ -5,62 +5,101 @@
 import json
 import os
 import sys
+import time
 
 from optparse import OptionParser
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+from known_hosts import KnownHosts
 from maas_base_client import MaasBaseClient as MaasClient
 from sshutils import (
-    get_ssh_host_key,
+    SSH_KEY_TYPES,
+    SSH_KEYSCAN_TIMEOUT,
+    scan_ssh_host_keys,
     update_ssh_known_hosts,
 )
+from workers import CONCURRENCY
+import tracing
 
+# give up collecting the keys after that many seconds
+SSH_KEYS_DEADLINE = 120
 
-class Node(object):
-    def __init__(self, thedict):
-        self._d = thedict
 
-    @property
-    def ip_addresses(self):
-        ips = sorted(link['ip_address']
-                     for iface in self._d['interface_set']
-                     for link in iface['links']
-                     if link.get('ip_address') is not None)
-        return list(ips)
-
-    @property
-    def hostname(self):
-        return self._d['hostname']
-
-
-def update_node_ssh_key(node):
-    ssh_key = get_ssh_host_key(node.ip_addresses, node.hostname)
-    update_ssh_known_hosts(node.ip_addresses, node.hostname, ssh_key=ssh_key)
-    return {
-        node.hostname: ssh_key,
-    }
+def node_ssh_keys(node, keys_by_addr):
+    """Keys of the node found at any of its addresses"""
+    keys = []
+    for ip in node.ip_addresses:
+        for key in keys_by_addr.get(ip, []):
+            if key not in keys:
+                keys.append(key)
+    return keys
 
 
 def update_ssh_keys(maas_client,
-                    maas_host=None, maas_user=None, maas_token=None):
+                    maas_host=None, maas_user=None, maas_token=None,
+                    key_types=SSH_KEY_TYPES, timeout=SSH_KEYSCAN_TIMEOUT,
+                    concurrency=CONCURRENCY, deadline=SSH_KEYS_DEADLINE):
+    """Collect host keys of all nodes at once (see scan_ssh_host_keys) and
+    update ~/.ssh/known_hosts. deadline (in seconds) limits the whole scan.
+    Returns {'ssh_keys': {hostname: [key, ...]}, 'timed_out': [hostname]},
+    timed_out being nodes (having IP addresses) which keys could not
+    be obtained"""
     if maas_client is None:
         maas_client = MaasClient(host=maas_host, user=maas_user,
                                  token=maas_token)
+    with tracing.phase('nodes'):
+        nodes = maas_client.node_records()
+    with tracing.phase('keyscan'):
+        keys_by_addr = scan_ssh_host_keys(
+            [ip for node in nodes for ip in node.ip_addresses],
+            key_types=key_types, timeout=timeout, concurrency=concurrency,
+            deadline=time.time() + deadline if deadline else None)
     ssh_keys = {}
-    for _node in maas_client.nodes():
-        node = Node(_node)
-        ssh_keys.update(update_node_ssh_key(node))
-    return ssh_keys
+    timed_out = []
+    known_hosts = KnownHosts()
+    for node in nodes:
+        keys = node_ssh_keys(node, keys_by_addr)
+        update_ssh_known_hosts(node.ip_addresses, node.hostname,
+                               ssh_key=keys, known_hosts=known_hosts)
+        ssh_keys[node.hostname] = keys
+        if node.ip_addresses and not keys:
+            timed_out.append(node.hostname)
+    with tracing.phase('known_hosts'):
+        known_hosts.commit()
+    return {
+        'ssh_keys': ssh_keys,
+        'timed_out': sorted(timed_out),
+    }
 
 
 def main():
     parser = OptionParser()
     parser.add_option('-m', '--maas-host', dest='maas_host')
     parser.add_option('-u', '--maas-user', dest='maas_user')
+    parser.add_option('-P', '--concurrency', dest='concurrency', type='int',
+                      default=CONCURRENCY,
+                      help='run at most that many ssh-keyscan [%default]')
+    parser.add_option('-T', '--timeout', dest='timeout', type='int',
+                      default=SSH_KEYSCAN_TIMEOUT,
+                      help='ssh-keyscan connection timeout [%default]')
+    parser.add_option('-d', '--deadline', dest='deadline', type='int',
+                      default=SSH_KEYS_DEADLINE,
+                      help='give up collecting keys after that many seconds '
+                      '[%default]')
+    parser.add_option('-t', '--key-types', dest='key_types',
+                      default=','.join(SSH_KEY_TYPES),
+                      help='comma separated key types [%default]')
+    parser.add_option('--trace', dest='trace',
+                      help='write timings of requests etc to the file')
     options, args = parser.parse_args()
+    tracing.enable(options.trace)
     maas_client = MaasClient(host=options.maas_host, user=options.maas_user)
-    data = update_ssh_keys(maas_client)
+    data = update_ssh_keys(maas_client,
+                           key_types=options.key_types.split(','),
+                           timeout=options.timeout,
+                           concurrency=options.concurrency,
+                           deadline=options.deadline)
     print(json.dumps(data, sort_keys=True, indent=2))
 
 
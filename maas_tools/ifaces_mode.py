@@ -3,14 +3,20 @@
 # Tell MAAS how to configure nodes' network interfaces
 
 import os
-import requests
 import sys
+import time
 
+from functools import partial
 from optparse import OptionParser
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from maas_base_client import MaasBaseClient
+import tracing
+from workers import (
+    CONCURRENCY,
+    parallel_map,
+)
 
 DHCP = 'dhcp'
 LINK_UP = 'link_up'
@@ -20,7 +26,7 @@ class MaasClient(MaasBaseClient):
 
     def unlink_iface(self, iface_uri, link_id=None):
         url = '{0}{1}/?op=unlink_subnet'.format(self._base_url, iface_uri)
-        rq = requests.post(url, data={'id': link_id}, headers=self._auth())
+        rq = self._transport.post(url, data={'id': link_id})
         rq.raise_for_status()
 
     def link_iface(self, iface_uri, subnet_id=None, link_id=None,
@@ -28,41 +34,119 @@ class MaasClient(MaasBaseClient):
         if mode.lower() == LINK_UP:
             self.unlink_iface(iface_uri, link_id=link_id)
         else:
-            url = '{0}{1}?op=link_subnet'.format(self._base_url, iface_uri)
-            data = {
-                'mode': mode,
-                'subnet': subnet_id,
-            }
-            rq = requests.post(url, data=data, headers=self._auth())
-            rq.raise_for_status()
-
-    def _set_links_mode(self, iface, mode=DHCP):
-        links = (link for link in iface['links']
-                 if link['mode'].lower() != mode.lower())
-        for link in links:
-            self.link_iface(iface['resource_uri'],
-                            subnet_id=link['subnet']['id'],
-                            link_id=link['id'],
-                            mode=mode)
-
-    def _set_nonpxe_ifaces_mode(self, node, mode=DHCP):
+            self.link_subnet(iface_uri, subnet_id=subnet_id, mode=mode)
+
+    def link_subnet(self, iface_uri, subnet_id=None, mode=DHCP):
+        url = '{0}{1}?op=link_subnet'.format(self._base_url, iface_uri)
+        data = {
+            'mode': mode,
+            'subnet': subnet_id,
+        }
+        rq = self._transport.post(url, data=data)
+        rq.raise_for_status()
+
+    def plan_node(self, node, mode=DHCP, skipped=None):
+        """Steps (description, function) to switch the links of the node's
+        non-PXE interfaces to the given mode. Empty if all links are in
+        that mode already. Links which can't be switched (having no subnet
+        to link to) are left as is and listed in `skipped`"""
         pxe_mac = node['pxe_mac']['mac_address']
         ifaces = (iface for iface in node['interface_set']
                   if iface['mac_address'] != pxe_mac)
+        steps = []
         for iface in ifaces:
+            links = (link for link in iface['links']
+                     if link['mode'].lower() != mode.lower())
+            for link in links:
+                iface_uri = iface['resource_uri']
+                subnet = link.get('subnet')
+                if not subnet and mode.lower() != LINK_UP:
+                    # unlinking it is pointless: MAAS puts a link_up link
+                    # back on an interface without links
+                    if skipped is not None:
+                        skipped.append('{0}: no subnet'.format(iface['name']))
+                    continue
+                cidr = subnet['cidr'] if subnet else 'no subnet'
+                steps.append((
+                    'unlink {0} from {1}'.format(iface['name'], cidr),
+                    partial(self.unlink_iface, iface_uri,
+                            link_id=link['id'])))
+                if mode.lower() == LINK_UP or not subnet:
+                    continue
+                steps.append((
+                    'link {0} to {1} ({2})'.format(iface['name'], cidr, mode),
+                    partial(self.link_subnet, iface_uri,
+                            subnet_id=subnet['id'], mode=mode)))
+        return steps
+
+    def _apply_plan(self, node, steps, skipped=()):
+        result = NodeResult(node['hostname'], len(steps), notes=skipped)
+        # the steps of a node must be run in order: unlink before link
+        for description, step in steps:
             try:
-                self._set_links_mode(iface, mode)
-            except:
-                print("{host}: failed to set {ifname} to {mode}".format(
-                    host=node['hostname'],
-                    mode=mode,
-                    ifname=iface['name']))
-
-    def set_nonpxe_ifaces_mode(self, nodes=None, mode=DHCP):
-        if not nodes:
-            nodes = self.nodes()
-        for node in nodes:
-            self._set_nonpxe_ifaces_mode(node, mode=mode)
+                step()
+            except Exception as e:
+                result.fail('{0}: {1}'.format(description, e))
+                break
+            result.done += 1
+        result.finish()
+        return result
+
+    def set_nonpxe_ifaces_mode(self, nodes=None, mode=DHCP,
+                               concurrency=CONCURRENCY, filters=None):
+        if nodes is None:
+            with tracing.phase('nodes'):
+                nodes = self.nodes(**(filters or {}))
+        with tracing.phase('plan'):
+            plans = []
+            for node in nodes:
+                skipped = []
+                steps = self.plan_node(node, mode=mode, skipped=skipped)
+                plans.append((node, steps, skipped))
+        results = [NodeResult(node['hostname'], 0, notes=skipped)
+                   for node, steps, skipped in plans if not steps]
+        with tracing.phase('apply'):
+            results.extend(parallel_map(
+                lambda plan: self._apply_plan(*plan),
+                [plan for plan in plans if plan[1]],
+                concurrency=concurrency))
+        return sorted(results, key=lambda r: r.hostname)
+
+
+class NodeResult(object):
+    def __init__(self, hostname, steps, notes=()):
+        self.hostname = hostname
+        self.steps = steps
+        self.notes = list(notes)
+        self.done = 0
+        self.error = None
+        self.started = time.time()
+        self.elapsed = 0
+
+    @property
+    def status(self):
+        if self.error is not None:
+            return 'failed'
+        return 'changed' if self.steps else 'unchanged'
+
+    def fail(self, error):
+        self.error = error
+
+    def finish(self):
+        self.elapsed = time.time() - self.started
+
+
+def print_report(results):
+    fmt = '{0:<32} {1:<10} {2:>7} {3:>8}  {4}'
+    print(fmt.format('HOST', 'STATUS', 'CHANGES', 'ELAPSED', ''))
+    for r in results:
+        print(fmt.format(r.hostname, r.status, '%d/%d' % (r.done, r.steps),
+                         '%.1f' % r.elapsed, r.error or ', '.join(r.notes)))
+    failed = [r for r in results if r.error is not None]
+    unchanged = [r for r in results if not r.steps]
+    print("%d nodes changed, %d unchanged, %d failed" % (
+        len(results) - len(failed) - len(unchanged), len(unchanged),
+        len(failed)))
 
 
 def main():
@@ -70,9 +154,24 @@ def main():
     parser.add_option('-m', '--maas-host', dest='maas_host')
     parser.add_option('-u', '--maas-user', dest='maas_user')
     parser.add_option('-M', '--link-mode', dest='link_mode', default=DHCP)
+    parser.add_option('-P', '--concurrency', dest='concurrency', type=int,
+                      help='max number of nodes configured at once',
+                      default=CONCURRENCY)
+    parser.add_option('-H', '--hostname', dest='hostnames', action='append',
+                      help='only this node, can be repeated')
+    parser.add_option('-z', '--zone', dest='zone',
+                      help='only the nodes in this zone')
+    parser.add_option('--trace', dest='trace',
+                      help='write timings of requests etc to the file')
     options, args = parser.parse_args()
+    tracing.enable(options.trace)
     maas_client = MaasClient(host=options.maas_host, user=options.maas_user)
-    maas_client.set_nonpxe_ifaces_mode(mode=options.link_mode)
+    results = maas_client.set_nonpxe_ifaces_mode(
+        filters={'hostname': options.hostnames, 'zone': options.zone},
+        mode=options.link_mode, concurrency=options.concurrency)
+    print_report(results)
+    if any(r.error is not None for r in results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,161 @@
+
+# encoding: utf-8
+# Spread the OSDs of a node over its journal drives according to the
+# write bandwidth of the drives rather than round robin, so that a slow
+# (or small) SSD does not end up with as many OSDs as a fast one. The
+# bandwidth of a drive is guessed from its media (rotary, SSD, NVMe)
+# unless the config file (MAAS_INVENTORY_CONFIG) has a hint for its
+# model:
+#
+#   [journals]
+#   max_osds_per_journal = 6
+#   # journal partition size, MB (0: don't check the journal drive size)
+#   journal_size = 3072
+#
+#   [bandwidth]
+#   # sequential write bandwidth by drive model, MB/s
+#   INTEL SSDSC2BP240G4 = 380
+#   ST2000DM001 = 150
+
+import os
+
+from ConfigParser import RawConfigParser
+
+CONFIG_ENV = 'MAAS_INVENTORY_CONFIG'
+JOURNALS_SECTION = 'journals'
+BANDWIDTH_SECTION = 'bandwidth'
+
+# 0 means no limit
+MAX_OSDS_PER_JOURNAL = 0
+JOURNAL_SIZE = 0
+
+ROTARY = 'rotary'
+SSD = 'ssd'
+NVME = 'nvme'
+# sequential write bandwidth by media, MB/s
+MEDIA_BANDWIDTH = {
+    ROTARY: 120,
+    SSD: 400,
+    NVME: 1500,
+}
+
+
+def drive_media(name, id_path, tags, default=ROTARY):
+    """Media of a drive, based on the tags MAAS assigns to block devices
+    (rotary, ssd) and the bus in the device name (nvme0n1, /dev/disk/by-id/
+    nvme-...)"""
+    if NVME in (name or '') or NVME in (id_path or ''):
+        return NVME
+    if ROTARY in tags:
+        return ROTARY
+    if SSD in tags:
+        return SSD
+    return default
+
+
+def media_type(drive, default=ROTARY):
+    """Media of a node_records.Drive"""
+    return drive_media(drive.name, drive.id_path, drive.tags, default)
+
+
+def read_config(path=None):
+    """RawConfigParser of the file (MAAS_INVENTORY_CONFIG if path is
+    not given), None if neither is set"""
+    path = path or os.environ.get(CONFIG_ENV)
+    if not path:
+        return None
+    config = RawConfigParser()
+    # keep the case of drive models
+    config.optionxform = str
+    with open(path) as f:
+        config.readfp(f)
+    return config
+
+
+class JournalPolicy(object):
+    def __init__(self, max_osds_per_journal=MAX_OSDS_PER_JOURNAL,
+                 journal_size=JOURNAL_SIZE, bandwidth=None):
+        self.max_osds_per_journal = max_osds_per_journal
+        self.journal_size = journal_size
+        self.bandwidth = bandwidth or {}
+
+    @classmethod
+    def load(cls, path=None):
+        """Read the policy from the file (MAAS_INVENTORY_CONFIG if path
+        is not given), defaults are used if neither is set"""
+        config = read_config(path)
+        if config is None:
+            return cls()
+        kwargs = {}
+        if config.has_section(JOURNALS_SECTION):
+            for name in ('max_osds_per_journal', 'journal_size'):
+                if config.has_option(JOURNALS_SECTION, name):
+                    kwargs[name] = config.getint(JOURNALS_SECTION, name)
+        if config.has_section(BANDWIDTH_SECTION):
+            kwargs['bandwidth'] = dict(
+                (model, float(value))
+                for model, value in config.items(BANDWIDTH_SECTION))
+        return cls(**kwargs)
+
+    def drive_bandwidth(self, drive, default_media=ROTARY):
+        if drive.model and drive.model in self.bandwidth:
+            return self.bandwidth[drive.model]
+        return MEDIA_BANDWIDTH[media_type(drive, default_media)]
+
+    def journal_slots(self, journal):
+        """How many OSDs the journal drive can hold, None if unlimited"""
+        slots = []
+        if self.max_osds_per_journal > 0:
+            slots.append(self.max_osds_per_journal)
+        if self.journal_size > 0 and journal.size:
+            slots.append(max(journal.size // (self.journal_size * 10 ** 6),
+                             1))
+        return min(slots) if slots else None
+
+
+def place_journals(osds, journals, policy=None):
+    """Assign a journal drive to every OSD drive (node_records.Drive).
+
+    OSDs are taken in the order of decreasing write bandwidth, and every
+    one goes to the journal which ends up least utilized (write bandwidth
+    of its OSDs relative to its own) among the ones having free slots.
+    If all journals are full the OSD goes to the least utilized one
+    anyway (and the journal is reported as overcommitted). With identical
+    drives this yields the round robin assignment.
+
+    Returns the list of journals (one per OSD, in the order of `osds`)
+    and the load report {journal id_path: {...}}"""
+    policy = policy or JournalPolicy()
+    if not osds or not journals:
+        return [], {}
+    demand = [policy.drive_bandwidth(osd, ROTARY) for osd in osds]
+    bandwidth = [policy.drive_bandwidth(j, SSD) for j in journals]
+    slots = [policy.journal_slots(j) for j in journals]
+    load = [0.0] * len(journals)
+    count = [0] * len(journals)
+    placement = [None] * len(osds)
+
+    def cost(j, osd_idx):
+        return ((load[j] + demand[osd_idx]) / bandwidth[j], count[j], j)
+
+    # sorted() is stable, so identical OSDs keep their order
+    for i in sorted(range(len(osds)), key=lambda i: -demand[i]):
+        free = [j for j in range(len(journals))
+                if slots[j] is None or count[j] < slots[j]]
+        best = min(free or range(len(journals)), key=lambda j: cost(j, i))
+        placement[i] = best
+        load[best] += demand[i]
+        count[best] += 1
+
+    report = {}
+    for j, journal in enumerate(journals):
+        report[journal.id_path] = {
+            'osds': count[j],
+            'slots': slots[j],
+            'write_mbps': load[j],
+            'bandwidth_mbps': bandwidth[j],
+            'utilization': round(load[j] / bandwidth[j], 3),
+            'overcommitted': (slots[j] is not None and count[j] > slots[j])
+            or load[j] > bandwidth[j],
+        }
+    return [journals[j].id_path for j in placement], report
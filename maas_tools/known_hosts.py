@@ -0,0 +1,141 @@
+
+# encoding: utf-8
+# Edit ~/.ssh/known_hosts in process: parse the file once, apply a batch of
+# removals/additions in memory, and write it back once (atomically, under
+# a lock) instead of running ssh-keygen -F/-R for every host and address
+
+import base64
+import hashlib
+import hmac
+import os
+
+from cacheutils import (
+    atomic_write,
+    file_lock,
+)
+
+KNOWN_HOSTS_FILE = os.path.expanduser('~/.ssh/known_hosts')
+HASH_MAGIC = '|1|'
+
+
+def _hash_host(host, salt):
+    return hmac.new(salt, host.encode('utf-8'), hashlib.sha1).digest()
+
+
+class Entry(object):
+    """A line of known_hosts. Comments, blank lines, and lines with
+    markers (@cert-authority, @revoked) are kept as is and never match"""
+
+    __slots__ = ('line', 'hosts', 'hashed')
+
+    def __init__(self, line):
+        self.line = line
+        self.hosts = ()
+        self.hashed = None
+        fields = line.split()
+        if len(fields) < 3 or fields[0].startswith('#') or \
+                fields[0].startswith('@'):
+            return
+        if fields[0].startswith(HASH_MAGIC):
+            try:
+                salt, digest = fields[0][len(HASH_MAGIC):].split('|', 1)
+                self.hashed = (base64.b64decode(salt),
+                               base64.b64decode(digest))
+            except (TypeError, ValueError):
+                pass
+        else:
+            self.hosts = tuple(fields[0].split(','))
+
+    def matches(self, host):
+        if self.hashed is not None:
+            salt, digest = self.hashed
+            return hmac.compare_digest(_hash_host(host, salt), digest)
+        return host in self.hosts
+
+
+class KnownHosts(object):
+    """known_hosts file indexed by host
+
+    Changes are queued with remove() and add() and written by commit().
+    The file is re-read under the lock before applying the changes, so
+    concurrent updates by other processes are not lost.
+    """
+
+    def __init__(self, path=KNOWN_HOSTS_FILE):
+        self.path = path
+        self._entries = []
+        self._by_host = {}
+        self._hashed = {}
+        self._removals = set()
+        self._additions = []
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError):
+            lines = []
+        self._entries = [Entry(line) for line in lines]
+        self._by_host = {}
+        # salt => digest => entries
+        self._hashed = {}
+        for entry in self._entries:
+            if entry.hashed is not None:
+                salt, digest = entry.hashed
+                self._hashed.setdefault(salt, {}).setdefault(
+                    digest, []).append(entry)
+            for host in entry.hosts:
+                self._by_host.setdefault(host, []).append(entry)
+
+    def lookup_all(self, hosts):
+        """Entries (both plain and hashed) matching any of the hosts. Every
+        host is hashed once per distinct salt, and the hashed entries are
+        found by the digest"""
+        hosts = set(hosts)
+        entries = [e for host in hosts for e in self._by_host.get(host, ())]
+        for salt, by_digest in self._hashed.items():
+            for host in hosts:
+                entries.extend(by_digest.get(_hash_host(host, salt), ()))
+        return entries
+
+    def lookup(self, host):
+        """Entries (both plain and hashed) matching the host"""
+        return self.lookup_all([host])
+
+    def __contains__(self, host):
+        return bool(self.lookup(host))
+
+    def remove(self, host):
+        """Queue removal of all keys of the host (same as ssh-keygen -R)"""
+        self._removals.add(host)
+
+    def add(self, hosts, key):
+        """Queue a 'hosts key' line, hosts being a list of names/addresses"""
+        self._additions.append('%s %s' % (','.join(hosts), key))
+
+    def _apply(self):
+        removed = set(id(e) for e in self.lookup_all(self._removals))
+        lines = [e.line for e in self._entries if id(e) not in removed]
+        lines.extend(self._additions)
+        return lines
+
+    def commit(self):
+        """Write the queued changes in one go"""
+        if not self._removals and not self._additions:
+            return
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0o700)
+        with file_lock(self.path + '.lock'):
+            self.load()
+            lines = self._apply()
+            try:
+                mode = os.stat(self.path).st_mode & 0o777
+            except OSError:
+                mode = 0o644
+            atomic_write(self.path, ''.join(line + '\n' for line in lines),
+                         mode=mode)
+            self._removals = set()
+            self._additions = []
+            self.load()
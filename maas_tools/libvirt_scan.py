@@ -0,0 +1,191 @@
+
+# encoding: utf-8
+# Enumerate libvirt domains and MAC addresses of their network interfaces
+# in one pass: a single libvirt connection (python bindings), or virsh if
+# the bindings are not available. The MAC addresses are cached by the
+# domain UUID, and the XML of a domain is read again only if its
+# definition has changed.
+
+import json
+import os
+import re
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+import tracing
+
+from cacheutils import (
+    atomic_write,
+    cache_dir,
+)
+from workers import (
+    CONCURRENCY,
+    parallel_map,
+)
+
+DEFAULT_LIBVIRT_URL = 'qemu:///system'
+
+# persistent domains definitions, used to find out if a domain has changed
+DOMAIN_CONFIG_DIRS = {
+    'qemu:///system': '/etc/libvirt/qemu',
+    'qemu:///session': os.path.expanduser('~/.config/libvirt/qemu'),
+}
+
+
+
+def _domain_macs(root):
+    macs = (mac.get('address')
+            for iface in root.findall('devices/interface')
+            if iface.get('type') == 'network'
+            for mac in iface.findall('mac'))
+    return tuple(sorted(mac for mac in macs if mac))
+
+
+def parse_macs(xml):
+    """MACs of the domain's interfaces connected to libvirt networks"""
+    return _domain_macs(ElementTree.fromstring(xml))
+
+
+def parse_domain(xml):
+    """(name, uuid, MACs) of the domain XML"""
+    root = ElementTree.fromstring(xml)
+    return (root.findtext('name'), root.findtext('uuid'),
+            _domain_macs(root))
+
+
+class Domain(object):
+    __slots__ = ('name', 'uuid', 'macs', 'stamp')
+
+    def __init__(self, name, uuid, macs, stamp=None):
+        self.name = name
+        self.uuid = uuid
+        self.macs = tuple(macs)
+        self.stamp = stamp
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'macs': list(self.macs),
+            'stamp': self.stamp,
+        }
+
+
+class LibvirtScanner(object):
+    def __init__(self, conn=DEFAULT_LIBVIRT_URL, cache_path=None,
+                 use_bindings=True, concurrency=CONCURRENCY):
+        self.conn = conn
+        if cache_path is None:
+            cache_path = os.path.join(
+                cache_dir(), 'libvirt-%s.json' % re.sub(r'[^\w.-]+', '_',
+                                                        conn))
+        self.cache_path = cache_path
+        self.use_bindings = use_bindings
+        self.concurrency = concurrency
+        self._set_cache(self._load_cache())
+
+    def _set_cache(self, domains):
+        """domains is {uuid: Domain}"""
+        self._cache = domains
+        self._uuid_by_name = dict((d.name, uuid)
+                                  for uuid, d in domains.items())
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        return dict((uuid, Domain(d['name'], uuid, d['macs'], d['stamp']))
+                    for uuid, d in data.items())
+
+    def _save_cache(self, domains):
+        data = dict((d.uuid, d.to_dict()) for d in domains
+                    if d.stamp is not None)
+        atomic_write(self.cache_path, json.dumps(data, sort_keys=True))
+
+    def _stamp(self, name):
+        """mtime of the domain definition, None if unknown"""
+        config_dir = DOMAIN_CONFIG_DIRS.get(self.conn)
+        if config_dir is None:
+            return None
+        try:
+            return os.stat(os.path.join(config_dir, name + '.xml')).st_mtime
+        except OSError:
+            return None
+
+    def _cached(self, name, uuid=None):
+        """The cached domain (None if it has changed since it was cached)
+        and the current stamp of its definition"""
+        stamp = self._stamp(name)
+        if stamp is None:
+            return None, None
+        domain = self._cache.get(uuid or self._uuid_by_name.get(name))
+        if domain is not None and domain.name == name and \
+                domain.stamp == stamp:
+            return domain, stamp
+        return None, stamp
+
+    def scan(self):
+        """Returns the list of all (defined and running) domains"""
+        libvirt = None
+        if self.use_bindings:
+            try:
+                import libvirt
+            except ImportError:
+                pass
+        if libvirt is not None:
+            domains = self._scan_bindings(libvirt)
+        else:
+            domains = self._scan_virsh()
+        self._save_cache(domains)
+        self._set_cache(dict((d.uuid, d) for d in domains
+                             if d.stamp is not None))
+        return domains
+
+    def _scan_bindings(self, libvirt):
+        conn = libvirt.openReadOnly(self.conn)
+        try:
+            domains = []
+            for dom in conn.listAllDomains(0):
+                name, uuid = dom.name(), dom.UUIDString()
+                domain, stamp = self._cached(name, uuid)
+                if domain is None:
+                    domain = Domain(name, uuid, parse_macs(dom.XMLDesc(0)),
+                                    stamp=stamp)
+                domains.append(domain)
+            return domains
+        finally:
+            conn.close()
+
+    def _virsh(self, *args):
+        cmd = ['virsh', '-q', '-c', self.conn]
+        cmd.extend(args)
+        return tracing.check_output(cmd)
+
+    def _scan_virsh(self):
+        names = [line.strip() for line in
+                 self._virsh('list', '--all', '--name').splitlines()
+                 if line.strip()]
+        domains = []
+        stamps = {}
+        for name in names:
+            domain, stamps[name] = self._cached(name)
+            if domain is not None:
+                domains.append(domain)
+        cached = set(domain.name for domain in domains)
+        to_read = set(name for name in names if name not in cached)
+        # the domain names are passed as arguments of their own, so they
+        # need no quoting; only the domains changed since the last scan
+        # are read, several at once
+        xmls = parallel_map(lambda name: self._virsh('dumpxml', '--domain',
+                                                     name),
+                            sorted(to_read), concurrency=self.concurrency)
+        for xml in xmls:
+            name, uuid, macs = parse_domain(xml)
+            if name in to_read and uuid:
+                domains.append(Domain(name, uuid, macs,
+                                      stamp=stamps.get(name)))
+        return domains
@@ -0,0 +1,91 @@
+
+# encoding: utf-8
+# URLs of the MAAS API endpoints used by the tools, for both MAAS 1.0
+# (nodes/) and MAAS 2.0 (machines/) APIs, and the node filters MAAS
+# supports, so that nodes can be selected by MAAS instead of downloading
+# all of them and filtering on the client.
+
+import re
+
+API_1_0 = '1.0'
+API_2_0 = '2.0'
+
+# nodes listing filters supported by both APIs
+NODE_FILTERS = ('id', 'hostname', 'mac_address', 'zone', 'agent_name')
+
+_VERSION_RE = re.compile(r'/api/(\d+\.\d+)/?$')
+
+# MAAS 1.0 node operations renamed in MAAS 2.0
+_OPS_2_0 = {
+    'acquire': 'allocate',
+    'start': 'deploy',
+}
+
+
+def api_version(api_url):
+    match = _VERSION_RE.search(api_url)
+    return match.group(1) if match else API_1_0
+
+
+def node_filters(**filters):
+    """Query parameters selecting the nodes, None values are ignored"""
+    params = {}
+    for name, value in filters.items():
+        if name not in NODE_FILTERS:
+            raise ValueError('unsupported node filter: %s' % name)
+        if value is None or value == []:
+            continue
+        params[name] = value
+    return params
+
+
+def normalize_node(node):
+    """Add the MAAS 1.0 fields missing in MAAS 2.0 machines"""
+    if 'substatus_name' not in node:
+        node['substatus_name'] = node.get('status_name')
+    if 'macaddress_set' not in node:
+        node['macaddress_set'] = [{'mac_address': iface['mac_address']}
+                                  for iface in node.get('interface_set', ())]
+    if 'pxe_mac' not in node:
+        boot_iface = node.get('boot_interface') or {}
+        node['pxe_mac'] = {'mac_address': boot_iface.get('mac_address')}
+    return node
+
+
+class MaasApi(object):
+    def __init__(self, api_url):
+        self.api_url = api_url.rstrip('/')
+        self.version = api_version(self.api_url)
+        self.v2 = self.version != API_1_0
+        self._nodes = 'machines' if self.v2 else 'nodes'
+
+    def op(self, op):
+        return _OPS_2_0.get(op, op) if self.v2 else op
+
+    def nodes_url(self):
+        if self.v2:
+            return '%s/machines/' % self.api_url
+        return '%s/nodes/?op=list' % self.api_url
+
+    def nodes_op_url(self, op):
+        return '%s/%s/?op=%s' % (self.api_url, self._nodes, self.op(op))
+
+    def node_url(self, system_id, op=None):
+        # note: trailing slash is mandatory
+        url = '%s/%s/%s/' % (self.api_url, self._nodes, system_id)
+        if op is not None:
+            url += '?op=%s' % self.op(op)
+        return url
+
+    def tags_url(self):
+        return '%s/tags/?op=list' % self.api_url
+
+    def tag_url(self, tag, op):
+        if op == 'nodes' and self.v2:
+            op = 'machines'
+        return '%s/tags/%s/?op=%s' % (self.api_url, tag, op)
+
+    @property
+    def drive_tag_method(self):
+        # MAAS 1.0 (ab)uses GET to tag the block devices
+        return 'POST' if self.v2 else 'GET'
@@ -1,22 +1,34 @@
 
 # encoding: utf-8
-import json
-import oauth.oauth as oauth
-import requests
-import subprocess
-import uuid
+import os
 
 from urlparse import urlparse
 
+from credentials import (
+    API_URL_ENV,
+    MAAS_USER,
+    SHELL_USER,
+    api_key_refresher,
+    get_api_key,
+)
+from maas_api import (
+    MaasApi,
+    node_filters,
+    normalize_node,
+)
+from maas_transport import get_transport
+from node_records import fetch_node_records
+import tracing
+
 MAAS_HOST = '127.0.0.1'
-MAAS_USER = 'root'
-SHELL_USER = 'ubuntu'
 
 
 class MaasBaseClient(object):
     def __init__(self, api_url=None, token=None,
                  host=None, user=None,
                  shell_user=None):
+        if not api_url and not host:
+            api_url = os.environ.get(API_URL_ENV)
         if not api_url:
             if not host:
                 host = MAAS_HOST
@@ -29,47 +41,40 @@ class MaasBaseClient(object):
             api_url = 'http://%s:5240/MAAS/api/1.0' % host
         if not host:
             host = urlparse(api_url).hostname
+        refresh_token = None
         if not token:
             token = self._get_token(host, user, shell_user)
+            refresh_token = api_key_refresher(host, user, shell_user)
         dissected_api_url = urlparse(api_url)
         self._token = token
+        self._transport = get_transport(token, refresh_token=refresh_token)
         self._api_url = api_url
+        self._api = MaasApi(api_url)
         self._base_url = '{0}://{1}'.format(dissected_api_url.scheme,
                                             dissected_api_url.netloc)
 
     def _auth(self):
-        consumer_key, key, secret = self._token.split(':')
-        resource_token = oauth.OAuthToken(key, secret)
-        consumer_token = oauth.OAuthConsumer(consumer_key, '')
-        oauth_request = oauth.OAuthRequest.from_consumer_and_token(
-            consumer_token,
-            token=resource_token,
-            http_url=self._api_url,
-            parameters={
-                'auth_nonce': uuid.uuid4().get_hex(),
-            }
-        )
-        oauth_request.sign_request(oauth.OAuthSignatureMethod_PLAINTEXT(),
-                                   consumer_token,
-                                   resource_token)
-        return oauth_request.to_header()
+        return self._transport.auth_headers()
 
     def _get_token(self, host, user, shell_user):
-        cmd = [
-            'ssh', '%s@%s' % (shell_user, host),
-            'sudo', 'maas-region-admin', 'apikey',
-            '--username=%s' % user
-        ]
-        return subprocess.check_output(cmd).strip()
+        return get_api_key(host, user=user, shell_user=shell_user)
 
-    def nodes(self):
-        url = '%s/nodes/?op=list' % self._api_url
-        rq = requests.get(url, headers=self._auth())
+    def nodes(self, system_ids=None, **filters):
+        """Nodes selected by MAAS with the given filters (see
+        maas_api.NODE_FILTERS), all nodes by default"""
+        params = node_filters(id=system_ids, **filters)
+        rq = self._transport.get(self._api.nodes_url(), params=params)
         rq.raise_for_status()
-        return json.loads(rq.text)
+        return [normalize_node(node) for node in
+                tracing.loads(rq.text, 'nodes')]
+
+    def node_records(self, system_ids=None, **filters):
+        """Same as nodes(), but decoded into (compact) NodeRecords"""
+        params = node_filters(id=system_ids, **filters)
+        return fetch_node_records(self._transport, self._api.nodes_url(),
+                                  params=params)
 
     def update_node(self, system_id, params=None):
-        # note: trailing slash is mandatory
-        url = '%s/nodes/%s/' % (self._api_url, system_id)
-        rq = requests.put(url, data=params, headers=self._auth())
+        url = self._api.node_url(system_id)
+        rq = self._transport.put(url, data=params)
         rq.raise_for_status()
@@ -0,0 +1,219 @@
+
+# encoding: utf-8
+# HTTP transport shared by the inventory script and all maas_tools:
+# keep-alive connections, bounded retries, and cheap OAuth signing
+
+import atexit
+import os
+import sys
+import threading
+import time
+import uuid
+
+from urllib import quote
+
+import tracing
+
+POOL_SIZE = 16
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5  # seconds, doubles after every attempt
+RETRY_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+# print the requests/connections counters on exit if set
+STATS_ENV = 'MAAS_TRANSPORT_STATS'
+
+
+def _escape(s):
+    return quote(s, safe='~')
+
+
+class OAuthSigner(object):
+    """Sign requests with a MAAS API key (consumer_key:token_key:secret)
+
+    MAAS uses the PLAINTEXT signature method, so the signature does not
+    depend on the request at all. Only the nonce and the timestamp have
+    to be generated for every request, the rest of the header is computed
+    once.
+    """
+
+    def __init__(self, token):
+        consumer_key, key, secret = token.split(':')
+        signature = '&' + _escape(secret)  # the consumer secret is empty
+        params = [
+            ('oauth_consumer_key', consumer_key),
+            ('oauth_token', key),
+            ('oauth_signature_method', 'PLAINTEXT'),
+            ('oauth_version', '1.0'),
+            ('oauth_signature', signature),
+        ]
+        self._header_prefix = 'OAuth realm=""' + ''.join(
+            ', %s="%s"' % (k, _escape(v)) for k, v in params)
+
+    def headers(self):
+        header = '%s, oauth_nonce="%s", oauth_timestamp="%d"' % (
+            self._header_prefix, uuid.uuid4().hex, int(time.time()))
+        return {'Authorization': header}
+
+
+class MaasTransport(object):
+    """A persistent requests session signing every request with the API key
+
+    Transient failures (connection errors, 5xx responses) are retried with
+    an exponential backoff. Non-idempotent requests (POST) are retried only
+    if the server has not processed them for sure: when the connection
+    could not be established, or MAAS replied with 503.
+
+    If MAAS rejects the API key (401) refresh_token is called (once) to get
+    a new one, and the request is repeated.
+    """
+
+    def __init__(self, token, pool_size=POOL_SIZE,
+                 max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF,
+                 refresh_token=None):
+        # importing requests takes a while, don't do that unless
+        # MAAS is actually going to be queried
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self._exceptions = requests.exceptions
+        self._signer = OAuthSigner(token)
+        self._refresh_token = refresh_token
+        self._token_refreshed = False
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._adapter = HTTPAdapter(pool_connections=pool_size,
+                                    pool_maxsize=pool_size)
+        self._session = requests.Session()
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._retries = 0
+
+    def auth_headers(self):
+        return self._signer.headers()
+
+    def set_refresh_token(self, refresh_token):
+        with self._lock:
+            self._refresh_token = refresh_token
+            self._token_refreshed = False
+
+    def _renew_token(self, rejected_signer):
+        with self._lock:
+            if self._signer is not rejected_signer:
+                # another thread has already got a new key
+                return True
+            if self._refresh_token is None or self._token_refreshed:
+                return False
+            self._token_refreshed = True
+            self._signer = OAuthSigner(self._refresh_token())
+            return True
+
+    def _may_retry(self, method, attempt, status=None, error=None):
+        if attempt >= self._max_retries:
+            return False
+        if method.upper() in IDEMPOTENT_METHODS:
+            return True
+        if error is not None:
+            return isinstance(error, self._exceptions.ConnectTimeout)
+        return status == 503
+
+    def _count(self, retry=False):
+        with self._lock:
+            self._requests += 1
+            if retry:
+                self._retries += 1
+
+    def request(self, method, url, headers=None, **kwargs):
+        if not tracing.enabled():
+            return self._request(method, url, headers=headers, **kwargs)
+        endpoint = tracing.endpoint_template(url, kwargs.get('params'))
+        with tracing.span('request', endpoint, method=method) as span:
+            rq = self._request(method, url, headers=headers, **kwargs)
+            span.set(status=rq.status_code,
+                     server_time=rq.elapsed.total_seconds())
+            if not kwargs.get('stream'):
+                span.set(bytes=len(rq.content))
+            return rq
+
+    def _request(self, method, url, headers=None, **kwargs):
+        attempt = 0
+        renewed = False
+        while True:
+            signer = self._signer
+            all_headers = signer.headers()
+            if headers:
+                all_headers.update(headers)
+            self._count(retry=attempt > 0 or renewed)
+            try:
+                rq = self._session.request(method, url, headers=all_headers,
+                                           **kwargs)
+            except self._exceptions.ConnectionError as e:
+                if not self._may_retry(method, attempt, error=e):
+                    raise
+            else:
+                if rq.status_code == 401 and not renewed and \
+                        self._renew_token(signer):
+                    rq.close()
+                    renewed = True
+                    continue
+                if rq.status_code not in RETRY_STATUSES or \
+                        not self._may_retry(method, attempt,
+                                            status=rq.status_code):
+                    return rq
+                rq.close()
+            time.sleep(self._backoff * 2 ** attempt)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def stats(self):
+        pools = self._adapter.poolmanager.pools
+        connections = sum(pools[key].num_connections for key in pools.keys())
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'retries': self._retries,
+                'connections': connections,
+                'reused_connections': max(self._requests - connections, 0),
+            }
+
+    def report_stats(self, out=sys.stderr):
+        out.write('MAAS transport: {requests} requests ({retries} retries), '
+                  '{connections} connections opened, '
+                  '{reused_connections} requests over reused connections\n'.
+                  format(**self.stats()))
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(token, refresh_token=None):
+    """Transport for the given API key, shared within the process. If
+    refresh_token is given, it replaces the one the transport has (see
+    set_token_refresher)"""
+    with _transports_lock:
+        transport = _transports.get(token)
+        if transport is None:
+            transport = _transports[token] = MaasTransport(
+                token, refresh_token=refresh_token)
+            if os.environ.get(STATS_ENV):
+                atexit.register(transport.report_stats)
+        elif refresh_token is not None:
+            transport.set_refresh_token(refresh_token)
+        return transport
+
+
+def set_token_refresher(token, refresh_token):
+    """Make the (shared) transport of the API key call refresh_token to
+    get a new key once MAAS rejects this one, no matter whether the
+    transport exists already"""
+    get_transport(token).set_refresh_token(refresh_token)
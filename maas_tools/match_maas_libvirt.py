@@ -4,46 +4,80 @@
 # virtual nodes. As a side effect the DNS names of MAAS nodes are set to
 # the corresponding libvirt VMs names.
 # MAAS nodes are matched to libvirt VMs by the set of MAC addresses.
+# With --watch keep doing that as VMs are defined/undefined.
 
-import json
-import oauth.oauth as oauth
-import requests
-import subprocess
-import uuid
+import os
+import sys
+import time
 
 from optparse import OptionParser
 from urlparse import urlparse
-from xml.etree import ElementTree
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from credentials import (
+    API_URL_ENV,
+    api_key_refresher,
+    get_api_key,
+)
+from libvirt_scan import (
+    DEFAULT_LIBVIRT_URL,
+    LibvirtScanner,
+    parse_macs,
+)
+from maas_api import (
+    MaasApi,
+    normalize_node,
+)
+from maas_transport import (
+    get_transport,
+    set_token_refresher,
+)
+from workers import (
+    parallel_call,
+    parallel_map,
+)
+import tracing
 
-DEFAULT_LIBVIRT_URL = 'qemu:///system'
 MAAS_HOST = '127.0.0.1'
 MAAS_USER = 'root'
 
+# --watch: re-read the nodes matching VMs that often (to catch changes
+# made via MAAS)
+MAAS_INTERVAL = 300  # seconds
+# look up VMs unknown to MAAS (yet) that often
+PENDING_INTERVAL = 5
+# look up nodes by that many MACs per request (keep the URL short)
+MAC_FILTER_BATCH = 100
+
 
 def maas_auth_headers(api_url, token=None):
-    consumer_key, key, secret = token.split(':')
-    resource_token = oauth.OAuthToken(key, secret)
-    consumer_token = oauth.OAuthConsumer(consumer_key, '')
-    oauth_request = oauth.OAuthRequest.from_consumer_and_token(
-        consumer_token,
-        token=resource_token,
-        http_url=api_url,
-        parameters={
-            'auth_nonce': uuid.uuid4().get_hex(),
-        },
-    )
-    oauth_request.sign_request(oauth.OAuthSignatureMethod_PLAINTEXT(),
-                               consumer_token,
-                               resource_token)
-    return oauth_request.to_header()
-
-
-def get_maas_nodes_by_macs(api_url, token=None):
-    url = '%s/nodes/?op=list' % api_url
-    rq = requests.get(url, headers=maas_auth_headers(api_url, token))
+    return get_transport(token).auth_headers()
+
+
+def _get_maas_nodes(api_url, token=None, macs=None):
+    params = {}
+    if macs:
+        # nodes having any of the given MACs
+        params['mac_address'] = list(macs)
+    rq = get_transport(token).get(MaasApi(api_url).nodes_url(),
+                                  params=params)
     rq.raise_for_status()
-    nodes = json.loads(rq.text)
+    return [normalize_node(node) for node in tracing.loads(rq.text, 'nodes')]
+
+
+def get_maas_nodes_by_macs(api_url, token=None, macs=None):
+    """MAAS nodes by their (sorted) MACs. If macs are given only the nodes
+    having any of those are fetched"""
+    if macs is None:
+        nodes = _get_maas_nodes(api_url, token=token)
+    else:
+        macs = sorted(set(macs))
+        batches = [macs[i:i + MAC_FILTER_BATCH]
+                   for i in range(0, len(macs), MAC_FILTER_BATCH)]
+        nodes = [node for batch in parallel_map(
+            lambda batch: _get_maas_nodes(api_url, token=token, macs=batch),
+            batches) for node in batch]
 
     def to_tuple(macset):
         return tuple(sorted(addr['mac_address'] for addr in macset))
@@ -51,40 +85,106 @@ def get_maas_nodes_by_macs(api_url, token=None):
     return dict((to_tuple(n['macaddress_set']), n) for n in nodes)
 
 
+def get_maas_power_params(api_url, token=None, system_ids=None):
+    """Power parameters of nodes by system_id (MAAS admins only)"""
+    url = MaasApi(api_url).nodes_op_url('power_parameters')
+    params = {}
+    if system_ids:
+        params['id'] = list(system_ids)
+    rq = get_transport(token).get(url, params=params)
+    rq.raise_for_status()
+    return tracing.loads(rq.text, 'power_parameters')
+
+
 def update_maas_node(system_id, params=None, api_url=None, token=None):
-    url = '%s/nodes/%s/' % (api_url, system_id)
-    auth_headers = maas_auth_headers(api_url, token)
-    rq = requests.put(url, data=params, headers=auth_headers)
+    url = MaasApi(api_url).node_url(system_id)
+    rq = get_transport(token).put(url, data=params)
     rq.raise_for_status()
 
 
+def node_power_params(node, vm_name, libvirt_conn):
+    old_hostname, domain = node['hostname'].split('.', 1)
+    return {
+        'power_parameters_power_address': libvirt_conn,
+        'power_parameters_power_id': vm_name,
+        'power_type': 'virsh',
+        'hostname': '%s.%s' % (vm_name, domain),
+    }
+
+
+def power_params_differ(node, current, params):
+    """Check if the node needs an update. current are the power
+    parameters of the node (as reported by MAAS), None if unknown"""
+    if current is None:
+        return True
+    return (node['power_type'] != params['power_type'] or
+            node['hostname'] != params['hostname'] or
+            current.get('power_address') !=
+            params['power_parameters_power_address'] or
+            current.get('power_id') != params['power_parameters_power_id'])
+
+
+def sync_power_params(maas_nodes_by_macs, vms_by_macs, libvirt_conn,
+                      current_params=None, api_url=None, token=None):
+    """Set the power parameters of MAAS nodes matching the VMs unless
+    those are already correct. current_params are the power parameters
+    of the nodes (by system_id), None if unknown (update all nodes).
+    Returns the list of updated nodes' system_ids."""
+    updated = []
+    for macset, node in maas_nodes_by_macs.iteritems():
+        vm_name = vms_by_macs.get(macset)
+        if vm_name is None:
+            continue
+        params = node_power_params(node, vm_name, libvirt_conn)
+        current = None
+        if current_params is not None:
+            current = current_params.get(node['system_id'], {})
+        if not power_params_differ(node, current, params):
+            continue
+        update_maas_node(node['system_id'], params=params,
+                         api_url=api_url, token=token)
+        node['hostname'] = params['hostname']
+        node['power_type'] = params['power_type']
+        if current_params is not None:
+            current_params[node['system_id']] = {
+                'power_address': params['power_parameters_power_address'],
+                'power_id': params['power_parameters_power_id'],
+            }
+        print("%s: set power parameters (%s)" % (node['system_id'],
+                                                 vm_name))
+        updated.append(node['system_id'])
+    return updated
+
+
+def try_get_maas_power_params(api_url, token=None, system_ids=None):
+    try:
+        return get_maas_power_params(api_url, token=token,
+                                     system_ids=system_ids)
+    except Exception as e:
+        print("failed to get power parameters, updating all nodes: %s" % e)
+        return None
+
+
 def get_maas_token(maas_host=MAAS_HOST, maas_user=MAAS_USER,
                    remote_user='ubuntu'):
-    cmd = [
-        'ssh', '%s@%s' % (remote_user, maas_host),
-        'sudo', 'maas-region-admin', 'apikey',
-        '--username=%s' % maas_user,
-    ]
-    token = subprocess.check_output(cmd).strip()
-    return token
+    return get_api_key(maas_host, user=maas_user, shell_user=remote_user)
 
 
 def get_vm_macs(name, conn=DEFAULT_LIBVIRT_URL):
-    raw_xml = subprocess.check_output(['virsh', '-c', conn, 'dumpxml', name])
-    vmxml = ElementTree.fromstring(raw_xml.strip())
-    macs = vmxml.findall("devices/interface/[@type='network']/mac")
-    return tuple(sorted(e.get('address') for e in macs))
+    raw_xml = tracing.check_output(['virsh', '-c', conn, 'dumpxml', name])
+    return parse_macs(raw_xml)
 
 
 def get_libvirt_vms_by_macs(vms, conn=DEFAULT_LIBVIRT_URL):
-    if vms is None or len(vms) == 0:
-        vms = get_libvirt_vms(conn)
-    return dict((get_vm_macs(vm, conn), vm) for vm in vms)
+    domains = LibvirtScanner(conn).scan()
+    if vms:
+        domains = [d for d in domains if d.name in vms]
+    return dict((d.macs, d.name) for d in domains)
 
 
 def get_libvirt_vms(conn='qemu:///system'):
     cmd = ['virsh', '-c', conn, '-q', 'list', '--all']
-    raw_out = subprocess.check_output(cmd).strip()
+    raw_out = tracing.check_output(cmd).strip()
     for line in raw_out.split('\n'):
         vmid, vmname, vmstate = line.split(None, 2)
         yield vmname
@@ -98,7 +198,7 @@ def verify_libvirt_connection(libvirt_conn,
     if host:
         cmd.extend(['ssh', '%s@%s' % (remote_user, host)])
     cmd.extend(['virsh', '-c', libvirt_conn, '-q', 'list', '--all'])
-    subprocess.check_output(cmd)
+    tracing.check_output(cmd)
 
 
 def set_maas_power_params(libvirt_conn=DEFAULT_LIBVIRT_URL,
@@ -106,8 +206,12 @@ def set_maas_power_params(libvirt_conn=DEFAULT_LIBVIRT_URL,
                           maas_api=None,
                           maas_host=None,
                           maas_user=MAAS_USER,
-                          maas_token=None):
+                          maas_token=None,
+                          watch=False,
+                          maas_interval=MAAS_INTERVAL):
 
+    if maas_host is None and maas_api is None:
+        maas_api = os.environ.get(API_URL_ENV)
     if maas_host is None and maas_api is None:
         maas_host = MAAS_HOST
     if maas_host is None:
@@ -116,25 +220,172 @@ def set_maas_power_params(libvirt_conn=DEFAULT_LIBVIRT_URL,
         maas_api = 'http://%s/MAAS/api/1.0' % maas_host
     if maas_token is None:
         maas_token = get_maas_token(maas_host=maas_host, maas_user=maas_user)
+        # MAAS might have rejected the cached key
+        set_token_refresher(maas_token,
+                            api_key_refresher(maas_host, maas_user))
 
     verify_libvirt_connection(libvirt_conn, host=maas_host)
 
-    # Identify the nodes by set of their MACs
-    maas_nodes_by_macs = get_maas_nodes_by_macs(maas_api, token=maas_token)
-    vms_by_macs = get_libvirt_vms_by_macs(None, local_libvirt_conn)
-    for macset, node in maas_nodes_by_macs.iteritems():
-        vm_name = vms_by_macs.get(macset)
-        if vm_name is None:
-            continue
-        old_hostname, domain = node['hostname'].split('.', 1)
-        params = {
-            'power_parameters_power_address': libvirt_conn,
-            'power_parameters_power_id': vm_name,
-            'power_type': 'virsh',
-            'hostname': '%s.%s' % (vm_name, domain),
-        }
-        update_maas_node(node['system_id'], params=params,
-                         api_url=maas_api, token=maas_token)
+    if watch:
+        watcher = PowerParamsWatcher(libvirt_conn, local_libvirt_conn,
+                                     maas_api, maas_token,
+                                     maas_interval=maas_interval)
+        watcher.run()
+        return
+
+    # Identify the nodes by set of their MACs. Scanning libvirt domains
+    # is cheap (cached), ask MAAS for the nodes having those MACs only
+    with tracing.phase('scan'):
+        vms_by_macs = get_libvirt_vms_by_macs(None, local_libvirt_conn)
+    if not vms_by_macs:
+        return
+    with tracing.phase('fetch'):
+        maas_nodes_by_macs, current_params = parallel_call(
+            lambda: get_maas_nodes_by_macs(
+                maas_api, token=maas_token,
+                macs=[mac for macs in vms_by_macs for mac in macs]),
+            lambda: try_get_maas_power_params(maas_api, token=maas_token))
+    with tracing.phase('update'):
+        sync_power_params(maas_nodes_by_macs, vms_by_macs, libvirt_conn,
+                          current_params=current_params,
+                          api_url=maas_api, token=maas_token)
+
+
+class PowerParamsWatcher(object):
+    """Keep power parameters of MAAS nodes in sync with libvirt domains
+
+    Domains are tracked via libvirt lifecycle events (or by rescanning
+    them every PENDING_INTERVAL seconds if libvirt python bindings are not
+    available). A new (or changed) domain is looked up in MAAS by its MACs,
+    and a node is updated only if its power parameters are wrong. The nodes
+    matching all the VMs are re-read once per maas_interval seconds only.
+    """
+
+    def __init__(self, libvirt_conn, local_libvirt_conn, maas_api, maas_token,
+                 maas_interval=MAAS_INTERVAL,
+                 pending_interval=PENDING_INTERVAL):
+        self.libvirt_conn = libvirt_conn
+        self.local_libvirt_conn = local_libvirt_conn
+        self.maas_api = maas_api
+        self.maas_token = maas_token
+        self.maas_interval = maas_interval
+        self.pending_interval = pending_interval
+        self.vms_by_macs = {}
+        self.macs_by_vm = {}
+        self.nodes_by_macs = {}
+        self.power_params = None
+
+    def _sync(self, nodes_by_macs):
+        sync_power_params(nodes_by_macs, self.vms_by_macs, self.libvirt_conn,
+                          current_params=self.power_params,
+                          api_url=self.maas_api, token=self.maas_token)
+
+    def refresh_maas(self):
+        # only the nodes matching the VMs are of interest
+        macs = [mac for vm_macs in self.vms_by_macs for mac in vm_macs]
+        self.nodes_by_macs, self.power_params = parallel_call(
+            lambda: get_maas_nodes_by_macs(self.maas_api,
+                                           token=self.maas_token,
+                                           macs=macs),
+            lambda: try_get_maas_power_params(self.maas_api,
+                                              token=self.maas_token))
+        self._sync(self.nodes_by_macs)
+
+    def check_pending(self):
+        """Look up the domains which have no MAAS nodes (yet)"""
+        pending = [macs for macs in self.vms_by_macs
+                   if macs not in self.nodes_by_macs]
+        if not pending:
+            return
+        nodes_by_macs = get_maas_nodes_by_macs(
+            self.maas_api, token=self.maas_token,
+            macs=[mac for macs in pending for mac in macs])
+        nodes_by_macs = dict((macs, node) for macs, node in
+                             nodes_by_macs.items() if macs in pending)
+        if not nodes_by_macs:
+            return
+        self.nodes_by_macs.update(nodes_by_macs)
+        if self.power_params is not None:
+            self.power_params.update(try_get_maas_power_params(
+                self.maas_api, token=self.maas_token,
+                system_ids=[n['system_id'] for n in nodes_by_macs.values()])
+                or {})
+        self._sync(nodes_by_macs)
+
+    def domain_defined(self, name, macs):
+        if self.macs_by_vm.get(name) == macs:
+            return
+        self.domain_undefined(name)
+        self.vms_by_macs[macs] = name
+        self.macs_by_vm[name] = macs
+        node = self.nodes_by_macs.get(macs)
+        if node is not None:
+            self._sync({macs: node})
+
+    def domain_undefined(self, name):
+        macs = self.macs_by_vm.pop(name, None)
+        if macs is not None:
+            self.vms_by_macs.pop(macs, None)
+
+    def _safely(self, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            print("%s failed: %s" % (func.__name__, e))
+
+    def run(self):
+        try:
+            import libvirt
+        except ImportError:
+            libvirt = None
+        for domain in LibvirtScanner(self.local_libvirt_conn).scan():
+            self.domain_defined(domain.name, domain.macs)
+        self.refresh_maas()
+        if libvirt is not None:
+            self._run_events(libvirt)
+        else:
+            self._run_polling()
+
+    def _run_events(self, libvirt):
+        def on_lifecycle_event(conn, dom, event, detail, opaque):
+            if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+                self.domain_undefined(dom.name())
+            elif event in (libvirt.VIR_DOMAIN_EVENT_DEFINED,
+                           libvirt.VIR_DOMAIN_EVENT_STARTED):
+                self._safely(self.domain_defined, dom.name(),
+                             parse_macs(dom.XMLDesc(0)))
+
+        libvirt.virEventRegisterDefaultImpl()
+        conn = libvirt.openReadOnly(self.local_libvirt_conn)
+        conn.domainEventRegisterAny(None,
+                                    libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                    on_lifecycle_event, None)
+        libvirt.virEventAddTimeout(
+            self.maas_interval * 1000,
+            lambda timer, opaque: self._safely(self.refresh_maas), None)
+        libvirt.virEventAddTimeout(
+            self.pending_interval * 1000,
+            lambda timer, opaque: self._safely(self.check_pending), None)
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    def _run_polling(self):
+        scanner = LibvirtScanner(self.local_libvirt_conn)
+        last_refresh = time.time()
+        while True:
+            time.sleep(self.pending_interval)
+            domains = scanner.scan()
+            names = set(domain.name for domain in domains)
+            for name in list(self.macs_by_vm):
+                if name not in names:
+                    self.domain_undefined(name)
+            for domain in domains:
+                self._safely(self.domain_defined, domain.name, domain.macs)
+            if time.time() - last_refresh >= self.maas_interval:
+                last_refresh = time.time()
+                self._safely(self.refresh_maas)
+            else:
+                self._safely(self.check_pending)
 
 
 def main():
@@ -149,13 +400,25 @@ def main():
     parser.add_option('-m', '--maas-host', dest='maas_host')
     parser.add_option('-a', '--maas-api', dest='maas_api_url')
     parser.add_option('-t', '--maas-token', dest='maas_token')
+    parser.add_option('-w', '--watch', dest='watch', action='store_true',
+                      default=False,
+                      help='keep updating MAAS as VMs are (re)defined')
+    parser.add_option('--trace', dest='trace',
+                      help='write timings of requests etc to the file')
+    parser.add_option('-i', '--maas-interval', dest='maas_interval',
+                      type='int', default=MAAS_INTERVAL,
+                      help='with --watch re-read the nodes from MAAS every '
+                      'MAAS_INTERVAL seconds [%default]')
     options, vms = parser.parse_args()
+    tracing.enable(options.trace)
     set_maas_power_params(libvirt_conn=options.libvirt_conn,
                           local_libvirt_conn=options.local_libvirt_conn,
                           maas_api=options.maas_api_url,
                           maas_host=options.maas_host,
                           maas_user=options.maas_user,
-                          maas_token=options.maas_token)
+                          maas_token=options.maas_token,
+                          watch=options.watch,
+                          maas_interval=options.maas_interval)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,179 @@
+
+# encoding: utf-8
+# Decode the nodes listing incrementally into compact records. The full
+# listing of a large fleet (with interface_set, physicalblockdevice_set,
+# etc of every node) takes hundreds of MB as nested dicts, while the tools
+# need a dozen of fields. Nodes are parsed one at a time as the response
+# is being read, and only the records are kept.
+
+import codecs
+import json
+
+import tracing
+
+from maas_api import normalize_node
+
+CHUNK_SIZE = 64 * 1024
+# drives are kept only if tagged for ansible (ansible_osd_data, etc):
+# MAAS tags every block device as rotary or ssd by itself
+MANAGED_TAG_PREFIX = 'ansible_'
+
+_WHITESPACE = ' \t\n\r'
+
+
+def iter_json_array(chunks):
+    """Yield the elements of a JSON array given as an iterable of text
+    chunks, without holding the whole document (nor all the elements)"""
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    started = False
+    exhausted = False
+
+    while True:
+        while pos < len(buf) and buf[pos] in _WHITESPACE:
+            pos += 1
+        item = end = None
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('expected a JSON array')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            if buf[pos] == ',':
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # incomplete element (or a malformed one, which fails
+                # again once the input is exhausted)
+                if exhausted:
+                    raise
+            # an element ending right at the end of the buffer might be
+            # truncated (say, a number), parse it again with more data
+            if end is not None and (end < len(buf) or exhausted):
+                pos = end
+                yield item
+                continue
+        if exhausted:
+            raise ValueError('truncated JSON array')
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+        else:
+            buf = buf[pos:] + chunk
+            pos = 0
+
+
+def iter_response_text(rq, chunk_size=CHUNK_SIZE):
+    """Text chunks of a (streamed) requests' response"""
+    decoder = codecs.getincrementaldecoder(rq.encoding or 'utf-8')()
+    for chunk in rq.iter_content(chunk_size):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def _intern(s):
+    # fabric names, CIDRs, tags, etc repeat across the fleet
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return intern(s) if s is not None else None
+
+
+class Link(object):
+    __slots__ = ('id', 'mode', 'ip_address', 'subnet_id', 'cidr', 'fabric')
+
+    def __init__(self, link):
+        subnet = link.get('subnet') or {}
+        self.id = link.get('id')
+        self.mode = _intern(link.get('mode'))
+        self.ip_address = link.get('ip_address')
+        self.subnet_id = subnet.get('id')
+        self.cidr = _intern(subnet.get('cidr'))
+        self.fabric = _intern((subnet.get('vlan') or {}).get('fabric'))
+
+
+class Interface(object):
+    __slots__ = ('name', 'mac_address', 'resource_uri', 'links')
+
+    def __init__(self, iface):
+        self.name = _intern(iface['name'])
+        self.mac_address = iface.get('mac_address')
+        self.resource_uri = iface.get('resource_uri')
+        self.links = tuple(Link(link) for link in iface.get('links', ()))
+
+
+class Drive(object):
+    __slots__ = ('id_path', 'name', 'model', 'size', 'tags', 'resource_uri')
+
+    def __init__(self, drive):
+        self.id_path = drive.get('id_path')
+        self.name = drive.get('name')
+        self.model = _intern(drive.get('model'))
+        self.size = drive.get('size')
+        self.tags = tuple(_intern(tag) for tag in drive.get('tags', ()))
+        self.resource_uri = drive.get('resource_uri')
+
+
+def is_managed_drive(drive):
+    return any(tag.startswith(MANAGED_TAG_PREFIX)
+               for tag in drive.get('tags', ()))
+
+
+class NodeRecord(object):
+    """The fields of a node the tools actually use. Only the drives having
+    ansible_* tags are kept"""
+
+    __slots__ = ('system_id', 'hostname', 'tag_names', 'macs', 'power_type',
+                 'osystem', 'distro_series', 'status', 'pxe_mac',
+                 'interfaces', 'drives')
+
+    def __init__(self, node):
+        node = normalize_node(node)
+        self.system_id = node['system_id']
+        self.hostname = node['hostname']
+        self.tag_names = tuple(_intern(tag) for tag in node['tag_names'])
+        self.macs = tuple(m['mac_address'] for m in node['macaddress_set'])
+        self.power_type = _intern(node.get('power_type'))
+        self.osystem = _intern(node.get('osystem'))
+        self.distro_series = _intern(node.get('distro_series'))
+        self.status = _intern(node.get('substatus_name'))
+        self.pxe_mac = (node.get('pxe_mac') or {}).get('mac_address')
+        self.interfaces = tuple(Interface(iface)
+                                for iface in node.get('interface_set', ()))
+        self.drives = tuple(Drive(drive) for drive in
+                            node.get('physicalblockdevice_set', ())
+                            if is_managed_drive(drive))
+
+    @property
+    def links(self):
+        return [(iface, link) for iface in self.interfaces
+                for link in iface.links]
+
+    @property
+    def ip_addresses(self):
+        return sorted(link.ip_address for iface, link in self.links
+                      if link.ip_address is not None)
+
+
+def fetch_node_records(transport, url, params=None):
+    """GET the nodes listing and decode it into NodeRecords on the fly"""
+    rq = transport.get(url, params=params, stream=True)
+    try:
+        rq.raise_for_status()
+        with tracing.span('decode', 'node_records') as span:
+            records = [NodeRecord(node) for node in
+                       iter_json_array(iter_response_text(rq))]
+            span.set(nodes=len(records))
+        return records
+    finally:
+        rq.close()
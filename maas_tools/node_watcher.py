@@ -0,0 +1,162 @@
+
+# encoding: utf-8
+# Wait for many nodes to reach their target states at once: a single
+# (filtered) nodes listing per tick instead of polling every node
+
+import time
+
+DONE = 'done'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+
+# the node won't get to the target state without a human intervention
+FAILED_STATES = (
+    'Broken',
+    'Failed commissioning',
+    'Failed deployment',
+    'Failed disk erasing',
+    'Failed releasing',
+    'Failed testing',
+)
+
+MIN_INTERVAL = 3  # seconds
+MAX_INTERVAL = 60
+BACKOFF = 1.5
+# poll as often as possible when a node has been busy for that fraction
+# of the typical time it takes a node to reach the target state
+EXPECTED_COMPLETION = 0.8
+
+
+def node_state(node):
+    return node['substatus_name']
+
+
+class Target(object):
+    def __init__(self, system_id, state, timeout=None):
+        self.system_id = system_id
+        self.state = state
+        self.started = time.time()
+        self.deadline = self.started + timeout if timeout else None
+        self.last_state = None
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+
+class NodeWatcher(object):
+    """Track a set of nodes (system_ids) and their target states
+
+    The polling interval adapts: it's short after some node has changed its
+    state, or is about to complete (judging by how long it took the nodes
+    which have already completed), and grows up to max_interval otherwise
+    (say, while nodes are installing the OS).
+    """
+
+    def __init__(self, client, min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL, backoff=BACKOFF, verbose=True):
+        self._client = client
+        self._min_interval = min_interval
+        self._max_interval = max(max_interval, min_interval)
+        self._backoff = backoff
+        self._verbose = verbose
+        self._interval = min_interval
+        self._targets = {}
+        self._durations = []
+
+    def __len__(self):
+        return len(self._targets)
+
+    def add(self, system_id, state, timeout=None):
+        self._targets[system_id] = Target(system_id, state, timeout=timeout)
+        self._interval = self._min_interval
+
+    def remove(self, system_id):
+        self._targets.pop(system_id, None)
+
+    def _expected_duration(self):
+        if not self._durations:
+            return None
+        durations = sorted(self._durations)
+        return durations[len(durations) // 2]
+
+    def _adapt_interval(self, changed):
+        expected = self._expected_duration()
+        about_to_complete = expected is not None and any(
+            t.elapsed >= EXPECTED_COMPLETION * expected
+            for t in self._targets.values())
+        if changed or about_to_complete:
+            self._interval = self._min_interval
+        else:
+            self._interval = min(self._interval * self._backoff,
+                                 self._max_interval)
+
+    def next_interval(self):
+        interval = self._interval
+        deadlines = [t.deadline for t in self._targets.values()
+                     if t.deadline is not None]
+        if deadlines:
+            interval = min(interval, max(min(deadlines) - time.time(), 0))
+        return interval
+
+    def sleep(self):
+        time.sleep(self.next_interval())
+
+    def poll(self):
+        """Check the nodes once. Returns the list of (system_id, node, status)
+        of the nodes which are done with (status being DONE, FAILED, or
+        TIMEOUT), those are not tracked any more"""
+        if not self._targets:
+            return []
+        nodes = self._client.nodes(system_ids=list(self._targets))
+        nodes_by_id = dict((node['system_id'], node) for node in nodes)
+        finished = []
+        changed = False
+        for system_id, target in list(self._targets.items()):
+            node = nodes_by_id.get(system_id)
+            state = node_state(node) if node is not None else None
+            if state != target.last_state:
+                changed = True
+                if self._verbose:
+                    print("node {0}: {state} (waiting for {want_state})".
+                          format(system_id, state=state,
+                                 want_state=target.state))
+                target.last_state = state
+            if state == target.state:
+                status = DONE
+                self._durations.append(target.elapsed)
+            elif state in FAILED_STATES or node is None:
+                status = FAILED
+            elif target.deadline is not None and \
+                    time.time() >= target.deadline:
+                status = TIMEOUT
+            else:
+                continue
+            del self._targets[system_id]
+            finished.append((system_id, node, status))
+        self._adapt_interval(changed)
+        return finished
+
+    def expire(self):
+        """Stop tracking the nodes past their deadlines without checking
+        them (say, when MAAS can't be reached). Returns the list of
+        (system_id, None, TIMEOUT) of such nodes"""
+        now = time.time()
+        expired = [system_id for system_id, target in self._targets.items()
+                   if target.deadline is not None and now >= target.deadline]
+        for system_id in expired:
+            del self._targets[system_id]
+        return [(system_id, None, TIMEOUT) for system_id in expired]
+
+    def watch(self, timeout=None, callback=None):
+        """Yield (system_id, node, status) as the nodes are done with.
+        callback(system_id, node, status) is called for every node too"""
+        if timeout is not None:
+            for target in self._targets.values():
+                target.deadline = target.started + timeout
+        while self._targets:
+            self.sleep()
+            for system_id, node, status in self.poll():
+                if callback is not None:
+                    callback(system_id, node, status)
+                yield system_id, node, status
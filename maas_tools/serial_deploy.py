@@ -1,10 +1,8 @@
 #!/usr/bin/env python
 # encoding: utf-8
-# deploy (or comission) nodes one by one
+# deploy (or comission) nodes one by one, or several at once (--parallel)
 
-import json
 import os
-import requests
 import sys
 import time
 
@@ -12,85 +10,317 @@ from optparse import OptionParser
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+from maas_api import normalize_node
 from maas_base_client import MaasBaseClient
+from node_watcher import (
+    DONE,
+    FAILED,
+    TIMEOUT,
+    NodeWatcher,
+    node_state,
+)
+import tracing
 
 NEW = 'New'
 READY = 'Ready'
 DEPLOYED = 'Deployed'
 ALLOCATED = 'Allocated'
 
+PENDING = 'pending'
 
-def node_state(node):
-    return node['substatus_name']
+NODE_TIMEOUT = 3600  # seconds
 
 
 class MaasClient(MaasBaseClient):
 
     def commission(self, system_id, **kwargs):
-        url = '%s/nodes/%s/?op=commission' % (self._api_url, system_id)
-        rq = requests.post(url, headers=self._auth())
+        url = self._api.node_url(system_id, 'commission')
+        rq = self._transport.post(url)
         rq.raise_for_status()
 
-    def _acquire(self, system_ids):
-        url = '%s/nodes/?op=acquire' % self._api_url
-        rq = requests.post(url, data={'nodes': system_ids},
-                           headers=self._auth())
+    def release(self, system_id):
+        url = self._api.node_url(system_id, 'release')
+        rq = self._transport.post(url)
         rq.raise_for_status()
+
+    def _release_all(self, system_ids):
+        """Give back the nodes allocated by a failed _acquire, keep going
+        if some of them can't be released"""
         for system_id in system_ids:
-            self.wait_for(system_id, ALLOCATED, interval=3)
+            try:
+                self.release(system_id)
+            except Exception as e:
+                print("%s: failed to release: %s" % (system_id, e))
+
+    def _acquire(self, system_ids):
+        """Allocate the nodes. MAAS replies with the allocated node, so
+        its state is checked right away instead of waiting for it"""
+        url = self._api.nodes_op_url('acquire')
+        allocated = []
+        if self._api.v2:
+            # MAAS 2.0 allocates a single machine at a time, don't leave
+            # the first ones allocated if a later one can't be
+            try:
+                for system_id in system_ids:
+                    rq = self._transport.post(url,
+                                              data={'system_id': system_id})
+                    rq.raise_for_status()
+                    allocated.extend(acquired_nodes(rq.text))
+            except Exception:
+                self._release_all([node.get('system_id')
+                                   for node in allocated])
+                raise
+        else:
+            rq = self._transport.post(url, data={'nodes': system_ids})
+            rq.raise_for_status()
+            allocated.extend(acquired_nodes(rq.text))
+        states = dict((node.get('system_id'), node_state(node))
+                      for node in allocated)
+        failed = [system_id for system_id in system_ids
+                  if states.get(system_id) != ALLOCATED]
+        if failed:
+            self._release_all([system_id for system_id in system_ids
+                               if states.get(system_id) == ALLOCATED])
+            raise RuntimeError("failed to allocate %s" % ', '.join(failed))
 
     def _deploy(self, system_id, **kwargs):
-        url = '%s/nodes/%s/?op=start' % (self._api_url, system_id)
-        rq = requests.post(url, data=kwargs, headers=self._auth())
+        url = self._api.node_url(system_id, 'start')
+        rq = self._transport.post(url, data=kwargs)
         rq.raise_for_status()
 
     def deploy(self, system_id, **kwargs):
         self._acquire([system_id])
         self._deploy(system_id, **kwargs)
 
-    def wait_for(self, system_id, state, interval=10):
-        url = '%s/nodes/%s/' % (self._api_url, system_id)
-        while True:
-            rq = requests.get(url, headers=self._auth())
-            rq.raise_for_status()
-            node = json.loads(rq.text)
-            if node_state(node) == state:
-                return True
-            print("waiting for node {0} {want_state} (now: {state})".
-                  format(system_id, want_state=state, state=node_state(node)))
-            time.sleep(interval)
-        return False
+    def wait_for(self, system_id, state, interval=10, timeout=None):
+        return self.wait_for_all([system_id], state, interval=interval,
+                                 timeout=timeout)
+
+    def wait_for_all(self, system_ids, state, interval=10, timeout=None):
+        """Wait for all nodes to get to the state, returns False if some
+        node has failed (or timed out) instead"""
+        watcher = NodeWatcher(self, min_interval=interval)
+        for system_id in system_ids:
+            watcher.add(system_id, state, timeout=timeout)
+        return all(status == DONE
+                   for _, _, status in watcher.watch(timeout=timeout))
+
+    def apply(self, action, initial_state, final_state, interval=10,
+              window=1, per_fabric=None, timeout=NODE_TIMEOUT, filters=None):
+        """Apply the action to the nodes in initial_state (and matching
+        the filters, see MaasBaseClient.nodes)"""
+        # MAAS can't filter by the state, but can by hostname, zone, etc
+        nodes = [n for n in self.nodes(**(filters or {}))
+                 if node_state(n) == initial_state]
+        scheduler = DeployScheduler(self, action, final_state,
+                                    window=window,
+                                    per_fabric=per_fabric,
+                                    timeout=timeout,
+                                    interval=interval)
+        results = scheduler.run(nodes)
+        print_summary(results)
+        return results
 
     def serial_apply(self, action, initial_state, final_state, interval=10):
-        nodes = (n for n in self.nodes() if node_state(n) == initial_state)
-        for node in nodes:
-            action(node)
-            self.wait_for(node['system_id'], final_state, interval=interval)
+        return self.apply(action, initial_state, final_state,
+                          interval=interval)
+
+    def commission_all(self, window=1, per_fabric=None,
+                       timeout=NODE_TIMEOUT, filters=None, **kwargs):
+        def commission(node):
+            system_id = node['system_id']
+            hostname = node['hostname']
+            print("start commissioning %s (%s)" % (hostname, system_id))
+            self.commission(system_id, **kwargs)
 
-    def commission_all(self, **kwargs):
-        self.serial_apply(lambda node: self.commission, NEW, READY)
+        return self.apply(commission, NEW, READY, window=window,
+                          per_fabric=per_fabric, timeout=timeout,
+                          filters=filters)
 
-    def deploy_all(self, **kwargs):
+    def deploy_all(self, window=1, per_fabric=None,
+                   timeout=NODE_TIMEOUT, filters=None, **kwargs):
         def deploy(node):
             system_id = node['system_id']
             hostname = node['hostname']
             print("start deploying %s (%s)" % (hostname, system_id))
             self.deploy(system_id, **kwargs)
 
-        self.serial_apply(deploy, READY, DEPLOYED)
+        return self.apply(deploy, READY, DEPLOYED, window=window,
+                          per_fabric=per_fabric, timeout=timeout,
+                          filters=filters)
+
+
+class NodeResult(object):
+    def __init__(self, node):
+        self.hostname = node['hostname']
+        self.system_id = node['system_id']
+        self.fabric = node_fabric(node)
+        self.started = None
+        self.finished = None
+        self.status = PENDING
+        self.error = None
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    def finish(self, status, error=None):
+        self.finished = time.time()
+        self.status = status
+        self.error = error
+
+
+class DeployScheduler(object):
+    """Apply the action (deploy, commission) to nodes keeping at most
+    `window` nodes in flight (at most `per_fabric` nodes per a fabric so
+    the PXE/TFTP servers are not overloaded), and wait for every node to
+    reach the final state. A node failing (or not getting to the final
+    state within `timeout` seconds) does not stop the others.
+    All nodes in flight are checked with a single request (NodeWatcher)."""
+
+    def __init__(self, client, action, final_state, window=1,
+                 per_fabric=None, timeout=NODE_TIMEOUT, interval=10):
+        self._client = client
+        self._action = action
+        self._final_state = final_state
+        self._window = max(window, 1)
+        self._per_fabric = max(per_fabric, 1) if per_fabric else None
+        self._timeout = timeout
+        self._watcher = NodeWatcher(client, min_interval=interval)
+
+    def _can_start(self, result, in_flight):
+        if len(in_flight) >= self._window:
+            return False
+        if self._per_fabric is None:
+            return True
+        same_fabric = [r for r in in_flight.values()
+                       if r.fabric == result.fabric]
+        return len(same_fabric) < self._per_fabric
+
+    def _start_nodes(self, pending, in_flight):
+        for node, result in list(pending):
+            if not self._can_start(result, in_flight):
+                continue
+            pending.remove((node, result))
+            result.started = time.time()
+            try:
+                self._action(node)
+            except Exception as e:
+                print("%s: failed to start: %s" % (result.hostname, e))
+                result.finish(FAILED, error=str(e))
+                continue
+            in_flight[result.system_id] = result
+            self._watcher.add(result.system_id, self._final_state,
+                              timeout=self._timeout)
+
+    def _poll(self, in_flight):
+        try:
+            finished = self._watcher.poll()
+        except Exception as e:
+            # might be a transient error, keep waiting until timeout (the
+            # deadlines still apply, MAAS might be down for good)
+            print("failed to get the nodes states: %s" % e)
+            finished = self._watcher.expire()
+        for system_id, node, status in finished:
+            result = in_flight.pop(system_id)
+            error = None
+            if status != DONE:
+                error = 'last state: %s' % (node_state(node) if node
+                                            else 'unknown')
+            result.finish(status, error=error)
+            print("%s: %s in %d seconds" % (result.hostname, result.status,
+                                            result.elapsed))
+
+    def run(self, nodes):
+        results = [NodeResult(node) for node in nodes]
+        pending = list(zip(nodes, results))
+        in_flight = {}
+        while pending or in_flight:
+            self._start_nodes(pending, in_flight)
+            if not in_flight:
+                continue
+            self._watcher.sleep()
+            self._poll(in_flight)
+        return results
+
+
+def acquired_nodes(text):
+    """Nodes in the reply to acquire (a single node or a list of them)"""
+    nodes = tracing.loads(text, 'nodes')
+    if isinstance(nodes, dict):
+        nodes = [nodes]
+    return [normalize_node(node) for node in nodes]
+
+
+def node_fabric(node):
+    """Fabric the node boots (PXE) from"""
+    pxe_mac = (node.get('pxe_mac') or {}).get('mac_address')
+    for iface in node.get('interface_set', []):
+        if iface['mac_address'] != pxe_mac:
+            continue
+        for link in iface['links']:
+            # New nodes often have no subnet on the PXE link yet
+            fabric = (link.get('subnet') or {}).get('vlan', {}).get('fabric')
+            if fabric is not None:
+                return fabric
+    return None
+
+
+def print_summary(results):
+    fmt = '{0:<32} {1:<12} {2:<8} {3:>8}  {4}'
+    print(fmt.format('HOST', 'SYSTEM ID', 'STATUS', 'ELAPSED', ''))
+    for r in results:
+        print(fmt.format(r.hostname, r.system_id, r.status,
+                         '%d' % r.elapsed, r.error or ''))
+    failed = [r for r in results if r.status != DONE]
+    print("%d nodes done, %d failed" % (len(results) - len(failed),
+                                        len(failed)))
 
 
 def main():
     parser = OptionParser()
     parser.add_option('-m', '--maas-host', dest='maas_host')
     parser.add_option('-u', '--maas-user', dest='maas_user')
-    parser.add_option('-n', '--node', dest='node')
+    parser.add_option('-n', '--node', dest='nodes', action='append',
+                      help='only this node (hostname), can be repeated')
+    parser.add_option('-z', '--zone', dest='zone',
+                      help='only the nodes in this zone')
     parser.add_option('-r', '--release', dest='os_release')
     parser.add_option('-k', '--kernel', dest='kernel', default='hwe-x')
+    parser.add_option('-C', '--commission', dest='commission',
+                      action='store_true', default=False,
+                      help='commission new nodes instead of deploying')
+    parser.add_option('-p', '--parallel', dest='window', type=int, default=1,
+                      help='max number of nodes being deployed at once')
+    parser.add_option('-f', '--per-fabric', dest='per_fabric', type=int,
+                      help='max number of nodes being deployed at once '
+                      'per a fabric')
+    parser.add_option('-t', '--timeout', dest='timeout', type=int,
+                      default=NODE_TIMEOUT,
+                      help='give up waiting for a node after that many '
+                      'seconds')
+    parser.add_option('--trace', dest='trace',
+                      help='write timings of requests etc to the file')
     options, args = parser.parse_args()
+    tracing.enable(options.trace)
     maas_client = MaasClient(host=options.maas_host, user=options.maas_user)
-    maas_client.deploy_all(distro_series=options.os_release,
-                           hwe_kernel=options.kernel)
+    filters = {'hostname': options.nodes, 'zone': options.zone}
+    if options.commission:
+        results = maas_client.commission_all(window=options.window,
+                                             per_fabric=options.per_fabric,
+                                             timeout=options.timeout,
+                                             filters=filters)
+    else:
+        results = maas_client.deploy_all(window=options.window,
+                                         per_fabric=options.per_fabric,
+                                         timeout=options.timeout,
+                                         filters=filters,
+                                         distro_series=options.os_release,
+                                         hwe_kernel=options.kernel)
+    if any(r.status != DONE for r in results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -1,57 +1,120 @@
 
 import os
 import subprocess
+import threading
+import time
+
+import tracing
+
+from known_hosts import (
+    KNOWN_HOSTS_FILE,
+    KnownHosts,
+)
+from workers import CONCURRENCY, parallel_map
 
-KNOWN_HOSTS_FILE = os.path.expanduser('~/.ssh/known_hosts')
 SSH_KEYSCAN_TIMEOUT = 10
+# in the order of preference
+SSH_KEY_TYPES = ('ed25519', 'ecdsa', 'rsa')
+# ssh-keyscan connects to all hosts in the batch at once
+SSH_KEYSCAN_BATCH = 64
 
 
 def check_ssh_known_host(name_or_ip, known_hosts_file=KNOWN_HOSTS_FILE):
     """Check if the known_hosts_file contains ssh key of the given host"""
-    try:
-        subprocess.check_call(['ssh-keygen', '-F', name_or_ip,
-                               '-f', known_hosts_file])
-        return True
-    except subprocess.CalledProcessError as e:
-        if e.returncode == 1:
-            return False
-        else:
-            raise
+    return name_or_ip in KnownHosts(known_hosts_file)
 
 
 def remove_ssh_known_host(name_or_ip, known_hosts_file=KNOWN_HOSTS_FILE):
     """Remove ssh keys of the given host from known_hosts_file"""
     if not known_hosts_file:
-        known_hosts_file = os.path.expanduser('~/.ssh/known_hosts')
-    while check_ssh_known_host(name_or_ip, known_hosts_file=known_hosts_file):
-        subprocess.call(['ssh-keygen', '-f', known_hosts_file,
-                         '-R', name_or_ip])
+        known_hosts_file = KNOWN_HOSTS_FILE
+    known_hosts = KnownHosts(known_hosts_file)
+    known_hosts.remove(name_or_ip)
+    known_hosts.commit()
+
+
+def _key_type_rank(key):
+    key_type = key.split(None, 1)[0]
+    for rank, name in enumerate(SSH_KEY_TYPES):
+        if name in key_type:
+            return rank
+    return len(SSH_KEY_TYPES)
+
+
+def _keyscan_batch(addrs, key_types, timeout, deadline):
+    """Run a single ssh-keyscan for all addrs, returns the output lines.
+    ssh-keyscan is killed when the deadline passes, the keys obtained
+    so far are returned anyway"""
+    cmd = ['ssh-keyscan', '-T', str(timeout), '-t', ','.join(key_types),
+           '-f', '-']
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=devnull)
+    killer = None
+    if deadline is not None:
+        killer = threading.Timer(max(deadline - time.time(), 0), proc.kill)
+        killer.start()
+    try:
+        with tracing.span('subprocess', 'ssh-keyscan', hosts=len(addrs)):
+            out, _ = proc.communicate('\n'.join(addrs) + '\n')
+    finally:
+        if killer is not None:
+            killer.cancel()
+    return out.splitlines()
+
+
+def scan_ssh_host_keys(addrs, key_types=SSH_KEY_TYPES,
+                       timeout=SSH_KEYSCAN_TIMEOUT, concurrency=CONCURRENCY,
+                       deadline=None, batch_size=SSH_KEYSCAN_BATCH):
+    """Get host keys of many hosts at once. Addresses are scanned in batches
+    of batch_size (a single ssh-keyscan per batch), at most `concurrency`
+    batches at a time. deadline (time.time() based) limits the whole scan.
+    Returns a dict {addr: [key, ...]} (keys are 'type base64-data', the most
+    preferred type first), unreachable hosts are not included"""
+    addrs = sorted(set(addrs))
+    batches = [addrs[i:i + batch_size]
+               for i in range(0, len(addrs), batch_size)]
+    outputs = parallel_map(
+        lambda batch: _keyscan_batch(batch, key_types, timeout, deadline),
+        batches, concurrency=concurrency)
+    keys = {}
+    for line in (line for out in outputs for line in out):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        addr, _, key = line.partition(' ')
+        if key and key not in keys.get(addr, []):
+            keys.setdefault(addr, []).append(key)
+    for addr_keys in keys.values():
+        addr_keys.sort(key=_key_type_rank)
+    return keys
 
 
 def get_ssh_host_key(ips, hostname, timeout=SSH_KEYSCAN_TIMEOUT):
+    keys = scan_ssh_host_keys(ips, timeout=timeout)
     for ip in ips:
-        cmd = ['ssh-keyscan', '-t', 'rsa', '-T', str(timeout),
-               '{ip},{hostname}'.format(ip=ip, hostname=hostname)]
-        try:
-            out = subprocess.check_output(cmd).strip()
-        except subprocess.CalledProcessError:
-            continue
-        if len(out) == 0:
-            continue
-        hostids, prefix, key_data = out.partition('ssh-rsa')
-        return prefix + key_data
+        if keys.get(ip):
+            return keys[ip][0]
     return None
 
 
 def update_ssh_known_hosts(ips, hostname, ssh_key=None,
-                           known_hosts_file=KNOWN_HOSTS_FILE):
-    remove_ssh_known_host(hostname)
+                           known_hosts_file=KNOWN_HOSTS_FILE,
+                           known_hosts=None):
+    """ssh_key is either a single key or a list of keys (of different
+    types) of the host. If known_hosts (KnownHosts) is given the changes
+    are only queued, and the caller is supposed to commit() them (say,
+    once for all nodes)"""
+    commit = known_hosts is None
+    if known_hosts is None:
+        known_hosts = KnownHosts(known_hosts_file)
+    known_hosts.remove(hostname)
     for ip in ips:
-        remove_ssh_known_host(ip)
-    if ssh_key is None:
-        return
-    with open(known_hosts_file, 'a') as f:
+        known_hosts.remove(ip)
+    if ssh_key:
+        ssh_keys = [ssh_key] if isinstance(ssh_key, basestring) else ssh_key
         for ip in ips:
-            f.write('{hostname},{ip} {ssh_key}\n'.
-                    format(ssh_key=ssh_key, ip=ip, hostname=hostname))
-        f.flush()
+            for key in ssh_keys:
+                known_hosts.add([hostname, ip], key)
+    if commit:
+        known_hosts.commit()
@@ -0,0 +1,189 @@
+
+# encoding: utf-8
+# Where does the time go: spans around MAAS requests (endpoint templates,
+# status, bytes, latency), subprocesses (ssh, virsh, ssh-keyscan), JSON
+# decoding, and the phases of a run, written as JSON lines. Enabled by
+# MAAS_TRACE=FILE (or --trace FILE of the tools), '-' means stderr.
+# Costs a single check per span when disabled. A summary of the top spans
+# by cumulative time is printed to stderr on exit.
+
+import atexit
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from urlparse import urlparse
+
+TRACE_ENV = 'MAAS_TRACE'
+TOP_SPANS = 10
+
+_ID_RE = re.compile(r'/\d+(?=/|$)')
+_SYSTEM_ID_RE = re.compile(r'/(nodes|machines)/[^/]+(?=/|$)')
+_TAG_RE = re.compile(r'/tags/[^/]+(?=/|$)')
+_API_PREFIX_RE = re.compile(r'^.*/api/[\d.]+')
+
+
+def endpoint_template(url, params=None):
+    """'/nodes/{system_id}/blockdevices/{id}/?op=add_tag' style name
+    of the endpoint, so that requests can be aggregated"""
+    parsed = urlparse(url)
+    path = _API_PREFIX_RE.sub('', parsed.path.replace('//', '/'))
+    path = _SYSTEM_ID_RE.sub(r'/\1/{system_id}', path)
+    path = _TAG_RE.sub('/tags/{tag}', path)
+    path = _ID_RE.sub('/{id}', path)
+    op = None
+    if params and 'op' in params:
+        op = params['op']
+    elif 'op=' in parsed.query:
+        op = re.search(r'(?:^|&)op=([^&]*)', parsed.query).group(1)
+    if op:
+        path = '%s?op=%s' % (path, op)
+    return path
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    def __init__(self, tracer, kind, name, fields):
+        self._tracer = tracer
+        self.kind = kind
+        self.name = name
+        self.fields = fields
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.time() - self.started
+        if exc_type is not None:
+            self.fields['error'] = '%s: %s' % (exc_type.__name__, exc)
+        self._tracer.record(self, duration)
+        return False
+
+
+class Tracer(object):
+    def __init__(self, out):
+        self._out = out
+        self._lock = threading.Lock()
+        self._totals = {}
+        self.started = time.time()
+
+    def record(self, span, duration):
+        line = dict(span.fields)
+        line.update({
+            'kind': span.kind,
+            'name': span.name,
+            'start': round(span.started - self.started, 6),
+            'duration': round(duration, 6),
+            'thread': threading.current_thread().name,
+        })
+        data = json.dumps(line, sort_keys=True) + '\n'
+        with self._lock:
+            self._out.write(data)
+            count, total = self._totals.get((span.kind, span.name), (0, 0))
+            self._totals[(span.kind, span.name)] = (count + 1,
+                                                    total + duration)
+
+    def summary(self, top=TOP_SPANS):
+        """[(kind, name, count, cumulative time)], the longest first"""
+        with self._lock:
+            totals = [(kind, name, count, total) for (kind, name), (
+                count, total) in self._totals.items()]
+        totals.sort(key=lambda t: t[3], reverse=True)
+        return totals[:top]
+
+    def close(self):
+        elapsed = time.time() - self.started
+        summary = self.summary()
+        with self._lock:
+            self._out.write(json.dumps({
+                'kind': 'summary',
+                'duration': round(elapsed, 6),
+                'top': [dict(kind=kind, name=name, count=count,
+                             total=round(total, 6))
+                        for kind, name, count, total in summary],
+            }, sort_keys=True) + '\n')
+            self._out.flush()
+        report = ['trace: %.3fs total, top spans by cumulative time:' %
+                  elapsed]
+        for kind, name, count, total in summary:
+            report.append('  %8.3fs %6d x %-10s %s' % (total, count, kind,
+                                                       name))
+        sys.stderr.write('\n'.join(report) + '\n')
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def enable(path=None):
+    """Start tracing to the file (MAAS_TRACE if path is not given).
+    Does nothing if neither is set or tracing is already enabled"""
+    global _tracer
+    path = path or os.environ.get(TRACE_ENV)
+    if not path:
+        return
+    with _tracer_lock:
+        if _tracer is not None:
+            return
+        if path == '-':
+            out = sys.stderr
+        else:
+            out = open(path, 'a', 1)
+        _tracer = Tracer(out)
+        atexit.register(_tracer.close)
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(kind, name, **fields):
+    """Context manager timing the block, fields are added to the record
+    (more can be added with .set() within the block)"""
+    if _tracer is None:
+        return _NULL_SPAN
+    return Span(_tracer, kind, name, fields)
+
+
+def phase(name):
+    return span('phase', name)
+
+
+def loads(text, what='json'):
+    """json.loads() accounted as decoding of `what`"""
+    with span('decode', what, bytes=len(text)):
+        return json.loads(text)
+
+
+def check_output(cmd, **kwargs):
+    """subprocess.check_output() accounted under the command name"""
+    if _tracer is None:
+        return subprocess.check_output(cmd, **kwargs)
+    with span('subprocess', os.path.basename(cmd[0])) as s:
+        out = subprocess.check_output(cmd, **kwargs)
+        s.set(bytes=len(out))
+        return out
+
+
+enable()
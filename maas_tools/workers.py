@@ -0,0 +1,30 @@
+
+# encoding: utf-8
+# Run independent (I/O bound) calls concurrently in a bounded thread pool
+
+CONCURRENCY = 8
+# ThreadPool.map() can't be interrupted with Ctrl-C unless a timeout is given
+WAIT_FOREVER = 365 * 24 * 3600
+
+
+def parallel_map(func, items, concurrency=CONCURRENCY):
+    """Same as map(func, items), but func is called concurrently in at most
+    `concurrency` threads. Results are returned in the order of items, and
+    the first exception raised by func is re-raised."""
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(concurrency, len(items)))
+    try:
+        return pool.map_async(func, items, chunksize=1).get(WAIT_FOREVER)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parallel_call(*funcs, **kwargs):
+    """Call the given functions (without arguments) concurrently,
+    return the list of their results"""
+    concurrency = kwargs.get('concurrency', len(funcs))
+    return parallel_map(lambda func: func(), funcs, concurrency=concurrency)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Reprovision VMs from a golden image instead of writing the root file
+# system into every VM's disk. The golden image is prepared once per
+# root file system image (partition table copied from a VM disk, rootfs
+# written at the given offset, checked and resized), after that
+# provisioning a VM takes constant time whatever the image size:
+#
+#  - LVM backed disks become thin snapshots of the golden LV (which must
+#    be in the same thin pool), the old disk LV is renamed to
+#    <name>_<timestamp> and kept as a backup
+#  - file backed disks become reflink copies of the golden file (sparse
+#    copies if the file system can't reflink), the old file is renamed
+#    the same way
+#
+# Clones are as big as the golden image (or as the old disk, whichever is
+# bigger), cloud-init grows the root partition on the first boot.
+#
+# The VMs are shut down and started by separate commands, so that virsh
+# runs as the user owning the VMs (with the user's libvirt URI) while the
+# disks are cloned as root:
+#
+#   provision_vms.py prepare -i trusty.rootfs -O 1048576 \
+#       -t /dev/vg/vm1-os /dev/vg/golden-20160713
+#   provision_vms.py shutdown -j 4 vm1 vm2
+#   sudo provision_vms.py clone -j 4 -o $USER /dev/vg/golden-20160713 \
+#       vm1=/dev/vg/vm1-os vm2=/dev/vg/vm2-os
+#   provision_vms.py start vm1 vm2
+
+import os
+import pwd
+import stat
+import subprocess
+import sys
+import time
+
+from contextlib import contextmanager
+from optparse import OptionParser
+
+from maas_tools.workers import parallel_map
+
+CONCURRENCY = 4
+SHUTDOWN_TIMEOUT = 60
+POLL_INTERVAL = 2
+BACKUP_SUFFIX_FORMAT = '_%Y%m%d%H%M'
+
+
+class ProvisionError(Exception):
+    pass
+
+
+def run(cmd, **kwargs):
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True,
+                            **kwargs)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise ProvisionError('%s failed: %s' % (' '.join(cmd), err.strip()))
+    return out
+
+
+def is_block_device(path):
+    return stat.S_ISBLK(os.stat(path).st_mode)
+
+
+class LogicalVolume(object):
+    def __init__(self, path):
+        out = run(['lvs', '--noheadings', '--nosuffix', '--units', 'b',
+                   '--separator', '|', '-o', 'vg_name,lv_name,pool_lv,lv_size',
+                   path])
+        fields = out.strip().split('|')
+        self.vg, self.name, self.pool = (f.strip() for f in fields[:3])
+        self.size = int(fields[3])
+
+    @staticmethod
+    def exists(path):
+        return subprocess.call(['lvs', path], stdout=open(os.devnull, 'w'),
+                               stderr=subprocess.STDOUT) == 0
+
+    @property
+    def path(self):
+        return '/dev/%s/%s' % (self.vg, self.name)
+
+
+def kpartx_maps(out):
+    """Device mapper names of the partitions from `kpartx -av` output.
+    kpartx puts a 'p' between the disk and the partition number if the
+    disk name ends with a digit (golden-20160713p1), so the names are
+    not guessed"""
+    return [line.split()[2] for line in out.splitlines()
+            if line.startswith('add map ')]
+
+
+@contextmanager
+def partition(disk):
+    """Map the partitions of the disk (a block device or a file), yield
+    the path of the first one"""
+    if is_block_device(disk):
+        maps = kpartx_maps(run(['kpartx', '-av', disk]))
+        try:
+            if not maps:
+                raise ProvisionError('no partitions on %s' % disk)
+            yield '/dev/mapper/' + maps[0]
+        finally:
+            run(['kpartx', '-d', disk])
+    else:
+        loop = run(['losetup', '--find', '--show', '--partscan',
+                    disk]).strip()
+        try:
+            yield loop + 'p1'
+        finally:
+            run(['losetup', '-d', loop])
+
+
+def disk_size(path):
+    if is_block_device(path):
+        return LogicalVolume(path).size
+    return os.stat(path).st_size
+
+
+def prepare(golden, image, offset, template):
+    """Make the golden disk: the partition table of the template disk,
+    the root file system image written to the first partition. Does
+    nothing if the golden disk exists"""
+    if os.path.exists(golden) or (golden.startswith('/dev/') and
+                                  LogicalVolume.exists(golden)):
+        return False
+    size = disk_size(template)
+    if is_block_device(template):
+        lv = LogicalVolume(template)
+        if not lv.pool:
+            raise ProvisionError('%s is not a thin LV' % template)
+        vg, name = golden.split('/')[-2:]
+        if vg != lv.vg:
+            raise ProvisionError('%s must be in %s VG' % (golden, lv.vg))
+        run(['lvcreate', '-T', '%s/%s' % (lv.vg, lv.pool), '-V',
+             '%db' % size, '-n', name])
+    else:
+        with open(golden, 'wb') as f:
+            f.truncate(size)
+    try:
+        table = run(['sfdisk', '-d', template])
+        proc = subprocess.Popen(['sfdisk', '--no-reread', golden],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        out = proc.communicate(table)[0]
+        if proc.returncode != 0:
+            raise ProvisionError('failed to partition %s: %s' % (golden,
+                                                                 out))
+        run(['e2image', '-arO', str(offset), image, golden])
+        with partition(golden) as part:
+            run(['tune2fs', '-O', '^has_journal', part])
+            run(['e2fsck', '-fp', part])
+            run(['resize2fs', part])
+    except:
+        if is_block_device(golden):
+            run(['lvremove', '-f', golden])
+        else:
+            os.unlink(golden)
+        raise
+    return True
+
+
+def virsh(args, uri=None):
+    cmd = ['virsh']
+    if uri:
+        cmd += ['-c', uri]
+    return run(cmd + args)
+
+
+def domain_state(name, uri=None):
+    return virsh(['domstate', name], uri=uri).strip()
+
+
+def shutdown(name, timeout=SHUTDOWN_TIMEOUT, uri=None):
+    if domain_state(name, uri=uri) == 'shut off':
+        return
+    virsh(['shutdown', name], uri=uri)
+    deadline = time.time() + timeout
+    while domain_state(name, uri=uri) != 'shut off':
+        if time.time() > deadline:
+            raise ProvisionError('%s has not shut down in %ds' % (name,
+                                                                  timeout))
+        time.sleep(POLL_INTERVAL)
+
+
+def start(name, uri=None):
+    if domain_state(name, uri=uri) != 'running':
+        virsh(['start', name], uri=uri)
+
+
+def clone_lv(golden, disk, suffix):
+    golden_lv = LogicalVolume(golden)
+    lv = LogicalVolume(disk)
+    if (lv.vg, lv.pool) != (golden_lv.vg, golden_lv.pool) or not lv.pool:
+        raise ProvisionError('%s and %s must be in the same thin pool' % (
+            disk, golden))
+    run(['lvrename', lv.vg, lv.name, lv.name + suffix])
+    try:
+        run(['lvcreate', '-s', '-kn', '-n', lv.name, golden_lv.path])
+    except:
+        run(['lvrename', lv.vg, lv.name + suffix, lv.name])
+        raise
+    run(['lvchange', '-ay', '%s/%s' % (lv.vg, lv.name)])
+    if lv.size > golden_lv.size:
+        run(['lvextend', '-L', '%db' % lv.size, '%s/%s' % (lv.vg, lv.name)])
+
+
+def clone_file(golden, disk, suffix):
+    size = os.stat(disk).st_size
+    os.rename(disk, disk + suffix)
+    try:
+        run(['cp', '--reflink=auto', golden, disk])
+    except:
+        os.rename(disk + suffix, disk)
+        raise
+    if size > os.stat(disk).st_size:
+        with open(disk, 'r+b') as f:
+            f.truncate(size)
+
+
+def clone(golden, disk, owner=None):
+    """Replace the disk of a VM (which must be shut off) with a clone of
+    the golden one, keeping the old disk as a backup. The clone is given
+    to the owner, if any, so that libvirt running as that user can use
+    it"""
+    suffix = time.strftime(BACKUP_SUFFIX_FORMAT)
+    if is_block_device(disk):
+        clone_lv(golden, disk, suffix)
+    else:
+        clone_file(golden, disk, suffix)
+    if owner:
+        os.chown(disk, pwd.getpwnam(owner).pw_uid, -1)
+
+
+def for_each_vm(action, vms, done, concurrency=CONCURRENCY):
+    """Apply the action to the VMs ([(name, args)]) in parallel, returns
+    True if it has succeeded for all of them"""
+    def apply(vm):
+        name, args = vm
+        started = time.time()
+        try:
+            action(*args)
+        except (ProvisionError, EnvironmentError) as e:
+            print('%s: %s' % (name, e))
+            return False
+        print('%s: %s in %.1fs' % (name, done, time.time() - started))
+        return True
+
+    return all(parallel_map(apply, vms, concurrency=concurrency))
+
+
+def main():
+    parser = OptionParser(usage='%prog prepare [options] GOLDEN\n'
+                          '       %prog shutdown|start [options] NAME...\n'
+                          '       %prog clone [options] GOLDEN NAME=DISK...')
+    parser.add_option('-i', '--image', dest='image',
+                      help='root file system image (prepare)')
+    parser.add_option('-O', '--offset', dest='offset', type=int,
+                      help='offset of the root partition, bytes (prepare)')
+    parser.add_option('-t', '--template', dest='template',
+                      help='disk to copy the partition table from (prepare)')
+    parser.add_option('-o', '--owner', dest='owner',
+                      help='user to give the cloned disks to (clone)')
+    parser.add_option('-c', '--connect', dest='uri',
+                      help='libvirt URI (shutdown, start) [virsh default]')
+    parser.add_option('-j', '--jobs', dest='jobs', type=int,
+                      default=CONCURRENCY,
+                      help='max number of VMs provisioned at once '
+                      '[%default]')
+    parser.add_option('-T', '--shutdown-timeout', dest='shutdown_timeout',
+                      type=int, default=SHUTDOWN_TIMEOUT,
+                      help='wait that long for a VM to shut down, seconds '
+                      '[%default]')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('no mode given')
+    mode, args = args[0], args[1:]
+    if mode == 'prepare':
+        if len(args) != 1 or None in (options.image, options.offset,
+                                      options.template):
+            parser.error('prepare needs the golden disk, image, offset '
+                         'and template')
+        golden = args[0]
+        try:
+            if prepare(golden, options.image, options.offset,
+                       options.template):
+                print('%s: prepared' % golden)
+        except ProvisionError as e:
+            sys.stderr.write('%s\n' % e)
+            sys.exit(1)
+        return
+    if mode == 'shutdown':
+        if not args:
+            parser.error('no VMs given')
+        ok = for_each_vm(
+            lambda name: shutdown(name, timeout=options.shutdown_timeout,
+                                  uri=options.uri),
+            [(name, (name,)) for name in args], 'shut off',
+            concurrency=options.jobs)
+    elif mode == 'start':
+        if not args:
+            parser.error('no VMs given')
+        ok = for_each_vm(lambda name: start(name, uri=options.uri),
+                         [(name, (name,)) for name in args], 'started',
+                         concurrency=options.jobs)
+    elif mode == 'clone':
+        if not args:
+            parser.error('no golden disk given')
+        golden, args = args[0], args[1:]
+        vms = [arg.split('=', 1) for arg in args]
+        if not vms or any(len(vm) != 2 for vm in vms):
+            parser.error('VMs should be given as NAME=DISK')
+        ok = for_each_vm(lambda disk: clone(golden, disk, owner=options.owner),
+                         [(name, (disk,)) for name, disk in vms],
+                         'provisioned', concurrency=options.jobs)
+    else:
+        parser.error('unknown mode: %s' % mode)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# encoding: utf-8
+# python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from upgrade_plan import (
+    check_rules,
+    host_domains,
+    plan_batches,
+    rule_failure_domains,
+)
+
+
+def rule(name, *steps):
+    return {
+        'rule_name': name,
+        'steps': [{'op': 'take', 'item': -1, 'item_name': 'default'}] +
+                 list(steps) + [{'op': 'emit'}],
+    }
+
+
+def step(op, num, type_):
+    return {'op': op, 'num': num, 'type': type_}
+
+
+CHOOSELEAF_RACK = rule('rack', step('chooseleaf_firstn', 0, 'rack'))
+CHOOSELEAF_HOST = rule('host', step('chooseleaf_firstn', 0, 'host'))
+# a rack per replica, then a host (and an OSD) in every rack
+CHOOSE_RACK_LEAF_HOST = rule('rack_host',
+                             step('choose_firstn', 0, 'rack'),
+                             step('chooseleaf_firstn', 1, 'host'))
+# two racks, two hosts in each: the replicas share racks
+TWO_RACKS_TWO_HOSTS = rule('2racks',
+                           step('choose_firstn', 2, 'rack'),
+                           step('chooseleaf_firstn', 2, 'host'))
+
+
+class RuleFailureDomainsTest(unittest.TestCase):
+    def test_chooseleaf(self):
+        self.assertEqual(rule_failure_domains(CHOOSELEAF_RACK), ['rack'])
+        self.assertEqual(rule_failure_domains(CHOOSELEAF_HOST), ['host'])
+
+    def test_choose_then_single_chooseleaf(self):
+        self.assertEqual(rule_failure_domains(CHOOSE_RACK_LEAF_HOST),
+                         ['rack'])
+
+    def test_choose_then_several_chooseleaf(self):
+        self.assertEqual(rule_failure_domains(TWO_RACKS_TWO_HOSTS),
+                         ['host'])
+
+    def test_several_emits(self):
+        ssd_primary = {
+            'rule_name': 'ssd_primary',
+            'steps': CHOOSELEAF_RACK['steps'] + CHOOSELEAF_HOST['steps'],
+        }
+        self.assertEqual(rule_failure_domains(ssd_primary),
+                         ['rack', 'host'])
+
+    def test_no_choose(self):
+        self.assertEqual(rule_failure_domains(rule('osd')), [None])
+
+
+class CheckRulesTest(unittest.TestCase):
+    def test_good_rules(self):
+        self.assertEqual(check_rules([CHOOSELEAF_RACK,
+                                      CHOOSE_RACK_LEAF_HOST]), [])
+
+    def test_bad_rules(self):
+        self.assertEqual(check_rules([CHOOSELEAF_RACK, CHOOSELEAF_HOST,
+                                      TWO_RACKS_TWO_HOSTS]),
+                         [('host', ['host']), ('2racks', ['host'])])
+
+    def test_failure_domain_type(self):
+        self.assertEqual(check_rules([CHOOSELEAF_HOST], 'host'), [])
+        self.assertEqual(check_rules([CHOOSELEAF_RACK], 'host'),
+                         [('rack', ['rack'])])
+
+    def test_rule_without_steps(self):
+        self.assertEqual(check_rules([{'rule_id': 3}]), [(3, [])])
+
+
+class PlanBatchesTest(unittest.TestCase):
+    DOMAINS = [('rack1', ['a', 'b', 'c']), ('rack2', ['d'])]
+
+    def test_whole_domains(self):
+        self.assertEqual(plan_batches(self.DOMAINS), self.DOMAINS)
+
+    def test_max_hosts(self):
+        self.assertEqual(plan_batches(self.DOMAINS, max_hosts=2),
+                         [('rack1', ['a', 'b']), ('rack1', ['c']),
+                          ('rack2', ['d'])])
+
+    def test_from_tree(self):
+        tree = {'nodes': [
+            {'id': -1, 'name': 'default', 'type': 'root',
+             'children': [-2, -3, -6]},
+            {'id': -2, 'name': 'rack1', 'type': 'rack', 'children': [-4]},
+            {'id': -3, 'name': 'rack2', 'type': 'rack', 'children': [-5]},
+            {'id': -4, 'name': 'a', 'type': 'host', 'children': [0]},
+            {'id': -5, 'name': 'b', 'type': 'host', 'children': [1]},
+            # not in a rack
+            {'id': -6, 'name': 'c', 'type': 'host', 'children': [2]},
+            {'id': 0, 'name': 'osd.0', 'type': 'osd'},
+            {'id': 1, 'name': 'osd.1', 'type': 'osd'},
+            {'id': 2, 'name': 'osd.2', 'type': 'osd'},
+        ]}
+        self.assertEqual(plan_batches(host_domains(tree)),
+                         [('rack1', ['a']), ('rack2', ['b']), ('c', ['c'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
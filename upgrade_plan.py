@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Plan the OSD hosts upgrade batches by the CRUSH failure domains: if
+# the CRUSH rules place the replicas in distinct failure domains (racks
+# by default), all hosts of a domain can be down at once without making
+# PGs unavailable, so they are upgraded together (at most --max-hosts
+# at a time). The rules are checked: no plan is made unless every rule
+# separates the replicas by the failure domain type. The plan is written
+# as extra vars for imgbased_os_upgrade.yml:
+#
+#   ssh saceph-mon ceph osd crush rule dump --format=json > rules.json
+#   ssh saceph-mon ceph osd tree --format=json | \
+#       ./upgrade_plan.py -r rules.json -o plan.json
+#   ansible-playbook -i ./maas_inventory.py -e @plan.json imgbased_os_upgrade.yml
+#
+# The hosts are listed in the batches order, osd_upgrade_serial holds
+# the batches' sizes. OSD hosts missing in the CRUSH map are upgraded
+# one by one after all the batches. osd_upgrade_batch_of maps every host
+# to its batch (an index into osd_upgrade_batches), so the playbook can
+# stop if a batch ansible makes is not exactly a planned one (say, some
+# hosts are missing in the inventory or excluded with --limit, and the
+# batches are shifted across the failure domains).
+
+import json
+import sys
+
+from optparse import OptionParser
+
+FAILURE_DOMAIN = 'rack'
+DOMAIN = 'maas'
+# 0 means no limit
+MAX_HOSTS = 0
+
+
+def host_domains(tree, domain_type=FAILURE_DOMAIN):
+    """[(failure domain, [hosts])] in the order of the CRUSH tree. Hosts
+    which are not within a domain of the given type (say, placed directly
+    under the root) form a domain of their own"""
+    nodes = dict((node['id'], node) for node in tree['nodes'])
+    children = set(child for node in tree['nodes']
+                   for child in node.get('children', ()))
+    roots = [node for node in tree['nodes'] if node['id'] not in children]
+    domains = []
+    by_name = {}
+    seen = set()
+
+    def visit(node, domain):
+        if node['type'] == domain_type:
+            domain = node['name']
+        if node['type'] == 'host':
+            if node['name'] in seen:
+                return
+            seen.add(node['name'])
+            name = domain or node['name']
+            if name not in by_name:
+                by_name[name] = []
+                domains.append((name, by_name[name]))
+            by_name[name].append(node['name'])
+            return
+        for child_id in node.get('children', ()):
+            if child_id in nodes:
+                visit(nodes[child_id], domain)
+
+    for root in roots:
+        if root['type'] != 'osd':
+            visit(root, None)
+    return domains
+
+
+def rule_failure_domains(rule):
+    """CRUSH types the rule spreads the replicas over, one per take..emit
+    block. The replicas are separated by the first choose(leaf) step, a
+    later one picking several items puts several replicas under every
+    item chosen before, so these are separated by its type instead"""
+    domains = []
+    domain = None
+    for step in rule.get('steps', ()):
+        op = step.get('op', '')
+        if op == 'take':
+            domain = None
+        elif op.startswith('choose'):
+            if domain is None or step.get('num') != 1:
+                domain = step.get('type')
+        elif op == 'emit':
+            domains.append(domain)
+            domain = None
+    return domains
+
+
+def check_rules(rules, domain_type=FAILURE_DOMAIN):
+    """[(rule name, [types])] of the rules which don't spread the replicas
+    over the failure domains of the given type"""
+    bad = []
+    for rule in rules:
+        domains = rule_failure_domains(rule)
+        if not domains or any(d != domain_type for d in domains):
+            bad.append((rule.get('rule_name', rule.get('rule_id')),
+                        domains))
+    return bad
+
+
+def plan_batches(domains, max_hosts=MAX_HOSTS):
+    """[(failure domain, [hosts])] of the batches, domains having more
+    than max_hosts hosts are split"""
+    batches = []
+    for domain, hosts in domains:
+        step = max_hosts if max_hosts > 0 else len(hosts)
+        for start in range(0, len(hosts), step):
+            batches.append((domain, hosts[start:start + step]))
+    return batches
+
+
+def upgrade_vars(batches, dns_domain=DOMAIN):
+    def fqdn(host):
+        return '%s.%s' % (host, dns_domain) if dns_domain else host
+
+    return {
+        'osd_upgrade_batch_of': dict((fqdn(host), i)
+                                     for i, (domain, hosts) in
+                                     enumerate(batches)
+                                     for host in hosts),
+        'osd_upgrade_hosts': [fqdn(host) for domain, hosts in batches
+                              for host in hosts],
+        # the last batch size is used for the rest of the hosts, that is,
+        # the ones missing in the plan are upgraded one by one
+        'osd_upgrade_serial': [len(hosts) for domain, hosts in batches] + [1],
+        'osd_upgrade_batches': [{'failure_domain': domain,
+                                 'hosts': [fqdn(host) for host in hosts]}
+                                for domain, hosts in batches],
+    }
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] -r rules.json '
+                          '[osd-tree.json]')
+    parser.add_option('-r', '--rules', dest='rules',
+                      help='CRUSH rules (ceph osd crush rule dump '
+                      '--format=json)')
+    parser.add_option('-t', '--failure-domain', dest='failure_domain',
+                      default=FAILURE_DOMAIN,
+                      help='CRUSH type of the failure domain [%default]')
+    parser.add_option('-p', '--max-hosts', dest='max_hosts', type=int,
+                      default=MAX_HOSTS,
+                      help='max number of hosts upgraded at once '
+                      '(0: the whole failure domain) [%default]')
+    parser.add_option('-d', '--domain', dest='domain', default=DOMAIN,
+                      help='DNS domain of the hosts in the inventory '
+                      '[%default]')
+    parser.add_option('-o', '--output', dest='output',
+                      help='write the extra vars to the file [stdout]')
+    options, args = parser.parse_args()
+    if len(args) > 1:
+        parser.error('too many arguments')
+    if not options.rules:
+        parser.error('no CRUSH rules given')
+    with open(options.rules) as f:
+        bad_rules = check_rules(json.load(f), options.failure_domain)
+    if bad_rules:
+        for name, domains in bad_rules:
+            sys.stderr.write('rule %s spreads the replicas over: %s\n' % (
+                name, ', '.join(str(d) for d in domains) or 'nothing'))
+        sys.stderr.write('not every rule spreads the replicas over %s '
+                         'failure domains, refusing to batch\n' %
+                         options.failure_domain)
+        sys.exit(1)
+    if args:
+        with open(args[0]) as f:
+            tree = json.load(f)
+    else:
+        tree = json.load(sys.stdin)
+    batches = plan_batches(host_domains(tree, options.failure_domain),
+                           options.max_hosts)
+    if not batches:
+        sys.stderr.write('no hosts in the CRUSH map\n')
+        sys.exit(1)
+    for domain, hosts in batches:
+        sys.stderr.write('%s: %s\n' % (domain, ' '.join(hosts)))
+    data = json.dumps(upgrade_vars(batches, options.domain), indent=2,
+                      sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()